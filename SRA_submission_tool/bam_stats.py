@@ -0,0 +1,327 @@
+import SRA_submission_tool.constants as c
+import array
+import logging
+import multiprocessing
+import struct
+from SRA_submission_tool import bgzf
+from SRA_submission_tool.file_service import FingerprintCache, file_fingerprint
+from SRA_submission_tool.resource_broker import ResourceBroker
+try:
+    import numpy
+except ImportError:
+    numpy = None
+__author__ = 'Amr Abouelleil'
+
+# Read and base counts straight from the BGZF blocks of a BAM. The block chain is split into ranges of whole blocks
+# that are inflated and scanned in separate processes. Alignment records run across block boundaries, so every range
+# but the first has to find its first record by looking for a plausible chain of records; the parent checks each guess
+# against where the previous range's last record actually ended and rescans any range that guessed wrong.
+
+record_fields = struct.Struct("<iiiBBHHHiiii")  # block_size up to tlen, the fixed-size start of every record
+resync_window = 4 * bgzf.max_block_size  # inflated bytes searched for a first record before giving up on a range
+resync_chain = 4  # consecutive plausible records needed to accept a record boundary
+tally_every = 1 << 20  # records buffered per range before they are tallied
+
+
+def _tally(flags, lengths):
+    """
+    Counts the records of a range.
+    :param flags: an array of record flags.
+    :param lengths: an array of record sequence lengths, in the same order.
+    :return: a (records, reads, bases, unmapped) tuple. Reads, bases and unmapped count primary records only.
+    """
+    if numpy is not None and len(flags):
+        flags = numpy.frombuffer(flags, dtype=numpy.uint16)
+        lengths = numpy.frombuffer(lengths, dtype=numpy.int32)
+        primary = (flags & 0x900) == 0
+        return (len(flags), int(primary.sum()), int(lengths[primary].sum(dtype=numpy.int64)),
+                int(((flags & 0x4) != 0)[primary].sum()))
+    reads = bases = unmapped = 0
+    for flag, length in zip(flags, lengths):
+        if not flag & 0x900:
+            reads += 1
+            bases += length
+            unmapped += flag & 0x4 and 1
+    return len(flags), reads, bases, unmapped
+
+
+def _plausible_record(data, position, n_ref):
+    """
+    Checks whether an alignment record could start at a position.
+    :return: the record's size including its block_size field, or None if no record can start there.
+    """
+    if position + record_fields.size > len(data):
+        return None
+    (block_size, ref_id, pos, l_read_name, mapq, bin_, n_cigar_op, flag, l_seq, next_ref_id, next_pos,
+     tlen) = record_fields.unpack_from(data, position)
+    if not (-1 <= ref_id < n_ref and -1 <= next_ref_id < n_ref and pos >= -1 and next_pos >= -1):
+        return None
+    if l_read_name < 2 or l_seq < 0 or block_size < 32 + l_read_name + 4 * n_cigar_op + (l_seq + 1) // 2 + l_seq:
+        return None
+    name_start = position + record_fields.size
+    if name_start + l_read_name <= len(data):
+        name = data[name_start:name_start + l_read_name]
+        if name[-1] != "\x00" or not all("!" <= char <= "~" for char in name[:-1]):
+            return None
+    return block_size + 4
+
+
+def find_first_record(data, n_ref):
+    """
+    Finds the first alignment record in a stretch of inflated BAM data that does not start on a record boundary.
+    :param data: the inflated data.
+    :param n_ref: the number of reference sequences in the BAM header.
+    :return: the offset of the first record, or None if none was found.
+    """
+    for position in range(len(data) - record_fields.size + 1):
+        next_position = position
+        chain = 0
+        while chain < resync_chain and next_position + record_fields.size <= len(data):
+            size = _plausible_record(data, next_position, n_ref)
+            if size is None:
+                break
+            next_position += size
+            chain += 1
+        else:
+            # a full chain, or one that ran off the end of the data without a bad record
+            return position
+    return None
+
+
+def scan_range(task):
+    """
+    Pool worker that counts the alignment records starting in a range of BGZF blocks.
+    :param task: a (bam_file, start, end, n_ref, first_record) tuple. start and end are compressed offsets on block
+    boundaries and first_record is the inflated offset of the first record in the range, or None to search for it.
+    :return: a dictionary with the range's counts, the first_record used, and the overhang: how many inflated bytes
+    past the end of the range the first record of the next range starts. first_record is None if no record was found.
+    """
+    bam_file, start, end, n_ref, first_record = task
+    try:
+        return _scan(bam_file, start, end, n_ref, first_record)
+    except bgzf.BgzfError:
+        if first_record is None:
+            # most likely a false record boundary; the parent rescans the range from the right one
+            return {'first_record': None}
+        raise
+
+
+def _scan(bam_file, start, end, n_ref, first_record):
+    counts = [0, 0, 0, 0]
+    flags = array.array('H')
+    lengths = array.array('i')
+    buffer = ""
+    buffer_start = 0
+    range_length = 0
+    position = first_record
+    with open(bam_file, 'rb') as handle:
+        handle.seek(start)
+        while True:
+            if position is not None:
+                while position < range_length:
+                    offset = position - buffer_start
+                    if offset + record_fields.size > len(buffer):
+                        break
+                    fields = record_fields.unpack_from(buffer, offset)
+                    size = fields[0] + 4
+                    if size < record_fields.size:
+                        raise bgzf.BgzfError(bam_file + " has a corrupt alignment record.")
+                    if offset + size > len(buffer):
+                        break
+                    flags.append(fields[7])
+                    lengths.append(fields[8])
+                    position += size
+                if len(flags) >= tally_every:
+                    counts = [a + b for a, b in zip(counts, _tally(flags, lengths))]
+                    flags = array.array('H')
+                    lengths = array.array('i')
+                consumed = min(position - buffer_start, len(buffer))
+                buffer = buffer[consumed:]
+                buffer_start += consumed
+            in_range = handle.tell() < end
+            if position is None and (not in_range or len(buffer) >= resync_window):
+                position = find_first_record(buffer, n_ref)
+                if position is None:
+                    return {'first_record': None}
+                first_record = position
+                continue
+            if not in_range and position >= range_length:
+                break
+            block = bgzf.read_block(handle)
+            if block is None:
+                raise bgzf.BgzfError(bam_file + " ends inside an alignment record.")
+            if in_range:
+                range_length += len(block[1])
+            buffer += block[1]
+    counts = [a + b for a, b in zip(counts, _tally(flags, lengths))]
+    return {'first_record': first_record, 'overhang': position - range_length, 'records': counts[0],
+            'reads': counts[1], 'bases': counts[2], 'unmapped': counts[3]}
+
+
+def next_template(reader):
+    """
+    Moves a reader past the records that share the read name of the record at its position.
+    :param reader: a BgzfReader positioned at an alignment record.
+    :return: the virtual offset of the first record with another read name, or None if there is none.
+    """
+    name = None
+    while True:
+        virtual_offset = reader.tell()
+        size = reader.read(4)
+        if len(size) < 4:
+            return None
+        record = reader.read(struct.unpack("<i", size)[0])
+        record_name = record[32:32 + ord(record[8])]
+        if name is None:
+            name = record_name
+        elif record_name != name:
+            return virtual_offset
+
+
+class StatsCache(FingerprintCache):
+    """
+    A persistent cache of bam statistics keyed by file fingerprint.
+    """
+    def __init__(self, cache_db=None):
+        super(StatsCache, self).__init__(cache_db or c.bam_stats_cache_file)
+
+
+class BamStatistics(object):
+    """
+    A class for computing read and base counts of bam files by scanning their BGZF blocks across a process pool.
+    """
+    def __init__(self, processes=None, min_range_size=None, cache=True, cache_db=None):
+        """
+        :param processes: size of the process pool. Defaults to c.bam_stats_processes, or every core if that is None.
+        The resource broker may grant fewer.
+        :param min_range_size: smallest compressed range given to one process, in bytes.
+        """
+        self.logger = logging.getLogger('sra_tool.bam_stats.BamStatistics')
+        self.processes = processes or c.bam_stats_processes or multiprocessing.cpu_count()
+        self.min_range_size = min_range_size or c.bam_stats_min_range_size
+        self.cache = StatsCache(cache_db) if cache else None
+
+    def block_ranges(self, bam_file, first_block=0):
+        """
+        Splits the block chain of a bam into ranges of roughly equal compressed size.
+        :param bam_file: path to the bam.
+        :param first_block: compressed offset of the first block to include.
+        :return: a list of (start, end) compressed offsets, each on a block boundary.
+        """
+        blocks = [(offset, size) for offset, size in bgzf.walk_blocks(bam_file) if offset >= first_block]
+        if not blocks:
+            return []
+        total = blocks[-1][0] + blocks[-1][1] - first_block
+        n_ranges = max(1, min(self.processes, total // self.min_range_size, len(blocks)))
+        ranges = []
+        start = first_block
+        for offset, size in blocks:
+            if offset > start and offset - first_block >= total * (len(ranges) + 1) // n_ranges:
+                ranges.append((start, offset))
+                start = offset
+        ranges.append((start, blocks[-1][0] + blocks[-1][1]))
+        return ranges
+
+    def scan(self, bam_file):
+        """
+        Scans every range of a bam, rescanning any range whose first record was guessed wrong.
+        :param bam_file: path to the bam.
+        :return: a list of (task, result) tuples in file order, where task[1] is the compressed offset of the range and
+        result['first_record'] the inflated offset of its first record from there.
+        """
+        with bgzf.BgzfReader(bam_file) as reader:
+            references = bgzf.read_bam_header(reader)[1]
+            virtual_offset = reader.tell()
+        ranges = self.block_ranges(bam_file, virtual_offset >> 16)
+        tasks = [(bam_file, start, end, len(references), None) for start, end in ranges]
+        tasks[0] = tasks[0][:4] + (virtual_offset & 0xffff,)
+        with ResourceBroker().acquire(cpus=min(self.processes, len(tasks)), memory_mb=c.bam_stats_memory_mb,
+                                      min_cpus=1, label="bam statistics " + bam_file) as grant:
+            if grant.cpus > 1:
+                pool = multiprocessing.Pool(grant.cpus)
+                try:
+                    results = pool.map(scan_range, tasks)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [scan_range(task) for task in tasks]
+        scanned = []
+        expected = tasks[0][4]
+        for task, result in zip(tasks, results):
+            if result['first_record'] != expected:
+                self.logger.debug("Rescanning range at offset " + str(task[1]) + " of " + bam_file)
+                result = scan_range(task[:4] + (expected,))
+            scanned.append((task, result))
+            expected = result['overhang']
+        return scanned
+
+    def compute_stats(self, bam_file):
+        """
+        Counts the records, primary reads and bases of a bam.
+        :param bam_file: path to the bam.
+        :return: a dictionary of records, reads, bases, unmapped (primary reads) and mean_read_length.
+        """
+        return self.summarize(bam_file, self.scan(bam_file))
+
+    def summarize(self, bam_file, scanned):
+        """
+        Adds up the counts of the scanned ranges of a bam.
+        :param bam_file: path to the bam.
+        :param scanned: the list returned by scan.
+        :return: a dictionary of records, reads, bases, unmapped (primary reads) and mean_read_length.
+        """
+        stats = {'records': 0, 'reads': 0, 'bases': 0, 'unmapped': 0}
+        for task, result in scanned:
+            for key in stats:
+                stats[key] += result[key]
+        stats['mean_read_length'] = round(float(stats['bases']) / stats['reads'], 1) if stats['reads'] else 0.0
+        self.logger.info("Statistics for " + bam_file + " from " + str(len(scanned)) + " ranges: " + str(stats))
+        return stats
+
+    def shard_boundaries(self, bam_file):
+        """
+        Splits a bam into shards of whole templates, one per scanned range. Records sharing a read name are kept in
+        the same shard, so a bam grouped by name splits without separating mates. Bams whose header does not declare
+        them grouped by name (SO:queryname or GO:query) could have mates anywhere in the file and are not split. The
+        statistics counted by the scan are cached, so a later get_stats does not scan the bam again.
+        :param bam_file: path to the bam.
+        :return: a list of BGZF virtual offsets at which the shards start, the first being the first record.
+        """
+        with bgzf.BgzfReader(bam_file) as reader:
+            text = bgzf.read_bam_header(reader)[0]
+            first_record = reader.tell()
+        tags = bgzf.parse_header_text(text)['HD']
+        if tags.get('SO') != "queryname" and tags.get('GO') != "query":
+            self.logger.info(bam_file + " is not grouped by read name, so it is not split into shards.")
+            return [first_record]
+        fingerprint = file_fingerprint(bam_file)
+        scanned = self.scan(bam_file)
+        if self.cache:
+            self.cache.put(bam_file, self.summarize(bam_file, scanned), fingerprint)
+        boundaries = []
+        with bgzf.BgzfReader(bam_file) as reader:
+            for task, result in scanned:
+                reader.seek(task[1] << 16)
+                reader.read(result['first_record'])
+                boundary = next_template(reader) if boundaries else reader.tell()
+                if boundary is not None and (not boundaries or boundary > boundaries[-1]):
+                    boundaries.append(boundary)
+        return boundaries
+
+    def get_stats(self, bam_file):
+        """
+        Gets the statistics of a bam, from the cache when the file has not changed since they were computed.
+        :param bam_file: path to the bam.
+        :return: the dictionary returned by compute_stats.
+        """
+        if self.cache:
+            stats = self.cache.get(bam_file)
+            if stats is not None:
+                self.logger.debug("Statistics cache hit for " + bam_file)
+                return stats
+        fingerprint = file_fingerprint(bam_file)
+        stats = self.compute_stats(bam_file)
+        if self.cache:
+            self.cache.put(bam_file, stats, fingerprint)
+        return stats
@@ -0,0 +1,286 @@
+import struct
+import zlib
+import logging
+import os
+__author__ = 'Amr Abouelleil'
+
+# Minimal BGZF and BAM header support. BAM files are a series of independently deflated gzip members ("blocks") of at
+# most 64KB each; the header sits at the front of the stream, so only the first few blocks ever need inflating.
+
+bgzf_magic = "\x1f\x8b\x08\x04"
+bam_magic = "BAM\x01"
+eof_block = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00"
+             "\x00\x00")
+max_block_size = 65536
+max_data_size = 0xff00  # inflated bytes per block written, leaving room for data that does not compress
+
+
+class BgzfError(Exception):
+    """
+    Raised when a file is not valid BGZF or BAM.
+    """
+    pass
+
+
+def read_block(handle):
+    """
+    Reads and inflates the next BGZF block.
+    :param handle: a binary file object positioned at the start of a block.
+    :return: a (block_size, data) tuple where block_size is the compressed size on disk, or None at end of file.
+    """
+    block_header = _read_block_header(handle)
+    if block_header is None:
+        return None
+    block_size, header_length = block_header
+    body_length = block_size - header_length
+    body = handle.read(body_length)
+    if len(body) != body_length or body_length < 8:
+        raise BgzfError("Truncated BGZF block.")
+    crc, data_length = struct.unpack("<Ii", body[-8:])
+    try:
+        data = zlib.decompress(body[:-8], -15)
+    except zlib.error as e:
+        raise BgzfError("Corrupt BGZF block: " + str(e))
+    if len(data) != data_length or zlib.crc32(data) & 0xffffffff != crc:
+        raise BgzfError("Corrupt BGZF block: size or CRC mismatch.")
+    return block_size, data
+
+
+def read_block_size(handle):
+    """
+    Reads the size of the BGZF block at the handle's position from its header alone, without inflating it.
+    :param handle: a binary file object positioned at the start of a block.
+    :return: the compressed block size, or None at end of file.
+    """
+    block_header = _read_block_header(handle)
+    return block_header and block_header[0]
+
+
+def _read_block_header(handle):
+    # reads the gzip header of a block, without seeking so that pipes can be read; returns (block_size, header_length)
+    header = handle.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:4] != bgzf_magic:
+        offset = _offset(handle)
+        raise BgzfError("Not a BGZF block" + (" at offset " + str(offset - len(header)) if offset is not None else ""))
+    extra = handle.read(struct.unpack("<H", header[10:12])[0])
+    position = 0
+    while position + 4 <= len(extra):
+        subfield_length = struct.unpack("<H", extra[position + 2:position + 4])[0]
+        if extra[position:position + 2] == "BC" and subfield_length == 2:
+            return struct.unpack("<H", extra[position + 4:position + 6])[0] + 1, 12 + len(extra)
+        position += 4 + subfield_length
+    raise BgzfError("BGZF block without a BC size field.")
+
+
+def _offset(handle):
+    try:
+        return handle.tell()
+    except IOError:
+        return None  # a pipe
+
+
+def walk_blocks(path):
+    """
+    Follows the chain of BGZF blocks by seeking from header to header.
+    :param path: path to the BGZF file.
+    :return: a generator of (offset, block_size) tuples. Raises BgzfError if the chain breaks or overruns the file.
+    """
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as handle:
+        offset = 0
+        while offset < file_size:
+            handle.seek(offset)
+            block_size = read_block_size(handle)
+            if block_size is None or offset + block_size > file_size:
+                raise BgzfError("BGZF block at offset " + str(offset) + " runs past the end of " + path)
+            yield offset, block_size
+            offset += block_size
+
+
+def has_eof_marker(path):
+    """
+    :return: True if the file ends with the empty BGZF block that marks a completely written file.
+    """
+    with open(path, 'rb') as handle:
+        handle.seek(0, os.SEEK_END)
+        if handle.tell() < len(eof_block):
+            return False
+        handle.seek(-len(eof_block), os.SEEK_END)
+        return handle.read() == eof_block
+
+
+def compress_block(data, level=6):
+    """
+    Deflates data into a single BGZF block.
+    :param data: at most max_block_size bytes.
+    :param level: zlib compression level.
+    :return: the block as a string.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    body = compressor.compress(data) + compressor.flush()
+    return (bgzf_magic + "\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" + struct.pack("<H", len(body) + 25) + body +
+            struct.pack("<Ii", zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+def write_blocks(handle, data):
+    """
+    Deflates data into as many BGZF blocks as it needs and writes them.
+    :param handle: a binary file object.
+    :param data: the inflated data.
+    """
+    for i in range(0, len(data), max_data_size):
+        handle.write(compress_block(data[i:i + max_data_size]))
+
+
+class BgzfReader(object):
+    """
+    A sequential reader over the inflated contents of a BGZF file. Blocks are inflated one at a time as they are
+    needed, so reading the first bytes of a large file costs only the blocks that cover them.
+    """
+
+    def __init__(self, path, handle=None):
+        """
+        :param path: path to the BGZF file.
+        :param handle: an already open binary stream to read instead of opening path, for pipes. Blocks are read
+        strictly in order, so the stream is left at the start of the block after the last one read.
+        """
+        self.logger = logging.getLogger('sra_tool.bgzf.BgzfReader')
+        self.path = path
+        self.owns_handle = handle is None
+        self.handle = open(path, 'rb') if handle is None else handle
+        self.block_start = 0
+        self.next_block_start = 0
+        self.buffer = ""
+        self.position = 0
+
+    def _load_block(self):
+        self.block_start = self.next_block_start
+        block = read_block(self.handle)
+        if block is None:
+            return False
+        self.next_block_start += block[0]
+        self.buffer = block[1]
+        self.position = 0
+        return True
+
+    def read(self, size):
+        """
+        Reads exactly size inflated bytes, or fewer at end of file.
+        :param size: number of bytes to read.
+        :return: a string.
+        """
+        chunks = []
+        while size > 0:
+            if self.position >= len(self.buffer) and not self._load_block():
+                break
+            chunk = self.buffer[self.position:self.position + size]
+            self.position += len(chunk)
+            size -= len(chunk)
+            chunks.append(chunk)
+        return "".join(chunks)
+
+    def seek(self, virtual_offset):
+        """
+        Moves to a BGZF virtual offset, as returned by tell.
+        :param virtual_offset: the compressed offset of a block shifted left 16 bits, plus an offset within the block.
+        """
+        self.handle.seek(virtual_offset >> 16)
+        self.block_start = self.next_block_start = virtual_offset >> 16
+        self.buffer = ""
+        self.position = 0
+        if virtual_offset & 0xffff:
+            self._load_block()
+            self.position = virtual_offset & 0xffff
+
+    def read_block_remainder(self):
+        """
+        Reads what is left of the current block, leaving the reader on a block boundary.
+        :return: a string, empty if the reader is already on a block boundary.
+        """
+        remainder = self.buffer[self.position:]
+        self.position = len(self.buffer)
+        return remainder
+
+    def tell(self):
+        """
+        :return: the BGZF virtual offset of the next byte: the compressed offset of its block shifted left 16 bits,
+        plus its offset within the inflated block.
+        """
+        if self.position >= len(self.buffer):
+            return self.next_block_start << 16
+        return (self.block_start << 16) | self.position
+
+    def close(self):
+        if self.owns_handle:
+            self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_bam_header(reader):
+    """
+    Reads the BAM header from the start of a BgzfReader, leaving the reader at the first alignment record.
+    :param reader: a freshly opened BgzfReader.
+    :return: a (header_text, references) tuple, references being a list of (name, length) tuples.
+    """
+    if reader.read(4) != bam_magic:
+        raise BgzfError(reader.path + " is not a BAM file.")
+    text = _read_exactly(reader, _read_int(reader)).rstrip("\x00")
+    references = []
+    for i in range(_read_int(reader)):
+        name = _read_exactly(reader, _read_int(reader)).rstrip("\x00")
+        references.append((name, _read_int(reader)))
+    return text, references
+
+
+def encode_bam_header(text, references):
+    """
+    Encodes a BAM header, the inverse of read_bam_header.
+    :param text: the SAM header text.
+    :param references: a list of (name, length) tuples.
+    :return: the inflated header bytes, ready to be split into blocks.
+    """
+    data = [bam_magic, struct.pack("<i", len(text)), text, struct.pack("<i", len(references))]
+    for name, length in references:
+        data.append(struct.pack("<i", len(name) + 1) + name + "\x00" + struct.pack("<i", length))
+    return "".join(data)
+
+
+def _read_exactly(reader, size):
+    data = reader.read(size)
+    if len(data) != size:
+        raise BgzfError(reader.path + " ends inside the BAM header.")
+    return data
+
+
+def _read_int(reader):
+    return struct.unpack("<i", _read_exactly(reader, 4))[0]
+
+
+def parse_header_text(text):
+    """
+    Parses SAM header text into structured records.
+    :param text: the header text, one @-line per record.
+    :return: a dictionary with an 'HD' dict of tags and 'SQ', 'RG', 'PG' lists of tag dicts in file order, plus a
+    'CO' list of comment strings.
+    """
+    header = {'HD': dict(), 'SQ': [], 'RG': [], 'PG': [], 'CO': []}
+    for line in text.splitlines():
+        if not line.startswith("@"):
+            continue
+        record_type = line[1:3]
+        if record_type == 'CO':
+            header['CO'].append(line[4:])
+            continue
+        tags = dict(field.split(":", 1) for field in line.split("\t")[1:] if ":" in field)
+        if record_type == 'HD':
+            header['HD'] = tags
+        else:
+            header.setdefault(record_type, []).append(tags)
+    return header
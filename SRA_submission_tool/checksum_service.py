@@ -0,0 +1,103 @@
+import SRA_submission_tool.constants as c
+import logging
+import multiprocessing
+import sqlite3
+from SRA_submission_tool.file_service import ChecksumCreator, FingerprintCache, file_fingerprint
+from SRA_submission_tool.resource_broker import ResourceBroker
+__author__ = 'Amr Abouelleil'
+
+
+def compute_digests(target_file):
+    """
+    Pool worker that streams one file through ChecksumCreator.
+    :param target_file: path to the file.
+    :return: a (target_file, digests) tuple.
+    """
+    return target_file, ChecksumCreator(target_file).compute_digests()
+
+
+class ChecksumCache(FingerprintCache):
+    """
+    A persistent cache of file digests keyed by file fingerprint, so nothing is written next to the data.
+    """
+    def __init__(self, cache_db=None):
+        super(ChecksumCache, self).__init__(cache_db or c.checksum_cache_file)
+
+
+class ChecksumService(object):
+    """
+    A service that checksums every file of a submission. Files are hashed in parallel, and their digests are cached by
+    file fingerprint, so later runs reuse them until the file changes size, mtime or inode.
+    """
+    def __init__(self, processes=None, cache=True, cache_db=None):
+        self.logger = logging.getLogger('sra_tool.checksum_service.ChecksumService')
+        self.processes = processes or c.checksum_processes
+        self.cache = None
+        if cache:
+            try:
+                self.cache = ChecksumCache(cache_db)
+            except sqlite3.Error as e:
+                self.logger.warning("Checksum cache unavailable, hashing every file: " + str(e))
+
+    def cached_checksum(self, target_file):
+        """
+        :param target_file: path to the file.
+        :return: the cached md5 hex digest, or None if it is not cached or the file changed since.
+        """
+        if not self.cache:
+            return None
+        try:
+            digests = self.cache.get(target_file)
+        except (sqlite3.Error, OSError) as e:
+            self.logger.warning("Could not read checksum cache: " + str(e))
+            return None
+        return digests['md5'] if digests else None
+
+    def cache_checksum(self, target_file, digests, fingerprint):
+        """
+        :param target_file: path to the file.
+        :param digests: the file's digests.
+        :param fingerprint: the file's fingerprint taken before it was hashed.
+        """
+        if not self.cache:
+            return
+        try:
+            self.cache.put(target_file, digests, fingerprint)
+        except sqlite3.Error as e:
+            self.logger.warning("Could not write checksum cache: " + str(e))
+
+    def get_checksums(self, file_list):
+        """
+        Gets the md5 of every file in a list, hashing only those without a cached digest.
+        :param file_list: a list of file paths. Symlinks are followed.
+        :return: a dictionary of file path to md5 hex digest.
+        """
+        checksums = dict()
+        to_hash = []
+        fingerprints = dict()
+        for target_file in file_list:
+            checksum = self.cached_checksum(target_file)
+            if checksum:
+                self.logger.debug("Reusing cached checksum for " + target_file)
+                checksums[target_file] = checksum
+            elif target_file not in fingerprints:
+                to_hash.append(target_file)
+                fingerprints[target_file] = file_fingerprint(target_file)
+        results = []
+        if to_hash:
+            with ResourceBroker().acquire(cpus=min(self.processes, len(to_hash)), memory_mb=c.checksum_memory_mb,
+                                          min_cpus=1, label="checksums of " + to_hash[0]) as grant:
+                if grant.cpus > 1:
+                    pool = multiprocessing.Pool(grant.cpus)
+                    try:
+                        results = pool.map(compute_digests, to_hash)
+                    finally:
+                        pool.close()
+                        pool.join()
+                else:
+                    results = [compute_digests(target_file) for target_file in to_hash]
+        for target_file, digests in results:
+            checksums[target_file] = digests['md5']
+            self.cache_checksum(target_file, digests, fingerprints[target_file])
+        self.logger.info("Checksums ready for " + str(len(checksums)) + " files, " + str(len(to_hash)) + " hashed.")
+        return checksums
@@ -50,4 +50,67 @@ screen_temp_dir = "/cil/shed/resources/sra_submission_tool/temp/screening/"
 #For live
 spuid_prefix = "BI_"
 submission_db = "/cil/shed/resources/sra_submission_tool/db/submission.db"
-sra_root_dir = 'Production'
\ No newline at end of file
+sra_root_dir = 'Production'
+
+# Submission DB and cache connection tuning. They live on shared storage opened from several hosts, where only a
+# rollback journal is safe: WAL keeps its index in shared memory, which does not work across hosts on a network
+# filesystem, and sqlite cannot detect that. Opt in to "WAL", which lets readers run alongside writers, only if every
+# one of these databases is on local disk.
+db_journal_mode = "DELETE"
+db_synchronous = "NORMAL"
+db_statement_cache_size = 100
+db_max_variables = 500  # bound parameters per batched IN query, below sqlite's default limit of 999
+db_page_size = 1000  # rows per page when streaming submissions
+terminal_states = ['processed-ok', 'abandoned']
+archive_after_days = 90  # terminal submissions untouched this long are moved to submissions_archive
+job_lease_seconds = 600  # a claimed job returns to the queue if its worker does not renew the lease in time
+job_max_attempts = 3
+status_flush_interval = 30  # seconds between write-behind flushes of monitor updates
+write_behind_states = ['monitoring', 'processing', 'submitted']  # other statuses are written through immediately
+header_cache_file = "header_cache.db"  # kept in the same directory as submission_db
+fingerprint_cache_max_age_days = 90  # cached header, validation and stats results older than this are pruned
+fingerprint_cache_max_entries = 100000  # per cache file; only the most recently cached results are kept
+checksum_chunk_size = 8 * 1024 * 1024  # bytes read per call when streaming a file through the digests
+checksum_buffers = 3  # rotating read buffers shared by the reader and hashing threads
+checksum_processes = 4  # files of one submission hashed in parallel
+checksum_cache_file = "checksum_cache.db"  # kept in the same directory as submission_db
+validation_cache_file = "validation_cache.db"  # kept in the same directory as submission_db
+# JVM flags for pre-validating a bam below validation_fast_start_max_size. Each bam gets its own short-lived JVM, so
+# favour startup time over peak JIT throughput. Larger bams, and validate_bam, run with the JVM's defaults.
+validation_jvm_flags = ["-Xmx2g", "-XX:+UseSerialGC", "-XX:TieredStopAtLevel=1", "-Xshare:auto"]
+validation_fast_start_max_size = 1024 * 1024 * 1024  # bytes
+validation_workers = 4  # concurrent ValidateSamFile runs, one bam each, when pre-validating
+bam_stats_processes = None  # processes scanning one bam for read statistics; None uses every core
+bam_stats_min_range_size = 64 * 1024 * 1024  # compressed bytes per process, so small bams are scanned in one
+bam_stats_cache_file = "bam_stats_cache.db"  # kept in the same directory as submission_db
+bam_stats_attributes = True  # add read_count, base_count and mean_read_length to the submission xml attributes
+screen_check_read_retention = True  # False skips counting the reads of the input and screened bams
+screen_min_read_fraction = 0.5  # share of the primary reads a screened bam must keep
+copy_chunk_size = 8 * 1024 * 1024  # bytes per read when copying the compressed blocks of a bam
+screen_threads = 4  # blender threads per screening run
+screen_shards = 1  # shards screened concurrently per bam; 1 turns sharding off, 0 sizes the pool to the machine
+screen_min_shard_size = 1024 * 1024 * 1024  # compressed bytes per shard, so small bams are screened in one run
+screen_cache_dir = "/cil/shed/resources/sra_submission_tool/screen_cache/"  # None turns the screening cache off
+screen_cache_max_bytes = 2 * 1024 ** 4  # least recently used screened bams are evicted above this total size
+screen_reference_index_suffixes = [".bitmask", ".srprism"]  # bmtagger indexes of human_reference, in screen cache keys
+# commands whose output identifies the blender and bmtagger build in screening cache keys
+screen_version_commands = [blender_path + " --version", "bmtagger.sh -V"]
+broker_db = "/tmp/sra_submission_tool_broker.db"  # must be on local disk: CPU and memory tokens are per host
+broker_journal_mode = "WAL"  # the broker db is on local disk, so it can use WAL
+broker_cpus = None  # CPU tokens per host; None uses every core
+broker_memory_mb = None  # memory tokens per host; None uses the physical memory
+broker_poll_seconds = 5  # wait between attempts when the host is full
+validation_memory_mb = 2560  # ValidateSamFile's -Xmx2g plus JVM overhead
+validation_default_memory_mb = 8192  # ValidateSamFile with the JVM's default heap sizing
+revert_memory_mb = 2560
+screen_memory_mb = 8192  # one blender run
+bam_stats_memory_mb = 1024  # one statistics scan across its process pool
+checksum_memory_mb = 512  # hashing the files of one submission
+default_trim_file = "trim.seq"  # -T default, taken relative to the launch directory; skipped if it is missing
+trim_processes = None  # processes trimming one read file; None uses every core the resource broker grants
+trim_memory_mb = 2048
+trim_min_overlap = 3  # fewest adapter bases at the end of a read that are trimmed
+trim_quality_cutoff = 0  # Phred cutoff for trimming low quality 3' ends; 0 turns quality trimming off
+trim_min_length = 1  # reads are never trimmed shorter than this, so no read is left empty
+trim_batch_size = 4 * 1024 * 1024  # inflated bam bytes per trimming batch
+trim_batch_reads = 20000  # FASTQ records per trimming batch
@@ -0,0 +1,201 @@
+import logging
+import threading
+import os
+__author__ = 'Amr Abouelleil'
+
+# Versioned schema for the submission DB. Each migration brings the database from the previous version to its own and
+# is applied at most once; the applied version is kept in sqlite's user_version pragma.
+
+submission_columns = [('spuid', 'INTEGER PRIMARY KEY AUTOINCREMENT'), ('spuid_date', 'TEXT'), ('read_file', 'TEXT'),
+                      ('platform_unit', 'TEXT'), ('temp_path', 'TEXT'), ('submission_status', 'TEXT'),
+                      ('g_number', 'TEXT'), ('biosample', 'TEXT'), ('bioproject', 'TEXT'), ('release_date', 'TEXT'),
+                      ('xml_attributes', 'TEXT'), ('ncbi_submission_id', 'TEXT'), ('response_message', 'TEXT'),
+                      ('response_severity', 'TEXT'), ('accession', 'TEXT'), ('validation_seconds', 'TEXT'),
+                      ('screening_progress', 'TEXT')]
+submission_indexes = ['read_file', 'submission_status', 'accession', 'biosample', 'ncbi_submission_id']
+
+_checked = set()
+_checked_lock = threading.Lock()
+
+
+def get_columns(conn, table):
+    return [row[1] for row in conn.execute("PRAGMA table_info(" + table + ")").fetchall()]
+
+
+def create_submissions(conn):
+    """
+    Creates the submissions table, adds any columns an older table is missing and indexes the lookup columns.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS submissions (" +
+                 ", ".join(name + " " + col_type for name, col_type in submission_columns) + ")")
+    existing = get_columns(conn, 'submissions')
+    for name, col_type in submission_columns:
+        if name not in existing:
+            conn.execute("ALTER TABLE submissions ADD COLUMN " + name + " " + col_type)
+    for column in submission_indexes:
+        conn.execute("CREATE INDEX IF NOT EXISTS submissions_" + column + " ON submissions (" + column + ")")
+
+
+def get_duplicate_platform_units(conn):
+    """
+    :return: a list of (platform_unit, count) tuples for the platform units held by more than one submission.
+    """
+    return conn.execute('''SELECT platform_unit, COUNT(*) FROM submissions WHERE platform_unit IS NOT NULL
+                           GROUP BY platform_unit HAVING COUNT(*) > 1''').fetchall()
+
+
+def has_unique_platform_unit(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='submissions_platform_unit'"
+                        ).fetchone() is not None
+
+
+def unique_platform_unit(conn):
+    """
+    Enforces one submission per platform unit. Launches before this migration could create duplicates; a database
+    that holds them is left without the index, and working, until they are resolved with update_submissions --dedupe.
+    ensure_schema reports them and tries again on every start.
+    """
+    if get_duplicate_platform_units(conn):
+        return
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS submissions_platform_unit ON submissions (platform_unit)")
+
+
+def dedupe_platform_units(manager):
+    """
+    Resolves duplicate platform units and creates the unique index. Of each group the processed-ok submission is kept,
+    or the newest if none is; the others keep their rows, reachable by SPUID, but lose their platform unit.
+    :param manager: the ConnectionManager for the database.
+    :return: a list of (platform_unit, kept_spuid, cleared_spuids) tuples.
+    """
+    resolved = []
+    with manager.transaction() as conn:
+        for platform_unit, count in get_duplicate_platform_units(conn):
+            rows = conn.execute('''SELECT spuid, submission_status FROM submissions WHERE platform_unit=?
+                                    ORDER BY spuid DESC''', (platform_unit,)).fetchall()
+            kept = next((spuid for spuid, status in rows if status == 'processed-ok'), rows[0][0])
+            cleared = [spuid for spuid, status in rows if spuid != kept]
+            conn.executemany("UPDATE submissions SET platform_unit=NULL WHERE spuid=?", [(spuid,) for spuid in cleared])
+            resolved.append((platform_unit, kept, cleared))
+        unique_platform_unit(conn)
+    return resolved
+
+
+def create_submission_events(conn):
+    """
+    Creates the append-only log of submission status transitions.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS submission_events (event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    spuid INTEGER NOT NULL, old_status TEXT, new_status TEXT, event_time REAL NOT NULL, host TEXT,
+                    pid INTEGER)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS submission_events_spuid ON submission_events (spuid, event_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS submission_events_time ON submission_events (event_time)")
+
+
+def create_submissions_archive(conn):
+    """
+    Creates the cold table that terminal submissions are moved to once they stop changing.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS submissions_archive (spuid INTEGER PRIMARY KEY, " +
+                 ", ".join(name + " " + col_type for name, col_type in submission_columns[1:]) +
+                 ", archived_date TEXT)")
+    conn.execute("CREATE INDEX IF NOT EXISTS submissions_archive_read_file ON submissions_archive (read_file)")
+    archive_platform_unit_index(conn)
+
+
+def create_jobs(conn):
+    """
+    Creates the work queue that worker hosts lease submissions from.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS jobs (job_id INTEGER PRIMARY KEY AUTOINCREMENT, spuid INTEGER,
+                    payload TEXT, state TEXT NOT NULL, lease_owner TEXT, lease_expiry REAL, attempts INTEGER NOT NULL
+                    DEFAULT 0, last_error TEXT, created REAL NOT NULL, updated REAL NOT NULL)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expiry)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_spuid ON jobs (spuid)")
+
+
+def add_validation_seconds(conn):
+    """
+    Adds the wall time of the last bam validation to live and archived submissions.
+    """
+    for table in ('submissions', 'submissions_archive'):
+        if 'validation_seconds' not in get_columns(conn, table):
+            conn.execute("ALTER TABLE " + table + " ADD COLUMN validation_seconds TEXT")
+
+
+def add_screening_progress(conn):
+    """
+    Adds the shard progress of sharded host screening to live and archived submissions.
+    """
+    for table in ('submissions', 'submissions_archive'):
+        if 'screening_progress' not in get_columns(conn, table):
+            conn.execute("ALTER TABLE " + table + " ADD COLUMN screening_progress TEXT")
+
+
+def archive_platform_unit_index(conn):
+    """
+    Indexes archived submissions by platform unit without enforcing uniqueness. A platform unit can be archived more
+    than once: databases from before unique_platform_unit may hold duplicates, and a unit resubmitted after its
+    submission was archived is archived again.
+    """
+    conn.execute("DROP INDEX IF EXISTS submissions_archive_platform_unit")
+    conn.execute("CREATE INDEX submissions_archive_platform_unit ON submissions_archive (platform_unit)")
+
+
+migrations = [(1, create_submissions),
+              (2, unique_platform_unit),
+              (3, create_submission_events),
+              (4, create_submissions_archive),
+              (5, create_jobs),
+              (6, add_validation_seconds),
+              (7, add_screening_progress),
+              (8, archive_platform_unit_index)]
+schema_version = migrations[-1][0]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(manager):
+    """
+    Applies every migration newer than the database's current version, each in its own transaction.
+    :param manager: the ConnectionManager for the database.
+    :return: the schema version the database is at afterwards.
+    """
+    logger = logging.getLogger('sra_tool.db_schema.migrate')
+    for version, migration in migrations:
+        with manager.transaction() as conn:
+            # re-read inside the write lock so that concurrent starters apply each migration only once
+            if get_schema_version(conn) >= version:
+                continue
+            logger.info("Migrating " + manager.db + " to schema version " + str(version) + ": " + migration.__name__)
+            migration(conn)
+            conn.execute("PRAGMA user_version=" + str(version))
+    return get_schema_version(manager.connection())
+
+
+def ensure_schema(manager):
+    """
+    Startup check that brings a database up to the current schema once per process.
+    :param manager: the ConnectionManager for the database.
+    :return:
+    """
+    key = (os.path.realpath(manager.db), os.getpid())
+    with _checked_lock:
+        if key in _checked:
+            return
+        if get_schema_version(manager.connection()) < schema_version:
+            migrate(manager)
+        conn = manager.connection()
+        if not has_unique_platform_unit(conn):
+            # read outside a transaction, so a database with duplicates costs no write lock on every start
+            duplicates = get_duplicate_platform_units(conn)
+            if duplicates:
+                logging.getLogger('sra_tool.db_schema.ensure_schema').critical(
+                    str(len(duplicates)) + " platform units of " + manager.db + " have more than one submission, e.g. "
+                    + str(duplicates[:5]) + ". Platform units are not enforced unique until update_submissions.py "
+                                            "--dedupe resolves them.")
+            else:
+                with manager.transaction() as conn:
+                    unique_platform_unit(conn)
+        _checked.add(key)
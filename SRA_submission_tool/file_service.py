@@ -2,34 +2,246 @@ import constants as c
 import subprocess
 import hashlib
 import logging
+import threading
+import Queue
+import io
+from multiprocessing.pool import ThreadPool
 import tarfile
+import shutil
+import stat
+import fcntl
 import sys
-from SRA_submission_tool.submission_db import SubmissionDBService
+import os
+import json
+import sqlite3
+import time
+import collections
+from SRA_submission_tool.submission_db import SubmissionDBService, ConnectionManager
+from SRA_submission_tool import bgzf
+from SRA_submission_tool.resource_broker import ResourceBroker
 __author__ = "Amr Abouelleil"
 
 
 class BamValidator(object):
     """
-    A class for creating bam validator objects that run ValidateSamFile.
+    A class for creating bam validator objects that run ValidateSamFile. Verdicts are cached per file and Picard
+    version, so unchanged files are not revalidated.
     """
-    def __init__(self):
+    def __init__(self, cache=True, cache_db=None):
         self.logger = logging.getLogger('sra_tool.bam_service.BamValidator')
         self.dbs = SubmissionDBService(c.submission_db)
+        self.cache = None
+        if cache:
+            try:
+                self.cache = ValidationCache(cache_db)
+            except sqlite3.Error as e:
+                self.logger.warning("Validation cache unavailable, validating every file: " + str(e))
+
+    def picard_version(self):
+        """
+        Identifies the installed ValidateSamFile build by its jar's fingerprint, so that upgrading Picard invalidates
+        every cached verdict.
+        :return: a version string, or None if the jar cannot be found.
+        """
+        try:
+            return ":".join(str(field) for field in file_fingerprint(c.picard_validate_path))
+        except OSError:
+            return None
+
+    def validation_command(self, bam_file, jvm_flags=()):
+        return (["java"] + list(jvm_flags) +
+                ["-jar", c.picard_validate_path, "I=" + bam_file, "IGNORE=INVALID_VERSION_NUMBER"])
+
+    def batch_jvm_flags(self, bam_file):
+        """
+        Picks the JVM flags for pre-validating one bam file. Every file is validated by its own JVM, one INPUT per
+        ValidateSamFile run; these flags only tune that per-file JVM. Small files get a JVM tuned for startup time,
+        which would slow down the long runs on large ones, so those keep the JVM's defaults.
+        :param bam_file: the bam file to validate.
+        :return: a list of JVM flags.
+        """
+        try:
+            if os.path.getsize(bam_file) < c.validation_fast_start_max_size:
+                return c.validation_jvm_flags
+        except OSError:
+            pass
+        return []
+
+    def check_structure(self, bam_file):
+        """
+        A cheap structural check that catches truncated or half-copied bam files in seconds, before Picard runs. It
+        checks the BGZF magic, the header, the EOF marker block and the block chain. Only the header blocks are
+        inflated; the rest of the chain is followed by seeking from block header to block header.
+        :param bam_file: the bam file to check.
+        :return: a (valid, problem) tuple.
+        """
+        try:
+            if not bgzf.has_eof_marker(bam_file):
+                return False, "Missing BGZF EOF marker block; the file is truncated or still being written."
+            with bgzf.BgzfReader(bam_file) as reader:
+                text, references = bgzf.read_bam_header(reader)
+            header = bgzf.parse_header_text(text)
+            if len(header['SQ']) != len(references):
+                return False, "Header text lists " + str(len(header['SQ'])) + " sequences but the binary header " \
+                                                                                "lists " + str(len(references)) + "."
+            block_count = 0
+            for offset, block_size in bgzf.walk_blocks(bam_file):
+                block_count += 1
+            self.logger.debug("Block chain of " + bam_file + " is intact: " + str(block_count) + " blocks.")
+        except (bgzf.BgzfError, IOError, OSError) as e:
+            return False, str(e)
+        return True, None
+
+    def check_platform_unit(self, bam_file, expected_pu):
+        """
+        Checks that a read group of the bam file carries the platform unit it is being submitted as. Files whose
+        read groups carry no platform unit at all pass.
+        :return: a (valid, problem) tuple.
+        """
+        platform_units = [rg['PU'] for rg in BamParser().read_header(bam_file)['RG'] if 'PU' in rg]
+        if platform_units and expected_pu not in platform_units:
+            return False, "Read groups carry platform units " + ", ".join(platform_units) + ", not " + expected_pu
+        return True, None
+
+    def cached_verdict(self, bam_file, version):
+        """
+        :return: the cached (valid, first_error) verdict for a bam file, or None.
+        """
+        if not self.cache or not version:
+            return None
+        try:
+            verdict = self.cache.get(bam_file, version)
+        except (sqlite3.Error, OSError) as e:
+            self.logger.warning("Could not read validation cache: " + str(e))
+            return None
+        # a verdict of None means validation could not be run; it is never reused
+        if verdict is not None and verdict[0] is not None:
+            self.logger.info("Using cached validation result for " + bam_file)
+            return tuple(verdict)
+        return None
+
+    def timed_validation(self, bam_file, version, jvm_flags=()):
+        """
+        Validates a bam file and caches the verdict, unless validation could not be run.
+        :param jvm_flags: JVM flags for ValidateSamFile, the JVM's defaults if empty.
+        :return: a (valid, first_error, seconds) tuple.
+        """
+        fingerprint = file_fingerprint(bam_file)
+        start = time.time()
+        valid, first_error = self.check_structure(bam_file)
+        if valid:
+            valid, first_error = self.run_validation(bam_file, jvm_flags)
+        else:
+            self.logger.error("Structural check failed for " + bam_file + ", skipping ValidateSamFile.")
+        seconds = time.time() - start
+        if self.cache and version and valid is not None:
+            try:
+                self.cache.put(bam_file, [valid, first_error], fingerprint, version)
+            except sqlite3.Error as e:
+                self.logger.warning("Could not write validation cache: " + str(e))
+        return valid, first_error, seconds
+
+    def validate_bams(self, bam_files, workers=None):
+        """
+        Validates bam files ahead of submission. Cached verdicts are reused, and each remaining file is validated by
+        its own ValidateSamFile run, in its own JVM, with at most workers of them running at once. Verdicts are cached,
+        so the later per-submission validate_bam calls do not validate the files again.
+        :param bam_files: a list of bam file paths.
+        :param workers: maximum concurrent validations, c.validation_workers by default.
+        :return: a dictionary of bam file to (valid, first_error). valid is None where validation could not be run.
+        """
+        version = self.picard_version()
+        results = dict()
+        pending = []
+        for bam_file in bam_files:
+            if bam_file in results or bam_file in pending:
+                continue
+            verdict = self.cached_verdict(bam_file, version)
+            if verdict is None:
+                pending.append(bam_file)
+            else:
+                results[bam_file] = verdict
+
+        def validate(bam_file):
+            try:
+                return bam_file, self.timed_validation(bam_file, version, self.batch_jvm_flags(bam_file))[:2]
+            except (OSError, IOError) as e:
+                self.logger.error("Could not validate " + bam_file + ": " + str(e))
+                return bam_file, (None, str(e))
+
+        if pending:
+            self.logger.info("Validating " + str(len(pending)) + " bam files, " + str(len(results)) + " cached.")
+            pool = ThreadPool(min(workers or c.validation_workers, len(pending)))
+            try:
+                results.update(pool.map(validate, pending))
+            finally:
+                pool.close()
+                pool.join()
+        return results
+
+    def run_validation(self, bam_file, jvm_flags=()):
+        """
+        Streams ValidateSamFile's report and stops it at the first error instead of waiting for the full report.
+        :param bam_file: the bam file to validate.
+        :param jvm_flags: JVM flags for ValidateSamFile, the JVM's defaults if empty.
+        :return: a (valid, first_error) tuple. valid is None if ValidateSamFile failed without reporting an error,
+        e.g. when the JVM could not start or was killed, and first_error is then the tail of its stderr.
+        """
+        cmd = self.validation_command(bam_file, jvm_flags)
+        memory_mb = c.validation_memory_mb if jvm_flags else c.validation_default_memory_mb
+        with ResourceBroker().acquire(cpus=1, memory_mb=memory_mb, label="ValidateSamFile " + bam_file):
+            self.logger.info("validate bam : " + " ".join(cmd))
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            # drained on a thread so that a chatty JVM cannot block on a full stderr pipe
+            stderr_tail = collections.deque(maxlen=10)
+            stderr_reader = threading.Thread(target=stderr_tail.extend, args=(iter(proc.stderr.readline, ''),))
+            stderr_reader.daemon = True
+            stderr_reader.start()
+            first_error = None
+            try:
+                for line in iter(proc.stdout.readline, ''):
+                    if 'ERROR' in line:
+                        first_error = line.strip()
+                        break
+            finally:
+                if first_error and proc.poll() is None:
+                    proc.kill()
+                proc.stdout.close()
+                proc.wait()
+                stderr_reader.join()
+                proc.stderr.close()
+        if first_error is None and proc.returncode != 0:
+            problem = "ValidateSamFile exited with status " + str(proc.returncode) + ": " + \
+                      " | ".join(line.strip() for line in stderr_tail)
+            self.logger.error(problem)
+            return None, problem
+        return first_error is None, first_error
 
     def validate_bam(self, bam_file, spuid):
         """
         A method that runs ValidateSamFile to check bam files for errors.
         :param bam_file:
-        :return: A dict with stdout and stderr of ValidateSamFile which can be analyzed to determine errors if any.
+        :return: True if no errors were found, False if they were, None if validation could not be run.
         """
         self.dbs.update_sub_data(spuid, column_id="submission_status", column_value="validating")
-        cmd = "java -jar " + c.picard_validate_path + " I=" + bam_file + " IGNORE=INVALID_VERSION_NUMBER"
-        self.logger.info("validate bam : " + cmd)
         try:
-            proc = subprocess.Popen([cmd], stdout=subprocess.PIPE, shell=True)
-            (out, err) = proc.communicate()
-            if 'ERROR' in out.split('\n')[0]:
-                self.logger.error("bam validation errors found: " + str(out))
+            version = self.picard_version()
+            verdict = self.cached_verdict(bam_file, version)
+            if verdict is not None:
+                valid, first_error = verdict
+            else:
+                valid, first_error, seconds = self.timed_validation(bam_file, version)
+                self.dbs.update_sub_data(spuid, "validation_seconds", "%.1f" % seconds)
+            if valid is None:
+                self.dbs.update_sub_data(spuid, column_id="submission_status", column_value="validation error")
+                return None
+            if valid:
+                # the platform unit is checked on every run; it depends on the submission, not only on the file
+                submission = next(self.dbs.iter_submissions(spuid_range=(spuid, spuid)), None)
+                if submission and submission.platform_unit and submission.platform_unit != bam_file:
+                    valid, first_error = self.check_platform_unit(bam_file, submission.platform_unit)
+            if not valid:
+                self.logger.error("bam validation errors found: " + str(first_error))
                 self.dbs.update_sub_data(spuid, column_id="submission_status",
                                          column_value="not validated")
                 return False
@@ -43,10 +255,13 @@ class BamValidator(object):
 
 class ChecksumCreator(object):
     """
-    A class for checksum creator objects using the md5 algorithm.
+    A class for checksum creator objects using the md5 algorithm. Files are streamed through the digests in fixed-size
+    chunks, so memory use does not depend on file size.
     """
-    def __init__(self, target_file):
+    def __init__(self, target_file, chunk_size=None):
+        self.logger = logging.getLogger('sra_tool.file_service.ChecksumCreator')
         self.target_file = target_file
+        self.chunk_size = chunk_size or c.checksum_chunk_size
 
     def create_checksum(self):
         """
@@ -54,10 +269,64 @@ class ChecksumCreator(object):
         :param
         :return: checksum string for file
         """
-        file_handle = open(self.target_file, 'rb')
-        checksum = hashlib.md5(file_handle.read()).hexdigest()
-        file_handle.close()
-        return checksum
+        return self.compute_digests()['md5']
+
+    def compute_digests(self):
+        """
+        Computes the MD5 and SHA-256 digests and byte count of the file in a single pass. One thread reads into a
+        small ring of reused buffers while another hashes them, so disk reads and hashing overlap.
+        :return: a dictionary with 'md5', 'sha256', 'size', 'seconds' and 'throughput' (MB/s) entries.
+        """
+        buffers = [bytearray(self.chunk_size) for i in range(c.checksum_buffers)]
+        free = Queue.Queue()
+        filled = Queue.Queue()
+        for index in range(len(buffers)):
+            free.put(index)
+        digests = {'md5': hashlib.md5(), 'sha256': hashlib.sha256(), 'size': 0}
+        errors = []
+
+        def hash_chunks():
+            # hashlib releases the GIL on large updates, so this runs alongside the reads
+            try:
+                while True:
+                    chunk = filled.get()
+                    if chunk is None:
+                        return
+                    index, length = chunk
+                    data = buffer(buffers[index], 0, length)
+                    digests['md5'].update(data)
+                    digests['sha256'].update(data)
+                    digests['size'] += length
+                    free.put(index)
+            except Exception as e:
+                errors.append(e)
+                free.put(None)
+
+        start = time.time()
+        hasher = threading.Thread(target=hash_chunks, name="ChecksumCreator")
+        hasher.start()
+        try:
+            with io.open(self.target_file, 'rb', buffering=0) as file_handle:
+                while True:
+                    index = free.get()
+                    if index is None:
+                        break
+                    length = file_handle.readinto(buffers[index])
+                    if not length:
+                        break
+                    filled.put((index, length))
+        finally:
+            filled.put(None)
+            hasher.join()
+        if errors:
+            raise errors[0]
+        seconds = time.time() - start
+        result = {'md5': digests['md5'].hexdigest(), 'sha256': digests['sha256'].hexdigest(),
+                  'size': digests['size'], 'seconds': seconds,
+                  'throughput': digests['size'] / 1048576.0 / seconds if seconds else 0.0}
+        self.logger.info("Checksummed " + self.target_file + ": " + str(result['size']) + " bytes in "
+                         + "%.1f" % seconds + " seconds (" + "%.1f" % result['throughput'] + " MB/s).")
+        return result
 
     def write_checksum(self, checksum):
         """
@@ -72,13 +341,153 @@ class ChecksumCreator(object):
         return out_file_name
 
 
+_created_caches = set()
+_created_caches_lock = threading.Lock()
+
+
+def _byte_strings(value):
+    """
+    json hands back unicode, while the rest of the tool works with the str it read from the file in the first place.
+    :param value: a value loaded from json.
+    :return: the value with every unicode string, including dict keys, encoded to a utf-8 str.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_byte_strings(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_byte_strings(key), _byte_strings(item)) for key, item in value.items())
+    return value
+
+
+def file_fingerprint(path):
+    """
+    Identifies a file by where it is and what it looks like on disk, without reading it.
+    :param path: path to the file.
+    :return: a (realpath, size, mtime, inode) tuple. Any change to the file changes at least one of them.
+    """
+    real_path = os.path.realpath(path)
+    stat = os.stat(real_path)
+    return real_path, stat.st_size, stat.st_mtime, stat.st_ino
+
+
+class FingerprintCache(object):
+    """
+    A persistent cache of json-serializable results computed from a file, kept in a sqlite file next to the submission
+    DB and keyed by the file's fingerprint and an optional tool version. Entries for files that changed since they were
+    cached are dropped on lookup, and entries older than c.fingerprint_cache_max_age_days or beyond the newest
+    c.fingerprint_cache_max_entries are pruned the first time a process opens the cache.
+    """
+    def __init__(self, cache_db):
+        """
+        :param cache_db: path to the cache file, or a bare file name to keep it in the submission DB's directory.
+        """
+        self.logger = logging.getLogger('sra_tool.file_service.' + self.__class__.__name__)
+        if os.sep not in cache_db:
+            cache_db = os.path.join(os.path.dirname(c.submission_db), cache_db)
+        self.manager = ConnectionManager.for_db(cache_db)
+        key = (os.path.realpath(cache_db), os.getpid())
+        with _created_caches_lock:
+            if key not in _created_caches:
+                with self.manager.transaction() as conn:
+                    conn.execute('''CREATE TABLE IF NOT EXISTS results (path TEXT, version TEXT, size INTEGER,
+                                    mtime REAL, inode INTEGER, result TEXT, cached REAL,
+                                    PRIMARY KEY (path, version))''')
+                    conn.execute('''CREATE INDEX IF NOT EXISTS results_cached ON results (cached)''')
+                    self.prune(conn)
+                _created_caches.add(key)
+
+    def prune(self, conn):
+        """
+        Drops entries cached more than c.fingerprint_cache_max_age_days ago, then all but the newest
+        c.fingerprint_cache_max_entries, so that results for files long gone do not pile up.
+        :param conn: a connection inside a transaction.
+        :return: the number of entries dropped.
+        """
+        pruned = 0
+        if c.fingerprint_cache_max_age_days is not None:
+            cutoff = time.time() - c.fingerprint_cache_max_age_days * 24 * 60 * 60
+            pruned += conn.execute('''DELETE FROM results WHERE cached < ?''', (cutoff,)).rowcount
+        if c.fingerprint_cache_max_entries is not None:
+            pruned += conn.execute('''DELETE FROM results WHERE rowid NOT IN
+                                      (SELECT rowid FROM results ORDER BY cached DESC LIMIT ?)''',
+                                   (c.fingerprint_cache_max_entries,)).rowcount
+        if pruned:
+            self.logger.info("Pruned " + str(pruned) + " cached results from " + self.manager.db)
+        return pruned
+
+    def get(self, target_file, version=""):
+        """
+        :param target_file: path to the file.
+        :param version: the version of the tool that produced the result.
+        :return: the cached result, or None if it is not cached or the file changed.
+        """
+        fingerprint = file_fingerprint(target_file)
+        row = self.manager.connection().execute('''SELECT size, mtime, inode, result FROM results
+                                                   WHERE path=? AND version=?''',
+                                                (fingerprint[0], version)).fetchone()
+        if row is None:
+            return None
+        if tuple(row[:3]) != fingerprint[1:]:
+            self.logger.debug("Dropping stale cached result for " + fingerprint[0])
+            with self.manager.transaction() as conn:
+                conn.execute('''DELETE FROM results WHERE path=?''', fingerprint[:1])
+            return None
+        return _byte_strings(json.loads(row[3]))
+
+    def put(self, target_file, result, fingerprint=None, version=""):
+        """
+        Caches a result.
+        :param target_file: path to the file.
+        :param result: a json-serializable result.
+        :param fingerprint: the file's fingerprint taken before the result was computed, to avoid caching a result
+        under the fingerprint of a file that changed while it was being read.
+        :param version: the version of the tool that produced the result.
+        """
+        if fingerprint is None:
+            fingerprint = file_fingerprint(target_file)
+        with self.manager.transaction() as conn:
+            conn.execute('''INSERT OR REPLACE INTO results (path, version, size, mtime, inode, result, cached)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                         (fingerprint[0], version) + fingerprint[1:] + (json.dumps(result), time.time()))
+
+
+class HeaderCache(FingerprintCache):
+    """
+    A persistent cache of parsed bam headers keyed by file fingerprint.
+    """
+    def __init__(self, cache_db=None):
+        super(HeaderCache, self).__init__(cache_db or c.header_cache_file)
+
+    def get(self, bam_file, version=""):
+        header = super(HeaderCache, self).get(bam_file, version)
+        if header is not None:
+            header['references'] = [tuple(reference) for reference in header['references']]
+        return header
+
+
+class ValidationCache(FingerprintCache):
+    """
+    A persistent cache of ValidateSamFile verdicts keyed by file fingerprint and Picard version.
+    """
+    def __init__(self, cache_db=None):
+        super(ValidationCache, self).__init__(cache_db or c.validation_cache_file)
+
+
 class BamParser(object):
     """
-    A class for parsing bam files using samtools. Currently just parses bam header into a dictionary.
+    A class for parsing bam files. Currently just parses the bam header, reading it natively from the BGZF blocks that
+    cover it. Parsed headers are cached next to the submission DB so each file is only read once.
     """
 
-    def __init__(self):
+    def __init__(self, cache=True, cache_db=None):
         self.logger = logging.getLogger('sra_tool.file_service.BamParser')
+        self.cache = None
+        if cache:
+            try:
+                self.cache = HeaderCache(cache_db)
+            except sqlite3.Error as e:
+                self.logger.warning("Bam header cache unavailable, parsing headers from files: " + str(e))
 
     def list_to_dict(self, delim, in_list):
         """
@@ -94,21 +503,47 @@ class BamParser(object):
         self.logger.debug("List converted to dict:" + str(new_dict))
         return new_dict
 
+    def read_header(self, bam_file):
+        """
+        Reads the full bam header without touching any alignment records.
+        :param bam_file: The bam file to parse
+        :return: A dictionary with the 'HD' tags, lists of 'SQ', 'RG' and 'PG' tag dictionaries, the 'CO' comments and
+        the binary 'references' list of (name, length) tuples.
+        """
+        if self.cache:
+            try:
+                header = self.cache.get(bam_file)
+                if header is not None:
+                    self.logger.debug(msg="Header for " + bam_file + " found in cache.")
+                    return header
+            except sqlite3.Error as e:
+                self.logger.warning("Could not read bam header cache: " + str(e))
+        fingerprint = file_fingerprint(bam_file)
+        with bgzf.BgzfReader(bam_file) as reader:
+            text, references = bgzf.read_bam_header(reader)
+        header = bgzf.parse_header_text(text)
+        header['references'] = references
+        if self.cache:
+            try:
+                self.cache.put(bam_file, header, fingerprint)
+            except sqlite3.Error as e:
+                self.logger.warning("Could not write bam header cache: " + str(e))
+        self.logger.debug(msg="Header read from " + bam_file + ": " + str(len(header['SQ'])) + " sequences, "
+                              + str(len(header['RG'])) + " read groups.")
+        return header
+
     def parse_header(self, bam_file):
         """
-        A wrapper method that calls samtools to parse the header information.
+        Parses the bam header into a flat dictionary of the tags of the first read group and first sequence.
         :param bam_file: The bam file to parse
         :return: A dictionary of bam header information.
         """
-        cmd = c.samtools_path + " view -H " + bam_file
-        self.logger.debug(msg="Header Parse cmd:" + cmd)
-        proc = subprocess.Popen([cmd], stdout=subprocess.PIPE, shell=True)
-        stdout, stderr = proc.communicate()
-        read_group_string = stdout[stdout.find("@RG")+1:stdout.find("@PG")]
-        seq_string = stdout[stdout.find("@SQ")+1:stdout.find("@RG")]
-        header_dict = self.list_to_dict(":", read_group_string.split())
-        seq_dict = self.list_to_dict(":", seq_string.split())
-        header_dict.update(seq_dict)
+        header = self.read_header(bam_file)
+        header_dict = dict()
+        if header['RG']:
+            header_dict.update(header['RG'][0])
+        if header['SQ']:
+            header_dict.update(header['SQ'][0])
         self.logger.debug(msg="Header dict:" + str(header_dict))
         return header_dict
 
@@ -158,21 +593,265 @@ def archive_maker(archive_dest, file_list):
 
 
 def rehead_bam(in_bam, bam_file, temp_dir, header):
+    """
+    Gives a bam the header of another bam. Only the headers are read: the new header is written as fresh BGZF blocks
+    and the alignment blocks of bam_file are copied byte for byte. If bam_file's first alignment record shares a block
+    with its header, only that block is recompressed.
+    :param in_bam: the bam whose header is used.
+    :param bam_file: the bam whose alignment records are kept.
+    :param temp_dir: the directory to write the reheaded bam to.
+    :param header: the name stem of the reheaded bam.
+    :return: the path to the reheaded bam.
+    """
     logger = logging.getLogger('sra_tool.file_service.rehead_bam')
-    sam_file = temp_dir + "/temp.sam"
-    sam_cmd = c.samtools_path + " view -h -o " + sam_file + " " + in_bam
-    logger.info("Running " + sam_cmd)
-    subprocess.check_call(sam_cmd, stdout=subprocess.PIPE, shell=True)
     reheaded_bam_path = temp_dir + "/" + header + ".reheaded.screened.bam"
-    rehead_cmd = c.samtools_path + " reheader " + sam_file + " " + bam_file + " > " + reheaded_bam_path
-    logger.info("Running " + rehead_cmd)
-    subprocess.check_call(rehead_cmd, stdout=subprocess.PIPE, shell=True)
+    with open(bam_file, 'rb') as source, open(reheaded_bam_path, 'wb') as target:
+        rehead_stream(in_bam, source, target)
+    logger.info("Reheaded " + bam_file + " with the header of " + in_bam + " into " + reheaded_bam_path)
     return reheaded_bam_path
 
 
+def rehead_stream(in_bam, source, target):
+    """
+    Copies a bam from one stream to another, giving it the header of another bam. The source is read strictly in
+    order, so it can be a pipe.
+    :param in_bam: the bam whose header is used.
+    :param source: a binary stream of the bam whose alignment records are kept.
+    :param target: a binary stream to write the reheaded bam to.
+    """
+    logger = logging.getLogger('sra_tool.file_service.rehead_stream')
+    with bgzf.BgzfReader(in_bam) as reader:
+        text, references = bgzf.read_bam_header(reader)
+    reader = bgzf.BgzfReader(getattr(source, 'name', "stream"), source)
+    if bgzf.read_bam_header(reader)[1] != references:
+        logger.warning("Reference sequences of " + reader.path + " differ from those of " + in_bam)
+    # the first records may share a block with the old header; carry them over into the new header's blocks
+    bgzf.write_blocks(target, bgzf.encode_bam_header(text, references) + reader.read_block_remainder())
+    shutil.copyfileobj(source, target, c.copy_chunk_size)
+
+
+def write_bam_slice(bam_file, start, end, target):
+    """
+    Writes the alignment records of a bam between two virtual offsets as a bam of their own, with the same header.
+    Only the blocks the slice starts and ends in are recompressed; the blocks between them are copied byte for byte.
+    :param bam_file: path to the bam.
+    :param start: virtual offset of the first record of the slice.
+    :param end: virtual offset of the first record after the slice, or None to slice to the end of the bam.
+    :param target: a binary stream to write the slice to.
+    """
+    with bgzf.BgzfReader(bam_file) as reader:
+        header = bgzf.encode_bam_header(*bgzf.read_bam_header(reader))
+        reader.seek(start)
+        if end is not None and end >> 16 == start >> 16:
+            bgzf.write_blocks(target, header + reader.read((end & 0xffff) - (start & 0xffff)))
+            target.write(bgzf.eof_block)
+            return
+        bgzf.write_blocks(target, header + reader.read_block_remainder())
+        reader.handle.seek(reader.tell() >> 16)
+        if end is None:
+            shutil.copyfileobj(reader.handle, target, c.copy_chunk_size)
+            return
+        _copy_bytes(reader.handle, target, (end >> 16) - (reader.tell() >> 16))
+        reader.seek(end >> 16 << 16)
+        bgzf.write_blocks(target, reader.read(end & 0xffff))
+        target.write(bgzf.eof_block)
+
+
+class SliceFeeder(object):
+    """
+    Writes a slice of a bam into a named pipe from a thread, so that a command can read the slice as its input bam
+    without the slice ever being written to disk. The command must read its input once, from start to end.
+    """
+    def __init__(self, bam_file, start, end, fifo_path):
+        """
+        :param bam_file: path to the bam.
+        :param start: virtual offset of the first record of the slice.
+        :param end: virtual offset of the first record after the slice, or None to slice to the end of the bam.
+        :param fifo_path: the named pipe to write the slice to.
+        """
+        self.logger = logging.getLogger('sra_tool.file_service.SliceFeeder')
+        self.slice = (bam_file, start, end)
+        self.fifo_path = fifo_path
+        self.error = None
+        self.thread = threading.Thread(target=self._feed)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def _feed(self):
+        try:
+            # blocks until the command opens the pipe for reading
+            with open(self.fifo_path, 'wb') as target:
+                write_bam_slice(self.slice[0], self.slice[1], self.slice[2], target)
+        except (IOError, OSError, bgzf.BgzfError) as e:
+            self.error = e
+
+    def join(self):
+        """
+        Waits for the writer to finish, keeping any error for wait. Call it once the reading command has exited. A
+        command that never opened the pipe would leave the writer waiting for a reader forever, so the pipe is briefly
+        opened for reading until the writer gives up with a broken pipe.
+        """
+        while self.thread.is_alive():
+            os.close(os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+            self.thread.join(0.1)
+
+    def wait(self):
+        """
+        Waits for the writer to finish. Raises its error if the slice could not be written in full, e.g. because the
+        command stopped reading early.
+        """
+        self.join()
+        if self.error is not None:
+            self.logger.error("Could not feed " + self.fifo_path + " from " + self.slice[0] + ": " + str(self.error))
+            raise self.error
+
+
+def concatenate_bams(header_bam, bam_files, target):
+    """
+    Joins the alignment records of several bams, in order, under the header of another bam. Only the block each bam's
+    records start in is recompressed.
+    :param header_bam: the bam whose header is used.
+    :param bam_files: the bams whose records are joined, in any iterable. Each bam is read completely before the next
+    one is taken from it.
+    :param target: a binary stream to write the joined bam to.
+    """
+    with bgzf.BgzfReader(header_bam) as reader:
+        bgzf.write_blocks(target, bgzf.encode_bam_header(*bgzf.read_bam_header(reader)))
+    for bam_file in bam_files:
+        with bgzf.BgzfReader(bam_file) as reader:
+            bgzf.read_bam_header(reader)
+            bgzf.write_blocks(target, reader.read_block_remainder())
+            start = reader.tell() >> 16
+            # leave out each bam's end of file marker; a single one goes at the very end
+            end = os.path.getsize(bam_file) - (len(bgzf.eof_block) if bgzf.has_eof_marker(bam_file) else 0)
+            reader.handle.seek(start)
+            _copy_bytes(reader.handle, target, end - start)
+    target.write(bgzf.eof_block)
+
+
+def _copy_bytes(source, target, length):
+    while length > 0:
+        chunk = source.read(min(length, c.copy_chunk_size))
+        if not chunk:
+            raise bgzf.BgzfError("Unexpected end of file while copying blocks.")
+        target.write(chunk)
+        length -= len(chunk)
+
+
+class StageRunner(object):
+    """
+    A class for running a chain of streaming stages, each reading the output of the one before, so that intermediate
+    results never touch the disk. A stage is either a shell command reading stdin and writing stdout, or a function
+    called with (source, target) binary streams, which runs in a thread. The source can be a named pipe that another
+    process writes to once the chain is started.
+    """
+    def __init__(self, stages):
+        self.logger = logging.getLogger('sra_tool.file_service.StageRunner')
+        self.stages = stages
+        self.processes = []
+        self.threads = []
+        self.errors = []
+        self.target = None
+        self.fifo_writer = None
+
+    def start(self, source_path, target_path):
+        """
+        Starts the chain in the background. Commands are started from the calling thread.
+        :param source_path: the file or named pipe the first stage reads.
+        :param target_path: the file the last stage writes.
+        """
+        if stat.S_ISFIFO(os.stat(source_path).st_mode):
+            # open the pipe without waiting for its writer, and hold a write end of our own so that the chain only
+            # reads end of file once release is called and the real writer is done
+            read_fd = os.open(source_path, os.O_RDONLY | os.O_NONBLOCK)
+            self.fifo_writer = os.open(source_path, os.O_WRONLY)
+            fcntl.fcntl(self.fifo_writer, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            fcntl.fcntl(read_fd, fcntl.F_SETFL, fcntl.fcntl(read_fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            upstream = os.fdopen(read_fd, 'rb')
+        else:
+            upstream = open(source_path, 'rb')
+        self.target = open(target_path, 'wb')
+        for i, stage in enumerate(self.stages):
+            last = i == len(self.stages) - 1
+            if isinstance(stage, basestring):
+                self.logger.info("Running stage: " + stage)
+                process = subprocess.Popen(stage, shell=True, stdin=upstream,
+                                           stdout=self.target if last else subprocess.PIPE, close_fds=True)
+                upstream.close()
+                self.processes.append((stage, process))
+                upstream = process.stdout
+            else:
+                if last:
+                    downstream = self.target
+                else:
+                    read_fd, write_fd = os.pipe()
+                    downstream = os.fdopen(write_fd, 'wb')
+                thread = threading.Thread(target=self._run_function, args=(stage, upstream, downstream, not last))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+                if not last:
+                    upstream = os.fdopen(read_fd, 'rb')
+
+    def _run_function(self, function, source, target, close_target):
+        try:
+            function(source, target)
+        except Exception as e:
+            self.logger.error("Stage " + str(function) + " failed: " + str(e))
+            self.errors.append(e)
+        finally:
+            source.close()
+            if close_target:
+                target.close()
+
+    def release(self):
+        """
+        Lets the chain read end of file from its named pipe source once the pipe's writer is done.
+        """
+        if self.fifo_writer is not None:
+            os.close(self.fifo_writer)
+            self.fifo_writer = None
+
+    def join(self):
+        """
+        Releases the source and waits for every stage to finish, keeping any error for wait.
+        """
+        self.release()
+        for thread in self.threads:
+            thread.join()
+        for stage, process in self.processes:
+            if process.wait() != 0:
+                self.errors.append(subprocess.CalledProcessError(process.returncode, stage))
+        self.processes = []
+        self.threads = []
+        self.target.close()
+
+    def wait(self):
+        """
+        Waits for the chain to finish. Raises the first stage error, or CalledProcessError for a failed command.
+        """
+        self.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def run(self, source_path, target_path):
+        self.start(source_path, target_path)
+        self.wait()
+
+
+def revert_command(bam_file, out_bam):
+    """
+    :return: the RevertSam command for a bam. Use /dev/stdin and /dev/stdout to run it as a streaming stage.
+    """
+    return "java -jar " + c.picard_revert_sam + " I=" + bam_file + " O=" + out_bam
+
+
 def unalign_bam(bam_file, out_bam):
     logger = logging.getLogger('sra_tool.file_service.unalign_bam')
-    cmd = "java -jar " + c.picard_revert_sam + " I=" + bam_file + " O=" + out_bam
-    subprocess.check_call([cmd], stdout=subprocess.PIPE, shell=True)
+    cmd = revert_command(bam_file, out_bam)
+    with ResourceBroker().acquire(cpus=1, memory_mb=c.revert_memory_mb, label="RevertSam " + bam_file):
+        subprocess.check_call([cmd], stdout=subprocess.PIPE, shell=True)
     logger.info("Running " + cmd)
     return out_bam
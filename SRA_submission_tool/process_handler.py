@@ -5,6 +5,8 @@ from SRA_submission_tool.file_service import BamValidator, PacBioService
 from SRA_submission_tool.submission_db import SubmissionDBService
 from SRA_submission_tool.transfer_service import AsperaTransfer
 from SRA_submission_tool.screening_service import ScreeningService
+from SRA_submission_tool.trim_service import TrimService, TrimError
+from SRA_submission_tool.bgzf import BgzfError
 import SRA_submission_tool.constants as c
 import shutil
 from sub_monitor_service import SubmissionMonitor
@@ -43,6 +45,11 @@ class ProcessHandler(object):
                     s_file = sc.screen_human(read_file=args['read_file'],
                                              file_type=self.determine_file_type(args['read_file']), output_dir=temp_dir,
                                              spuid=c.spuid_prefix + args['spuid'], library_layout='paired')
+                    if not sc.check_read_retention(args['read_file'], s_file):
+                        self.dbs.update_sub_fields(args['spuid'],
+                                                   {'submission_status': "screening failed",
+                                                    'response_message': "Screening removed too many reads"})
+                        return
                     args['read_file'] = s_file
                     self.logger.info("Screened file: " + s_file)
                     temp_read_file = temp_dir + "/" + args['read_file'].split('/')[-1]
@@ -50,6 +57,9 @@ class ProcessHandler(object):
                 else:
                     temp_read_file = temp_dir + "/" + args['read_file'].split('/')[-1]
                     os.symlink(args['read_file'], temp_read_file)
+                if not self.trim_reads(args, temp_dir):
+                    return
+                temp_read_file = temp_dir + "/" + args['read_file'].split('/')[-1]
                 bv = BamValidator()
                 bv.validate_bam(args['read_file'], args['spuid'])
                 self.logger.debug(msg="Temporary data file created: " + temp_read_file)
@@ -64,17 +74,15 @@ class ProcessHandler(object):
                 ready_file = temp_dir + "/submit.ready"
                 open(ready_file, "w").close()
                 self.logger.debug(msg="Ready file created: " + ready_file)
-                for k, v in {'g_number': args['g_project'],
-                             'biosample': att['ncbi_biosample_id'],
-                             'bioproject': att['ncbi_bioproject_id'],
-                             'release_date': args['release_date'],
-                             'xml_attributes': str(att).replace('\"', '').replace("\'", "").replace('\n', '')}.items():
-                    self.dbs.update_sub_data(args['spuid'], column_id=k, column_value=v)
+                self.dbs.update_sub_fields(args['spuid'], {'g_number': args['g_project'],
+                                                           'biosample': att['ncbi_biosample_id'],
+                                                           'bioproject': att['ncbi_bioproject_id'],
+                                                           'release_date': args['release_date'],
+                                                           'xml_attributes': str(att).replace('\"', '')
+                                                           .replace("\'", "").replace('\n', '')})
                 if args['dry_run']:
-                    self.dbs.update_sub_data(args['spuid'].replace("BI_", ""), column_id="submission_status",
-                                             column_value="failed")
-                    self.dbs.update_sub_data(args['spuid'].replace("BI_", ""), column_id="response_message",
-                                             column_value="DR Complete")
+                    self.dbs.update_sub_fields(args['spuid'].replace("BI_", ""), {'submission_status': "failed",
+                                                                                 'response_message': "DR Complete"})
                     sys.exit(0)
                 at = AsperaTransfer(spuid=args['spuid'].replace("BI_", ""))
                 self.dbs.update_sub_data(args['spuid'].replace("BI_", ""), column_id="submission_status", column_value="uploading")
@@ -94,10 +102,8 @@ class ProcessHandler(object):
                 self.logger.error(self.determine_file_type(args['read_file']) +
                                   " IS NOT A PRODUCTION FILE. USE MANUAL SUBMISSION MODE INSTEAD!")
         except cx_Oracle.InterfaceError as e:
-            self.dbs.update_sub_data(args['spuid'].replace("BI_", ""), column_id="submission_status",
-                                     column_value="InterfaceError")
-            self.dbs.update_sub_data(args['spuid'].replace("BI_", ""), column_id="response_message",
-                                     column_value=str(e))
+            self.dbs.update_sub_fields(args['spuid'].replace("BI_", ""), {'submission_status': "InterfaceError",
+                                                                         'response_message': str(e)})
             raise e
 
     def process_manual(self, args):
@@ -127,6 +133,11 @@ class ProcessHandler(object):
                     s_file = sc.screen_human(read_file=args['read_file'],
                                              file_type=self.determine_file_type(args['read_file']), output_dir=temp_dir,
                                              spuid=c.spuid_prefix + args['spuid'], library_layout='paired')
+                    if not sc.check_read_retention(args['read_file'], s_file):
+                        self.dbs.update_sub_fields(args['spuid'],
+                                                   {'submission_status': "screening failed",
+                                                    'response_message': "Screening removed too many reads"})
+                        return
                     args['read_file'] = s_file
                     self.logger.info("Screened file: " + s_file)
                     temp_file = temp_dir + "/" + args['read_file'].split('/')[-1]
@@ -136,12 +147,15 @@ class ProcessHandler(object):
                     print(temp_file)
 		    if not os.path.exists(temp_file):
 		        os.symlink(args['read_file'], temp_file)
+                if not self.trim_reads(args, temp_dir):
+                    return
+                temp_file = temp_dir + "/" + args['read_file'].split('/')[-1]
             self.logger.debug(msg="Temporary data file created: " + temp_file)
             mx = XmlCreator()
             mx.create_xml_from_dict(args, temp_dir, args['file_type'])
             if args['dry_run']:
-                self.dbs.update_sub_data(args['spuid'].replace("BI_", ""), column_id="submission_status", column_value="failed")
-                self.dbs.update_sub_data(args['spuid'].replace("BI_", ""), column_id="response_message", column_value="DR Complete")
+                self.dbs.update_sub_fields(args['spuid'].replace("BI_", ""), {'submission_status': "failed",
+                                                                             'response_message': "DR Complete"})
                 sys.exit(0)
             at = AsperaTransfer(spuid=args['spuid'].replace("BI_", ""))
             self.dbs.update_sub_data(args['spuid'].replace("BI_", ""), column_id="submission_status", column_value="uploading")
@@ -155,12 +169,12 @@ class ProcessHandler(object):
             open(ready_file, "w").close()
             self.logger.debug(msg="Ready file created: " + ready_file)
             at.aspera_submit(c.asp_acct, ready_file, c.sra_root_dir + "/" + temp_dir.split('/')[-1])
-            for k, v in {'g_number': "None", 'read_file': args['read_file'], 'temp_path': temp_dir,
-                         'release_date': args['release_date'], 'biosample': args['ncbi_biosample_id'],
-                         'bioproject': args['ncbi_bioproject_id'],
-                         'xml_attributes': str(args['additional_attributes']).replace('\"', '').replace("\'", "")
-                         .replace('\n', '')}.items():
-                self.dbs.update_sub_data(args['spuid'].split('_')[-1], column_id=k, column_value=v)
+            self.dbs.update_sub_fields(args['spuid'].split('_')[-1],
+                                       {'g_number': "None", 'read_file': args['read_file'], 'temp_path': temp_dir,
+                                        'release_date': args['release_date'], 'biosample': args['ncbi_biosample_id'],
+                                        'bioproject': args['ncbi_bioproject_id'],
+                                        'xml_attributes': str(args['additional_attributes']).replace('\"', '')
+                                        .replace("\'", "").replace('\n', '')})
             monitor = SubmissionMonitor()
             # Sleep here to wait for NCBI to generate report.xml file before launching sub monitor
             time.sleep(120)
@@ -169,11 +183,50 @@ class ProcessHandler(object):
                                        local_sub_dir=temp_dir, spuid_suffix=args['spuid'].split('_')[-1], retry=True)
             shutil.rmtree(temp_dir)
         except TypeError as e:
-            self.dbs.update_sub_data(args['spuid'].replace("BI_", ""), column_id="submission_status", column_value="TypeError")
-            self.dbs.update_sub_data(args['spuid'].replace("BI_", ""), column_id="response_message", column_value=str(e))
+            self.dbs.update_sub_fields(args['spuid'].replace("BI_", ""), {'submission_status': "TypeError",
+                                                                         'response_message': str(e)})
             traceback.print_exc()
             traceback.print_stack()
 
+    def trim_reads(self, args, temp_dir):
+        """
+        Trims adapters from the read file into temp_dir when the submission's trim file exists. The trimmed file
+        replaces args['read_file'] and its trimmed_reads and trimmed_bases are added to args['additional_attributes'].
+        A missing trim file only fails the submission if the user named it, which run_submission records in
+        args['trim_required']; the default trim file is optional.
+        :param args: a dictionary containing metadata required for SRA submission.
+        :param temp_dir: the submission's temporary directory.
+        :return: False if trimming failed, True otherwise.
+        """
+        trim_file = args.get('trim')
+        if trim_file and not os.path.isfile(trim_file) and args.get('trim_required'):
+            self.logger.error("Trim file " + trim_file + " does not exist.")
+            self.dbs.update_sub_fields(args['spuid'], {'submission_status': "trimming failed",
+                                                       'response_message': "Trim file " + trim_file +
+                                                                           " does not exist"})
+            return False
+        if not trim_file or not os.path.isfile(trim_file):
+            self.logger.info("No trim file found at " + str(trim_file) + ", reads will not be trimmed.")
+            return True
+        self.dbs.update_sub_data(args['spuid'], column_id="submission_status", column_value="trimming")
+        try:
+            t_file, stats = TrimService(trim_file).trim(args['read_file'], temp_dir)
+        except (TrimError, BgzfError, IOError, OSError) as e:
+            self.logger.error("Trimming " + args['read_file'] + " failed: " + str(e))
+            self.dbs.update_sub_fields(args['spuid'], {'submission_status': "trimming failed",
+                                                       'response_message': str(e)})
+            return False
+        args['read_file'] = t_file
+        trim_attributes = "trimmed_reads:" + str(stats['trimmed_reads']) + "|trimmed_bases:" + \
+                          str(stats['trimmed_bases'])
+        if args.get('additional_attributes') and ':' in args['additional_attributes']:
+            args['additional_attributes'] += "|" + trim_attributes
+        else:
+            args['additional_attributes'] = trim_attributes
+        self.logger.info("Trimmed file: " + t_file)
+        self.dbs.update_sub_data(args['spuid'], column_id="submission_status", column_value="trimmed")
+        return True
+
     def check_row(self, row):
         """
         A simple row validator method that assigns a release date if none is provided and ensures required fields
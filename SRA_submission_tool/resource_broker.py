@@ -0,0 +1,123 @@
+import SRA_submission_tool.constants as c
+import logging
+import multiprocessing
+import threading
+import errno
+import time
+import os
+from SRA_submission_tool.submission_db import ConnectionManager
+__author__ = 'Amr Abouelleil'
+
+# Host-wide admission control for heavy subprocesses. Every Zamboni worker on a host shares one sqlite file on local
+# disk that records the CPU and memory tokens granted to running processes; a request waits until enough tokens are
+# free. Grants held by processes that died without releasing them are reclaimed by the next request.
+
+_created_brokers = set()
+_created_brokers_lock = threading.Lock()
+
+
+class ResourceGrant(object):
+    """
+    CPU and memory tokens granted to one subprocess. Release it, or use it as a context manager, once the subprocess
+    has finished.
+    """
+    def __init__(self, broker, grant_id, cpus, memory_mb):
+        self.broker = broker
+        self.grant_id = grant_id
+        self.cpus = cpus
+        self.memory_mb = memory_mb
+
+    def release(self):
+        if self.grant_id is not None:
+            self.broker.release(self.grant_id)
+            self.grant_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class ResourceBroker(object):
+    """
+    A counting semaphore over the CPUs and memory of the host, shared by every process through a sqlite file.
+    """
+    def __init__(self, broker_db=None, cpus=None, memory_mb=None):
+        """
+        :param broker_db: path to the broker's sqlite file. It must be on local disk, since the tokens are per host.
+        :param cpus: CPU tokens on the host, c.broker_cpus or every core by default.
+        :param memory_mb: memory tokens on the host in MB, c.broker_memory_mb or the physical memory by default.
+        """
+        self.logger = logging.getLogger('sra_tool.resource_broker.ResourceBroker')
+        self.total_cpus = cpus or c.broker_cpus or multiprocessing.cpu_count()
+        self.total_memory_mb = memory_mb or c.broker_memory_mb or physical_memory_mb()
+        broker_db = broker_db or c.broker_db
+        self.manager = ConnectionManager.for_db(broker_db, c.broker_journal_mode)
+        key = (os.path.realpath(broker_db), os.getpid())
+        with _created_brokers_lock:
+            if key not in _created_brokers:
+                with self.manager.transaction() as conn:
+                    conn.execute('''CREATE TABLE IF NOT EXISTS grants (grant_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                    pid INTEGER, cpus INTEGER, memory_mb INTEGER, label TEXT, granted REAL)''')
+                _created_brokers.add(key)
+
+    def acquire(self, cpus=1, memory_mb=0, min_cpus=None, label="", poll_seconds=None):
+        """
+        Waits until the host has the tokens free, then takes them.
+        :param cpus: the CPUs wanted.
+        :param memory_mb: the memory wanted, in MB.
+        :param min_cpus: the fewest CPUs the caller can work with; defaults to cpus. The grant holds as many CPUs up
+        to cpus as are free.
+        :param label: a description of the subprocess, for the log.
+        :param poll_seconds: how long to wait between attempts, c.broker_poll_seconds by default.
+        :return: a ResourceGrant.
+        """
+        # a request larger than the host would otherwise never be granted; let it run alone instead
+        cpus = min(cpus, self.total_cpus)
+        min_cpus = min(min_cpus or cpus, cpus)
+        memory_mb = min(memory_mb, self.total_memory_mb)
+        waited = False
+        while True:
+            with self.manager.transaction() as conn:
+                self.reclaim(conn)
+                used_cpus, used_memory = conn.execute('''SELECT COALESCE(SUM(cpus), 0), COALESCE(SUM(memory_mb), 0)
+                                                         FROM grants''').fetchone()
+                free_cpus = self.total_cpus - used_cpus
+                if free_cpus >= min_cpus and self.total_memory_mb - used_memory >= memory_mb:
+                    granted = min(cpus, free_cpus)
+                    grant_id = conn.execute('''INSERT INTO grants (pid, cpus, memory_mb, label, granted)
+                                               VALUES (?, ?, ?, ?, ?)''',
+                                            (os.getpid(), granted, memory_mb, label, time.time())).lastrowid
+                    self.logger.info("Granted " + str(granted) + " CPUs and " + str(memory_mb) + "MB to " + label)
+                    return ResourceGrant(self, grant_id, granted, memory_mb)
+            if not waited:
+                self.logger.info("Waiting for " + str(min_cpus) + " CPUs and " + str(memory_mb) + "MB for " + label)
+                waited = True
+            time.sleep(poll_seconds or c.broker_poll_seconds)
+
+    def release(self, grant_id):
+        with self.manager.transaction() as conn:
+            conn.execute('''DELETE FROM grants WHERE grant_id=?''', (grant_id,))
+
+    def reclaim(self, conn):
+        """
+        Deletes the grants of processes that are no longer running.
+        :param conn: a connection inside a transaction.
+        """
+        for grant_id, pid, label in conn.execute('''SELECT grant_id, pid, label FROM grants''').fetchall():
+            if not pid_alive(pid):
+                self.logger.warning("Reclaiming tokens of dead process " + str(pid) + ": " + label)
+                conn.execute('''DELETE FROM grants WHERE grant_id=?''', (grant_id,))
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def physical_memory_mb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
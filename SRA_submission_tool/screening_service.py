@@ -3,45 +3,379 @@ import logging
 import subprocess
 import os
 import shutil
-from SRA_submission_tool.file_service import rehead_bam
+import sqlite3
+import functools
+import threading
+import hashlib
+import json
+import time
+import errno
+import multiprocessing
+import glob
+from multiprocessing.pool import ThreadPool
+from SRA_submission_tool.file_service import rehead_stream, revert_command, StageRunner, SliceFeeder, \
+    concatenate_bams, file_fingerprint
+from SRA_submission_tool.bam_stats import BamStatistics
+from SRA_submission_tool.resource_broker import ResourceBroker
+from SRA_submission_tool.submission_db import SubmissionDBService, ConnectionManager
 __author__ = "Amr Abouelleil"
 
+_screen_versions = dict()
+_screen_versions_lock = threading.Lock()
+
+
+def screen_version():
+    """
+    Identifies the installed screening build by the output of c.screen_version_commands, run once per process. A
+    command that fails contributes its exit status instead.
+    :return: a version string.
+    """
+    commands = tuple(c.screen_version_commands)
+    with _screen_versions_lock:
+        if commands not in _screen_versions:
+            versions = []
+            for command in commands:
+                process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                           close_fds=True)
+                output = process.communicate()[0].strip()
+                versions.append(output if process.returncode == 0 else command + " exited " + str(process.returncode))
+            _screen_versions[commands] = "\n".join(versions)
+        return _screen_versions[commands]
+
+
+def reference_index_files():
+    """
+    :return: the paths of the bmtagger index files of c.human_reference, named after it with one of
+    c.screen_reference_index_suffixes, whether the suffix follows the whole file name or its stem.
+    """
+    index_files = set()
+    for suffix in c.screen_reference_index_suffixes:
+        for stem in (c.human_reference, os.path.splitext(c.human_reference)[0]):
+            index_files.update(glob.glob(stem + suffix + "*"))
+    return sorted(index_files)
+
+
+class ScreeningCache(object):
+    """
+    A size-bounded store of screened bams, addressed by everything the screening result depends on: the input bam's
+    fingerprint, the reference and its bmtagger index files, the blender build and the versions it reports, and the
+    library layout. Hits are hard linked into the submission's temp dir, so resubmitting a screened sample costs no
+    screening and no copy. Least recently used entries are evicted once the store grows past c.screen_cache_max_bytes.
+    """
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.logger = logging.getLogger('sra_tool.screening_service.ScreeningCache')
+        self.cache_dir = cache_dir or c.screen_cache_dir
+        self.max_bytes = max_bytes or c.screen_cache_max_bytes
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.manager = ConnectionManager.for_db(os.path.join(self.cache_dir, "index.db"))
+        with self.manager.transaction() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, created REAL,
+                            last_used REAL)''')
+
+    def key(self, read_file, library_layout, revert=False):
+        """
+        :return: the cache key of screening read_file with the current reference, its indexes and blender.
+        """
+        inputs = [list(file_fingerprint(read_file)), c.human_reference, os.stat(c.human_reference).st_mtime,
+                  [list(file_fingerprint(index_file)) for index_file in reference_index_files()],
+                  list(file_fingerprint(c.blender_path)), screen_version(), library_layout, revert]
+        return hashlib.sha256(json.dumps(inputs)).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ".bam")
+
+    def fetch(self, key, target):
+        """
+        Links a cached screened bam to target.
+        :return: True on a hit, False on a miss.
+        """
+        conn = self.manager.connection()
+        if conn.execute('''SELECT 1 FROM entries WHERE key=?''', (key,)).fetchone() is None:
+            return False
+        try:
+            _link_or_copy(self.entry_path(key), target)
+        except (IOError, OSError) as e:
+            self.logger.warning("Dropping unreadable screening cache entry " + key + ": " + str(e))
+            with self.manager.transaction() as conn:
+                conn.execute('''DELETE FROM entries WHERE key=?''', (key,))
+            return False
+        with self.manager.transaction() as conn:
+            conn.execute('''UPDATE entries SET last_used=? WHERE key=?''', (time.time(), key))
+        return True
+
+    def store(self, key, screened_file):
+        """
+        Adds a screened bam to the store, then evicts least recently used entries down to the size bound.
+        """
+        size = os.path.getsize(screened_file)
+        if size > self.max_bytes:
+            self.logger.info("Not caching " + screened_file + ", it is larger than the whole screening cache.")
+            return
+        temp_path = self.entry_path(key) + "." + str(os.getpid()) + ".tmp"
+        try:
+            _link_or_copy(screened_file, temp_path)
+            os.rename(temp_path, self.entry_path(key))
+        except (IOError, OSError) as e:
+            self.logger.warning("Could not cache " + screened_file + ": " + str(e))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        now = time.time()
+        with self.manager.transaction() as conn:
+            conn.execute('''INSERT OR REPLACE INTO entries (key, size, created, last_used) VALUES (?, ?, ?, ?)''',
+                         (key, size, now, now))
+            total = conn.execute('''SELECT SUM(size) FROM entries''').fetchone()[0]
+            evicted = []
+            for old_key, old_size in conn.execute('''SELECT key, size FROM entries WHERE key != ?
+                                                     ORDER BY last_used''', (key,)).fetchall():
+                if total <= self.max_bytes:
+                    break
+                evicted.append(old_key)
+                total -= old_size
+            conn.executemany('''DELETE FROM entries WHERE key=?''', [(old_key,) for old_key in evicted])
+        for old_key in evicted:
+            # files still linked from a submission temp dir survive until that dir is removed
+            try:
+                os.remove(self.entry_path(old_key))
+            except OSError:
+                pass
+        self.logger.info("Cached screened bam " + screened_file + " as " + key + ", evicted " + str(len(evicted)) +
+                         " entries.")
+
+
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copyfile(source, target)
+
 
 class ScreeningService(object):
     """
     A service for screening read files for contamination
     """
     def __init__(self):
-        self.base_cmd = c.blender_path + " filter --remove_host --threads 4"
+        self.base_cmd = c.blender_path + " filter --remove_host"
         self.logger = logging.getLogger('sra_tool.screening_service.ScreeningService')
         self.logger.info("Starting Screening Service.")
 
-    def screen_human(self, read_file, library_layout, file_type, spuid, output_dir):
+    def screen_command(self, read_file, library_layout, file_type, screen_dir, output_header, threads=None):
+        """
+        :param threads: the CPUs granted to blender. Defaults to c.screen_threads.
+        :return: the blender command that screens read_file into screen_dir.
+        """
+        screen_cmd = self.base_cmd + " --threads " + str(threads or c.screen_threads) + " --reference " + \
+            c.human_reference + \
+            " --output_format " + file_type + " --output_directory " + screen_dir + " --output_header " + output_header
+        if library_layout == "paired":
+            screen_cmd += " --paired_bam_file " + read_file
+        elif library_layout == "single":
+            screen_cmd += " --unpaired_bam_file " + read_file
+        return screen_cmd
+
+    def acquire(self, read_file, revert=False, shards=1):
+        """
+        Waits for the host's resource broker to admit a screening run. Blender gets as many of c.screen_threads per
+        shard as are free, so a busy host runs it on fewer threads rather than oversubscribing the CPUs. The shards and
+        the RevertSam are admitted together, as one request capped at the host, so that no part of the run holds its
+        tokens while waiting for the rest.
+        :param read_file: the bam to be screened.
+        :param revert: the run also feeds a RevertSam, which needs its own memory.
+        :param shards: the number of blender runs screening read_file at once.
+        :return: a ResourceGrant whose cpus is the thread count to share between the blender runs.
+        """
+        memory_mb = c.screen_memory_mb * shards + (c.revert_memory_mb if revert else 0)
+        return ResourceBroker().acquire(cpus=c.screen_threads * shards, memory_mb=memory_mb, min_cpus=shards,
+                                        label="blender " + read_file)
+
+    def screen_human(self, read_file, library_layout, file_type, spuid, output_dir, revert=False, shards=None):
+        """
+        Screens a bam for human reads. Blender writes the filtered bam into a named pipe, from which it is streamed
+        through the optional revert and the reheader stages straight into output_dir, so it is written to disk once.
+        When more than one shard is allowed, large bams are split into shards that are screened concurrently, see
+        screen_shards.
+        :param read_file: the bam to screen.
+        :param revert: also revert the screened bam to an unaligned bam.
+        :param shards: the most shards to split the bam into. Defaults to c.screen_shards.
+        :return: the path to the screened bam in output_dir, named like read_file.
+        """
+        final_bam = output_dir + "/" + read_file.split("/")[-1]
+        if os.path.exists(final_bam):
+            # a leftover from an earlier attempt may be linked into the screening cache; never write through it
+            os.remove(final_bam)
+        cache = None
+        if c.screen_cache_dir:
+            try:
+                cache = ScreeningCache()
+                key = cache.key(read_file, library_layout, revert)
+                if cache.fetch(key, final_bam):
+                    self.logger.info("Screening cache hit for " + read_file + ", linked to " + final_bam)
+                    return final_bam
+            except (IOError, OSError, sqlite3.Error) as e:
+                self.logger.warning("Screening cache unavailable: " + str(e))
+                cache = None
+        self.screen_uncached(read_file, library_layout, file_type, spuid, final_bam, revert, shards)
+        if cache:
+            try:
+                cache.store(key, final_bam)
+            except sqlite3.Error as e:
+                self.logger.warning("Could not record " + final_bam + " in the screening cache: " + str(e))
+        return final_bam
+
+    def screen_uncached(self, read_file, library_layout, file_type, spuid, final_bam, revert=False, shards=None):
+        """
+        Runs the screening behind screen_human.
+        :return: final_bam.
+        """
         output_header = ".".join(read_file.split("/")[-1].split(".")[0:-1])
         self.logger.info("Output header assigned:" + output_header)
         screen_dir = c.screen_temp_dir + spuid + "/"
         if not os.path.exists(screen_dir):
             os.mkdir(screen_dir, 0777)
-        screen_cmd = self.base_cmd + " --reference " + c.human_reference + " --output_format " \
-                     + file_type + " --output_directory " + screen_dir + " --output_header " + output_header
-        if library_layout == "paired":
-            screen_cmd += " --paired_bam_file " + read_file
-        elif library_layout == "single":
-            screen_cmd += " --unpaired_bam_file " + read_file
+        shards = shards or c.screen_shards or max(1, multiprocessing.cpu_count() // c.screen_threads)
+        if shards > 1 and file_type == "bam":
+            boundaries = BamStatistics(processes=shards,
+                                       min_range_size=c.screen_min_shard_size).shard_boundaries(read_file)
+            if len(boundaries) > 1:
+                return self.screen_shards(read_file, boundaries, library_layout, spuid, screen_dir, final_bam, revert)
+        screened_bam = screen_dir + output_header + ".filter-bmtagger." + library_layout + ".sample.1.bam"
+        stages = [functools.partial(rehead_stream, read_file)]
+        if revert:
+            stages.insert(0, revert_command("/dev/stdin", "/dev/stdout"))
+        runner = StageRunner(stages)
+        grant = self.acquire(read_file, revert)
         try:
-            self.logger.info("Screening command issued via subprocess:" + screen_cmd)
-            subprocess.check_call(screen_cmd, stdout=subprocess.PIPE, shell=True)
-        except subprocess.CalledProcessError as e:
-            self.logger.error("Subprocess call failed:" + str(e))
-            self.logger.info("Trying system call:" + screen_cmd)
-            os.system(screen_cmd)
+            screen_cmd = self.screen_command(read_file, library_layout, file_type, screen_dir, output_header,
+                                             grant.cpus)
+            os.mkfifo(screened_bam)
+            runner.start(screened_bam, final_bam)
+            try:
+                self.logger.info("Screening command issued via subprocess:" + screen_cmd)
+                with open(os.devnull, 'w') as devnull:
+                    subprocess.check_call(screen_cmd, stdout=devnull, shell=True)
+            except subprocess.CalledProcessError as e:
+                self.logger.error("Subprocess call failed:" + str(e))
+                raise
+            finally:
+                # let the stages finish before a blender failure propagates, so their output can be removed
+                runner.join()
+                grant.release()
+            runner.wait()
+        except:
+            if os.path.exists(final_bam):
+                os.remove(final_bam)
+            raise
         finally:
-            screened_bam = screen_dir + output_header + ".filter-bmtagger." + library_layout + ".sample.1.bam"
-            reheaded_bam = rehead_bam(temp_dir=screen_dir, in_bam=read_file, bam_file=screened_bam,
-                                      header=output_header)
-            self.logger.info("Moving screened bam:" + reheaded_bam + " to " + output_dir)
-            final_bam = output_dir + "/" + read_file.split("/")[-1]
-            shutil.move(reheaded_bam, final_bam)
+            grant.release()
             self.logger.info("Deleting temp screening dir: " + screen_dir)
             shutil.rmtree(screen_dir)
-            return final_bam
+        self.logger.info("Screened bam written to " + final_bam)
+        return final_bam
+
+    def screen_shards(self, read_file, boundaries, library_layout, spuid, screen_dir, final_bam, revert=False):
+        """
+        Screens a bam in shards of whole templates, one blender run per shard, all running at once. Each shard is fed
+        to its blender run through a named pipe, straight from read_file. The screened shards are joined in their
+        original order under the header of read_file as soon as the shards before them are done, and each is deleted
+        once joined. Progress is recorded in the submission's screening_progress column as each shard finishes.
+        :param read_file: the bam to screen.
+        :param boundaries: the virtual offsets the shards start at, from BamStatistics.shard_boundaries.
+        :param screen_dir: the scratch directory for the screened shards, removed afterwards.
+        :param final_bam: the path to write the screened bam to.
+        :param revert: also revert the screened bam to an unaligned bam.
+        :return: final_bam.
+        """
+        dbs = SubmissionDBService(c.submission_db)
+        db_spuid = spuid[len(c.spuid_prefix):] if spuid.startswith(c.spuid_prefix) else spuid
+        progress_lock = threading.Lock()
+        screened = []
+        dbs.update_sub_data(db_spuid, "screening_progress", "0/" + str(len(boundaries)))
+        self.logger.info("Screening " + read_file + " in " + str(len(boundaries)) + " shards.")
+
+        def screen_shard(shard):
+            shard_dir = screen_dir + "shard" + str(shard) + "/"
+            os.mkdir(shard_dir)
+            shard_fifo = shard_dir + "input.bam"
+            os.mkfifo(shard_fifo)
+            feeder = SliceFeeder(read_file, boundaries[shard], (boundaries + [None])[shard + 1], shard_fifo)
+            with open(os.devnull, 'w') as devnull:
+                feeder.start()
+                try:
+                    screen_cmd = self.screen_command(shard_fifo, library_layout, "bam", shard_dir, "screened",
+                                                     max(1, grant.cpus // len(boundaries)))
+                    self.logger.info("Screening command issued via subprocess:" + screen_cmd)
+                    subprocess.check_call(screen_cmd, stdout=devnull, shell=True, close_fds=True)
+                finally:
+                    # a blender failure takes precedence over the broken pipe it leaves the feeder with
+                    feeder.join()
+                feeder.wait()
+            with progress_lock:
+                screened.append(shard)
+                dbs.update_sub_data(db_spuid, "screening_progress", str(len(screened)) + "/" + str(len(boundaries)))
+            return shard_dir + "screened.filter-bmtagger." + library_layout + ".sample.1.bam"
+
+        # a RevertSam holding its tokens while the shards wait for theirs could deadlock, so all are admitted at once
+        grant = self.acquire(read_file, revert, len(boundaries))
+        pool = ThreadPool(len(boundaries))
+
+        def screened_shards():
+            # in shard order, as each one and those before it are done; a shard is deleted once it has been joined
+            for shard_bam in pool.imap(screen_shard, range(len(boundaries))):
+                yield shard_bam
+                os.remove(shard_bam)
+
+        try:
+            if revert:
+                process = subprocess.Popen(revert_command("/dev/stdin", final_bam), shell=True,
+                                           stdin=subprocess.PIPE, close_fds=True)
+                try:
+                    concatenate_bams(read_file, screened_shards(), process.stdin)
+                finally:
+                    process.stdin.close()
+                    process.wait()
+                if process.returncode != 0:
+                    raise subprocess.CalledProcessError(process.returncode, revert_command("/dev/stdin", final_bam))
+            else:
+                with open(final_bam, 'wb') as target:
+                    concatenate_bams(read_file, screened_shards(), target)
+        except:
+            self.logger.error("Sharded screening of " + read_file + " failed.")
+            if os.path.exists(final_bam):
+                os.remove(final_bam)
+            raise
+        finally:
+            pool.close()
+            pool.join()
+            grant.release()
+            self.logger.info("Deleting temp screening dir: " + screen_dir)
+            shutil.rmtree(screen_dir)
+        self.logger.info("Screened bam written to " + final_bam)
+        return final_bam
+
+    def check_read_retention(self, read_file, screened_file):
+        """
+        Checks that screening removed no more reads than host contamination plausibly accounts for. Read counts come
+        from the statistics cache, which the shard scan and the xml attributes share, so each bam is scanned once.
+        :param read_file: the bam before screening.
+        :param screened_file: the bam after screening.
+        :return: True if the screened bam kept at least c.screen_min_read_fraction of the primary reads, if the files
+        are not bams, or if c.screen_check_read_retention is off.
+        """
+        if not c.screen_check_read_retention:
+            self.logger.debug("Read retention check is off, not checking " + screened_file)
+            return True
+        if not (read_file.endswith(".bam") and screened_file.endswith(".bam")):
+            return True
+        bs = BamStatistics()
+        reads = bs.get_stats(read_file)['reads']
+        screened_reads = bs.get_stats(screened_file)['reads']
+        fraction = float(screened_reads) / reads if reads else 1.0
+        self.logger.info("Screening kept " + str(screened_reads) + " of " + str(reads) + " reads (" +
+                         "%.1f" % (fraction * 100) + "%).")
+        if fraction < c.screen_min_read_fraction:
+            self.logger.error("Screened bam " + screened_file + " lost too many reads.")
+            return False
+        return True
@@ -6,7 +6,7 @@ import logging
 import sys
 import time
 import xml.etree.ElementTree as ET
-from submission_db import SubmissionDBService
+from submission_db import StatusWriter
 import os
 
 
@@ -21,8 +21,9 @@ class SubmissionMonitor(object):
     def monitor_submission(self, remote_sub_path, local_sub_dir, spuid_suffix, retry):
         at = AsperaTransfer()
         exit_flag = False
-        dbs = SubmissionDBService(c.submission_db)
-        dbs.update_sub_data(spuid_suffix, "submission_status", "monitoring")
+        # report.xml is polled every minute for up to days; unchanged values never reach the db
+        dbs = StatusWriter(c.submission_db)
+        dbs.write(spuid_suffix, {'submission_status': "monitoring"})
         time_lapsed = 0
         attempts = 0
         print("retry=" + str(retry))
@@ -35,42 +36,28 @@ class SubmissionMonitor(object):
             self.logger.debug('Monitoring ' + local_sub_dir + '/report.xml')
             root = tree.getroot()
             if root.attrib['status'] == 'processing' or root.attrib['status'] == 'submitted':
+                update_dict = {'submission_status': root.attrib['status']}
                 if time_lapsed <= c.report_check_interval:
-                    dbs.update_sub_data(spuid=spuid_suffix,
-                                        column_id='submission_status', column_value=root.attrib['status'])
                     try:
-                        dbs.update_sub_data(spuid=spuid_suffix,
-                                            column_id='ncbi_submission_id',
-                                            column_value=root.attrib['submission_id'])
+                        update_dict['ncbi_submission_id'] = root.attrib['submission_id']
                     except KeyError as e:
                         self.logger.error("No submission_id assigned yet." + str(e))
-                        dbs.update_sub_data(spuid=spuid_suffix,
-                                            column_id='ncbi_submission_id',
-                                            column_value='')
-                dbs.update_sub_data(spuid=spuid_suffix, column_id='submission_status',
-                                    column_value=root.attrib['status'])
+                        update_dict['ncbi_submission_id'] = ''
+                dbs.write(spuid_suffix, update_dict)
                 self.logger.info('Report.xml still processing. Rechecking in ' + str(c.report_check_interval)
                                  + ' seconds...')
                 # this sleep time is to give NCBI time to finish processing the submission
                 time.sleep(c.report_check_interval)
                 time_lapsed += c.report_check_interval
                 if time_lapsed > c.max_report_check_time:
-                    dbs.update_sub_data(spuid=spuid_suffix,
-                                        column_id='submission_status',
-                                        column_value=root.attrib['status'] + "-time_out")
                     update_dict = dict()
+                    update_dict['submission_status'] = root.attrib['status'] + "-time_out"
                     update_dict['response_severity'] = "sra tool time-out."
                     update_dict['response_message'] = "Submission did not receive a terminal response."
-                    for k, v in update_dict.items():
-                        try:
-                            dbs.update_sub_data(spuid=spuid_suffix,
-                                                column_id=k, column_value=v)
-                        except KeyError as e:
-                            self.logger.error("Unable to update " + str(k) + ":" + str(v) + "." + str(e))
+                    dbs.write(spuid_suffix, update_dict)
                     self.logger.error("Maximum monitoring time exceeded. Aborting submissions.")
                     sys.exit(-1)
             elif root.attrib['status'] == 'processed-error':
-                dbs.update_sub_data(spuid_suffix, "submission_status", root.attrib['status'])
                 update_dict = {'ncbi_submission_id': root.attrib['submission_id'],
                                'submission_status': root.attrib['status']}
                 try:
@@ -83,12 +70,7 @@ class SubmissionMonitor(object):
                 except KeyError as e:
                     self.logger.error("Unable to assign response message. Assigning none value." + str(e))
                     update_dict['response_message'] = "None"
-                for k, v in update_dict.items():
-                    try:
-                        dbs.update_sub_data(spuid=spuid_suffix,
-                                            column_id=k, column_value=v)
-                    except KeyError as e:
-                        self.logger.error("Unable to update " + str(k) + ":" + str(v) + "." + str(e))
+                dbs.write(spuid_suffix, update_dict)
                 self.logger.info("Processing failed with status processed-error. Submission DB updated.")
                 error_msg = "NCBI returned processed-error for submission: " \
                             + "Severity=" + update_dict['response_severity'] \
@@ -97,7 +79,7 @@ class SubmissionMonitor(object):
                 time.sleep(60)
                 if attempts >= 3:
                     self.logger.critical(msg=error_msg + " Aborting after " + str(attempts) + " attempts!")
-                    dbs.update_sub_data(spuid_suffix, "submission_status", root.attrib['status'])
+                    dbs.write(spuid_suffix, {'submission_status': root.attrib['status']})
                     sys.exit(-1)
             elif root.attrib['status'] == 'processed-ok':
                 update_dict = {'ncbi_submission_id': root.attrib['submission_id'],
@@ -116,34 +98,25 @@ class SubmissionMonitor(object):
                     update_dict['accession'] = root[0][0][0].attrib['accession']
                 except KeyError as e:
                     self.logger.error("Unable to assign accession number. Assigning none value." + str(e))
-                    update_dict['accession_number'] = "None"
-                for k, v in update_dict.items():
-                    try:
-                        dbs.update_sub_data(spuid=spuid_suffix,
-                                            column_id=k, column_value=v)
-                    except KeyError as e:
-                        self.logger.error("Unable to update " + str(k) + ":" + str(v) + "." + str(e))
+                    update_dict['accession'] = "None"
+                dbs.write(spuid_suffix, update_dict)
                 self.logger.info("Processing completed with status processed-ok. Submission DB updated.")
                 exit_flag = True
             elif root.attrib['status'] == 'failed':
-                dbs.update_sub_data(spuid=spuid_suffix,
-                                    column_id='submission_status', column_value=root.attrib['status'])
-                dbs.update_sub_data(spuid=spuid_suffix,
-                                    column_id='response_severity', column_value=root[0].attrib['severity'])
-                dbs.update_sub_data(spuid=spuid_suffix,
-                                    column_id='response_message', column_value=root[0].text)
+                dbs.write(spuid_suffix, {'submission_status': root.attrib['status'],
+                                         'response_severity': root[0].attrib['severity'],
+                                         'response_message': root[0].text})
                 self.logger.critical("NCBI returned submission 'failed' status for SPUID " + str(spuid_suffix))
                 self.logger.info("Attempts made: " + str(attempts) + " Trying again.")
                 time.sleep(60)
                 if attempts >= 3:
                     self.logger.critical(msg="Aborting after " + str(attempts) + " failed attempts!")
-                    dbs.update_sub_data(spuid_suffix, "submission_status", root.attrib['status'])
+                    dbs.write(spuid_suffix, {'submission_status': root.attrib['status']})
                     sys.exit(-1)
             else:
-                dbs.update_sub_data(spuid=spuid_suffix,
-                                    column_id='submission_status',
-                                    column_value=root.attrib['status'] + "-unrecognized")
+                dbs.write(spuid_suffix, {'submission_status': root.attrib['status'] + "-unrecognized"})
                 self.logger.critical(msg='Unrecognized submission status received from NCBI:' + root.attrib['status'] +
                                          " Aborting!")
                 sys.exit(-1)
+        dbs.close()
 
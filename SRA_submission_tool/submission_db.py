@@ -1,10 +1,128 @@
 import sqlite3
 import SRA_submission_tool.constants as c
+from SRA_submission_tool import db_schema
 import logging
+import threading
+import contextlib
 import time
 import sys
 import shutil
+import socket
 import os
+import json
+import atexit
+import weakref
+
+
+class ConnectionManager(object):
+    """
+    A process-wide manager that hands out one reusable sqlite connection per database file per thread. Connections
+    are opened in autocommit mode so that transactions are delimited explicitly with transaction().
+    """
+    _managers = dict()
+    _managers_lock = threading.Lock()
+
+    def __init__(self, db, journal_mode=None):
+        """
+        :param db: path to the sqlite database file.
+        :param journal_mode: the sqlite journal mode, c.db_journal_mode by default. Only databases on local disk may use
+        WAL: its shared memory index does not work across hosts on a network filesystem.
+        """
+        self.logger = logging.getLogger('sra_tool.submission_db.ConnectionManager')
+        self.db = db
+        self.journal_mode = journal_mode or c.db_journal_mode
+        self._local = threading.local()
+
+    @classmethod
+    def for_db(cls, db, journal_mode=None):
+        """
+        Returns the shared manager for a database file, creating it on first use.
+        :param db: path to the sqlite database file.
+        :param journal_mode: the journal mode of a newly created manager, c.db_journal_mode by default.
+        :return: a ConnectionManager instance.
+        """
+        key = os.path.realpath(db)
+        with cls._managers_lock:
+            if key not in cls._managers:
+                cls._managers[key] = cls(db, journal_mode)
+            return cls._managers[key]
+
+    def connection(self):
+        """
+        Returns this thread's connection to the database, opening it if needed. Connections inherited across a fork
+        are never reused.
+        :return: a sqlite3 connection.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._local.depth = 0
+        return conn
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db, timeout=c.global_db_timeout, isolation_level=None,
+                               cached_statements=c.db_statement_cache_size)
+        conn.execute("PRAGMA busy_timeout=" + str(int(c.global_db_timeout * 1000)))
+        journal_mode = conn.execute("PRAGMA journal_mode=" + self.journal_mode).fetchone()[0]
+        if journal_mode.upper() != self.journal_mode.upper():
+            self.logger.warning("Could not switch " + self.db + " to " + self.journal_mode + " journaling. Using "
+                                + journal_mode + ".")
+        conn.execute("PRAGMA synchronous=" + c.db_synchronous)
+        self.logger.debug("Opened connection to " + self.db + " in " + journal_mode + " mode for pid "
+                          + str(os.getpid()) + ".")
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self, mode="IMMEDIATE"):
+        """
+        A context manager that wraps its block in a single transaction on this thread's connection. Nested blocks
+        join the outermost transaction, which commits on success and rolls back if an exception escapes.
+        :param mode: the sqlite BEGIN mode. IMMEDIATE takes the write lock up front so that read-then-write blocks
+        cannot deadlock against each other.
+        :return: the connection in use.
+        """
+        conn = self.connection()
+        if self._local.depth == 0:
+            conn.execute("BEGIN " + mode)
+        self._local.depth += 1
+        try:
+            yield conn
+        except:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.execute("ROLLBACK")
+            raise
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            conn.execute("COMMIT")
+
+    def close(self):
+        """
+        Closes this thread's connection, if any.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+
+class SubmissionRecord(object):
+    """
+    A compact, read-only view of one row of the submissions table.
+    """
+    __slots__ = tuple(name for name, col_type in db_schema.submission_columns)
+
+    def __init__(self, row):
+        for name, value in zip(self.__slots__, row):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SubmissionRecord is read-only.")
+
+    def __repr__(self):
+        return "SubmissionRecord(spuid=" + str(self.spuid) + ", submission_status=" + str(self.submission_status) + ")"
 
 
 class SubmissionDBService(object):
@@ -15,68 +133,337 @@ class SubmissionDBService(object):
         else:
             self.logger = logging.getLogger('sra_tool.submission_db.SubmissionDBService')
         self.db = db
+        self.host = socket.gethostname()
+        self.manager = ConnectionManager.for_db(db)
+        db_schema.ensure_schema(self.manager)
 
     def get_new_spuid(self, read_file):
-        conn = sqlite3.connect(self.db, timeout=c.global_db_timeout)
-        cursor = conn.cursor()
+        insert_string = '''INSERT INTO submissions (spuid_date, read_file) VALUES (?, ?)'''
         try:
-            insert_string = ('''INSERT INTO submissions (spuid_date, read_file) VALUES(\"'''
-                             + str(time.strftime("%Y-%m-%d %H:%M:%S")) + '''\", \"''' + read_file +'''\")''')
-            self.logger.debug("Creating new SPUID with SQL string:" + insert_string)
-            cursor.execute(insert_string)
-            conn.commit()
-            new_spuid = str(cursor.lastrowid)
+            self.logger.debug("Creating new SPUID for read file:" + read_file)
+            with self.manager.transaction() as conn:
+                cursor = conn.execute(insert_string, (time.strftime("%Y-%m-%d %H:%M:%S"), read_file))
+                new_spuid = str(cursor.lastrowid)
             self.logger.debug("New SPUID generated:" + new_spuid)
         except sqlite3.OperationalError as e:
             self.logger.critical("Could not obtain new SPUID from database. Aborting." + str(e))
             sys.exit(-1)
-        conn.close()
         return new_spuid
 
-    def update_sub_data(self, spuid, column_id, column_value):
+    def reserve_spuids(self, read_files):
+        """
+        A batched get_new_spuid that creates a submission row for every read file in one transaction.
+        :param read_files: a list of read file paths.
+        :return: the new SPUIDs as strings, in the same order as read_files.
+        """
+        if not read_files:
+            return []
+        spuid_date = time.strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            self.logger.debug("Reserving " + str(len(read_files)) + " new SPUIDs.")
+            with self.manager.transaction() as conn:
+                # the write lock is held for the whole block, so every row above the current maximum is ours and
+                # rowids are handed out in insertion order
+                last_spuid = conn.execute('''SELECT COALESCE(MAX(spuid), 0) FROM submissions''').fetchone()[0]
+                conn.executemany('''INSERT INTO submissions (spuid_date, read_file) VALUES (?, ?)''',
+                                 [(spuid_date, read_file) for read_file in read_files])
+                new_spuids = [str(row[0]) for row in conn.execute('''SELECT spuid FROM submissions WHERE spuid > ?
+                                                                     ORDER BY spuid''', (last_spuid,))]
+            self.logger.debug("New SPUIDs reserved:" + str(new_spuids))
+        except sqlite3.OperationalError as e:
+            self.logger.critical("Could not reserve new SPUIDs from database. Aborting." + str(e))
+            sys.exit(-1)
+        return new_spuids
+
+    def get_or_create_submission(self, platform_unit, read_file):
+        """
+        Atomically returns the submission for a platform unit, creating it with a new SPUID and temp path if it does
+        not exist yet. Safe to call from parallel launchers.
+        :param platform_unit: the platform unit the submission is keyed by.
+        :param read_file: the read file recorded for a new submission.
+        :return: a (spuid, temp_path, submission_status, created) tuple.
+        """
+        return self.get_or_create_submissions([(platform_unit, read_file)])[platform_unit]
+
+    def get_or_create_submissions(self, units):
+        """
+        A batched get_or_create_submission that resolves every platform unit in one transaction. Archived
+        submissions are restored rather than recreated.
+        :param units: a list of (platform_unit, read_file) tuples.
+        :return: a dict of platform unit to (spuid, temp_path, submission_status, created) tuple.
+        """
+        read_files = dict()
+        for platform_unit, read_file in units:
+            read_files.setdefault(platform_unit, read_file)
+        results = dict()
+        spuid_date = time.strftime("%Y-%m-%d %H:%M:%S")
+        with self.manager.transaction() as conn:
+            for table in ("submissions_archive", "submissions"):
+                # archived units are restored first so that the lookup below sees them in the live table
+                unique_units = list(read_files.keys())
+                for i in range(0, len(unique_units), c.db_max_variables):
+                    chunk = unique_units[i:i + c.db_max_variables]
+                    query = ('''SELECT spuid, platform_unit, temp_path, submission_status FROM ''' + table +
+                             ''' WHERE platform_unit IN (''' + ", ".join("?" * len(chunk)) + ''')''')
+                    for spuid, platform_unit, temp_path, status in conn.execute(query, chunk).fetchall():
+                        if table == "submissions_archive":
+                            self.restore_archived(spuid)
+                        else:
+                            results[platform_unit] = (str(spuid), temp_path, status, False)
+            # the write lock is held from the lookup above, so no other launcher can create these units in between
+            for platform_unit in sorted(set(read_files) - set(results)):
+                spuid = str(conn.execute('''INSERT INTO submissions (spuid_date, read_file, platform_unit)
+                                            VALUES (?, ?, ?)''',
+                                         (spuid_date, read_files[platform_unit], platform_unit)).lastrowid)
+                temp_path = c.temp_root + c.spuid_prefix + spuid
+                conn.execute('''UPDATE submissions SET temp_path=? WHERE spuid=?''', (temp_path, spuid))
+                results[platform_unit] = (spuid, temp_path, None, True)
+        self.logger.debug("Created " + str(sum(1 for result in results.values() if result[3])) + " of "
+                          + str(len(results)) + " submissions by platform unit.")
+        return results
+
+    def clean_value(self, column_value):
+        """
+        Normalizes a column value the way the submission DB has always stored it: quotes are stripped and empty
+        values are stored as their string form.
+        :param column_value: the value to be written.
+        :return: the value to store.
+        """
         if column_value:
-            update_string = '''UPDATE submissions SET ''' + column_id + '''=\'''' + column_value.replace('\'', '') \
-                            + '''\' WHERE spuid=\'''' + str(spuid) + '''\''''
-        else:
-            update_string = '''UPDATE submissions SET ''' + column_id + '''=\'''' + str(column_value) \
-                            + '''\' WHERE spuid=\'''' + str(spuid) + '''\''''
-        self.logger.debug("Attempting update:" + update_string)
+            return column_value.replace('\'', '')
+        return str(column_value)
+
+    def build_update(self, columns):
+        """
+        Builds a parameterized UPDATE statement for a set of columns. Columns are sorted so that the same set always
+        produces the same statement text and hits the connection's statement cache.
+        :param columns: an iterable of column names.
+        :return: the column names in statement order and the SQL string.
+        """
+        columns = sorted(columns)
+        set_clause = ", ".join('"' + column + '"=?' for column in columns)
+        return columns, '''UPDATE submissions SET ''' + set_clause + ''' WHERE spuid=?'''
+
+    def update_sub_data(self, spuid, column_id, column_value):
+        self.update_sub_fields(spuid, {column_id: column_value})
+
+    def update_sub_fields(self, spuid, fields):
+        """
+        Updates several columns of a submission in one statement and one transaction.
+        :param spuid: the SPUID number of the submission (without prefix).
+        :param fields: a dictionary of column names to values.
+        :return:
+        """
+        if not fields:
+            return
+        columns, update_string = self.build_update(fields.keys())
+        values = [self.clean_value(fields[column]) for column in columns] + [str(spuid)]
+        self.logger.debug("Attempting update:" + update_string + " with " + str(values))
         try:
-            conn = sqlite3.connect(self.db, timeout=c.global_db_timeout)
-            cursor = conn.cursor()
-            cursor.execute(update_string)
-            conn.commit()
-            conn.close()
-            self.logger.debug("Submission DB updated:" + update_string)
+            with self.manager.transaction() as conn:
+                if 'submission_status' in fields:
+                    self.record_status_changes(conn, [(spuid, values[columns.index('submission_status')])])
+                conn.execute(update_string, values)
+            self.logger.debug("Submission DB updated:" + str(dict(zip(columns, values))) + " for SPUID " + str(spuid))
         except sqlite3.OperationalError as e:
-            self.logger.error("Problem updating database with " + str(column_id) + ": " + str(e) + "Aborting submission.")
+            self.logger.error("Problem updating database with " + str(columns) + ": " + str(e) + "Aborting submission.")
             self.logger.error("Update string:" + update_string)
 
+    def update_many(self, updates, event_times=None):
+        """
+        Applies updates to many submissions in a single transaction. Updates touching the same set of columns are
+        sent together with executemany.
+        :param updates: an iterable of (spuid, fields) tuples where fields is a dictionary of column names to values.
+        :param event_times: a dict of SPUID to the time its new status was set, for updates made before they are
+        written. Status changes of other submissions are logged at the time of writing.
+        :return: True if the updates were written.
+        """
+        batches = dict()
+        new_statuses = []
+        for spuid, fields in updates:
+            if not fields:
+                continue
+            columns, update_string = self.build_update(fields.keys())
+            values = [self.clean_value(fields[column]) for column in columns] + [str(spuid)]
+            batches.setdefault(update_string, []).append(values)
+            if 'submission_status' in fields:
+                new_statuses.append((spuid, values[columns.index('submission_status')]))
+        try:
+            with self.manager.transaction() as conn:
+                self.record_status_changes(conn, new_statuses, event_times)
+                for update_string, rows in batches.items():
+                    self.logger.debug("Attempting bulk update of " + str(len(rows)) + " rows:" + update_string)
+                    conn.executemany(update_string, rows)
+            self.logger.debug("Submission DB bulk update complete.")
+            return True
+        except sqlite3.OperationalError as e:
+            self.logger.error("Problem applying bulk update to database: " + str(e))
+            return False
+
+    def record_status_changes(self, conn, new_statuses, event_times=None):
+        """
+        Appends a submission_events row for every submission whose status is about to change. Must be called inside
+        the transaction that writes the new statuses so that the log and the submissions table never disagree.
+        :param conn: the connection holding the transaction.
+        :param new_statuses: a list of (spuid, new_status) tuples.
+        :param event_times: a dict of SPUID to the time its new status was set; the current time by default.
+        :return:
+        """
+        events = []
+        now = time.time()
+        event_times = event_times or dict()
+        for spuid, new_status in new_statuses:
+            row = conn.execute('''SELECT spuid, submission_status FROM submissions WHERE spuid=?''',
+                               (str(spuid),)).fetchone()
+            if row and row[1] != new_status:
+                events.append((row[0], row[1], new_status, event_times.get(str(spuid), now), self.host,
+                               os.getpid()))
+        if events:
+            conn.executemany('''INSERT INTO submission_events (spuid, old_status, new_status, event_time, host, pid)
+                                VALUES (?, ?, ?, ?, ?, ?)''', events)
+
+    def get_status_events(self, spuid):
+        """
+        Returns the status transition log of a submission, oldest first.
+        :param spuid: the SPUID number of the submission (without prefix).
+        :return: a list of (old_status, new_status, event_time, host, pid) tuples. event_time is in epoch seconds.
+        """
+        return self.manager.connection().execute('''SELECT old_status, new_status, event_time, host, pid
+                                                      FROM submission_events WHERE spuid=? ORDER BY event_id''',
+                                                   (str(spuid),)).fetchall()
+
+    def get_stage_durations(self, spuid):
+        """
+        Works out how long a submission spent in each status from its transition log.
+        :param spuid: the SPUID number of the submission (without prefix).
+        :return: a list of (status, started, seconds) tuples, oldest first. The current status is timed up to now.
+        """
+        events = self.get_status_events(spuid)
+        durations = []
+        for i, (old_status, new_status, event_time, host, pid) in enumerate(events):
+            if i + 1 < len(events):
+                ended = events[i + 1][2]
+            else:
+                ended = time.time()
+            durations.append((new_status, event_time, ended - event_time))
+        return durations
+
+    def get_stage_totals(self, since=None):
+        """
+        Sums the time all submissions spent in each completed status, to show where submission time goes.
+        :param since: optional epoch seconds; only stages entered at or after this time are counted.
+        :return: a dictionary of status to (count, total_seconds, mean_seconds).
+        """
+        query = '''SELECT spuid, new_status, event_time FROM submission_events'''
+        if since is not None:
+            query += ''' WHERE spuid IN (SELECT spuid FROM submission_events WHERE event_time >= ?)'''
+            params = (since,)
+        else:
+            params = ()
+        totals = dict()
+        previous = None
+        for spuid, new_status, event_time in self.manager.connection().execute(query + " ORDER BY spuid, event_id",
+                                                                               params):
+            if previous and previous[0] == spuid and (since is None or previous[2] >= since):
+                count, total = totals.get(previous[1], (0, 0.0))
+                totals[previous[1]] = (count + 1, total + event_time - previous[2])
+            previous = (spuid, new_status, event_time)
+        return dict((status, (count, total, total / count)) for status, (count, total) in totals.items())
+
+    def iter_submissions(self, status=None, exclude_status=None, since=None, until=None, spuid_range=None,
+                         page_size=None, archived=False):
+        """
+        Streams submissions in SPUID order, one page at a time, so that whole-table scans run in constant memory. Each
+        page is a separate keyset query, so no read transaction is held open between pages.
+        :param status: a status or list of statuses to include.
+        :param exclude_status: a status or list of statuses to leave out.
+        :param since: only submissions whose spuid_date is at or after this "%Y-%m-%d %H:%M:%S" string.
+        :param until: only submissions whose spuid_date is before this "%Y-%m-%d %H:%M:%S" string.
+        :param spuid_range: an inclusive (first, last) tuple of SPUID numbers.
+        :param page_size: rows fetched per query, c.db_page_size by default.
+        :param archived: stream the submissions archive instead of the live table.
+        :return: a generator of SubmissionRecord objects.
+        """
+        conditions = []
+        params = []
+        for column_filter, operator in ((status, "IN"), (exclude_status, "NOT IN")):
+            if column_filter is not None:
+                if isinstance(column_filter, basestring):
+                    column_filter = [column_filter]
+                conditions.append("submission_status " + operator + " (" + ", ".join("?" * len(column_filter)) + ")")
+                params.extend(column_filter)
+        if since is not None:
+            conditions.append("spuid_date >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("spuid_date < ?")
+            params.append(until)
+        if spuid_range is not None:
+            conditions.append("spuid BETWEEN ? AND ?")
+            params.extend([int(spuid_range[0]), int(spuid_range[-1])])
+        table = "submissions_archive" if archived else "submissions"
+        query = ("SELECT " + ", ".join(SubmissionRecord.__slots__) + " FROM " + table + " WHERE spuid > ?" +
+                 "".join(" AND " + condition for condition in conditions) + " ORDER BY spuid LIMIT ?")
+        page_size = page_size or c.db_page_size
+        self.logger.debug("Streaming submissions with query:" + query + " and parameters " + str(params))
+        last_spuid = -1
+        while True:
+            page = self.manager.connection().execute(query, [last_spuid] + params + [page_size]).fetchall()
+            for row in page:
+                yield SubmissionRecord(row)
+            if len(page) < page_size:
+                break
+            last_spuid = page[-1][0]
+
     def check_submission_exists(self, platform_unit):
         try:
-            conn = sqlite3.connect(self.db, timeout=c.global_db_timeout)
-            cursor = conn.cursor()
-            check_string = '''SELECT DISTINCT spuid, temp_path, submission_status FROM submissions WHERE platform_unit=\''''\
-                           + platform_unit + '''\''''
-            self.logger.debug("Query: " + check_string)
-            cursor.execute(check_string)
-            results = cursor.fetchall()
-            conn.close()
+            check_string = '''SELECT DISTINCT spuid, temp_path, submission_status FROM submissions WHERE platform_unit=?'''
+            self.logger.debug("Query: " + check_string + " with " + platform_unit)
+            conn = self.manager.connection()
+            results = conn.execute(check_string, (platform_unit,)).fetchall()
+            if not results:
+                results = conn.execute(check_string.replace("FROM submissions", "FROM submissions_archive"),
+                                       (platform_unit,)).fetchall()
             self.logger.debug("Check results: " + str(results))
             return results
 
         except sqlite3.OperationalError as e:
             self.logger.critical("Problem checking database for existing SPUID. Aborting submission." + str(e))
 
+    def check_submissions_exist(self, platform_units):
+        """
+        A batched check_submission_exists that looks up every platform unit of a batch with chunked IN queries.
+        :param platform_units: an iterable of platform units.
+        :return: a dictionary mapping each platform unit to its list of (spuid, temp_path, submission_status) rows,
+        which is empty for platform units that were never submitted.
+        """
+        results = dict((platform_unit, []) for platform_unit in platform_units)
+        try:
+            conn = self.manager.connection()
+            for table in ("submissions", "submissions_archive"):
+                # the archive is only consulted for platform units the hot table does not know
+                unique_units = [platform_unit for platform_unit in results if not results[platform_unit]]
+                for i in range(0, len(unique_units), c.db_max_variables):
+                    chunk = unique_units[i:i + c.db_max_variables]
+                    check_string = ('''SELECT DISTINCT platform_unit, spuid, temp_path, submission_status FROM '''
+                                    + table + ''' WHERE platform_unit IN (''' + ", ".join("?" * len(chunk)) + ''')''')
+                    for row in conn.execute(check_string, chunk):
+                        results[row[0]].append(tuple(row[1:]))
+            self.logger.debug("Batch check found previous submissions for " +
+                              str(len([pu for pu in results if results[pu]])) + " of " + str(len(results))
+                              + " platform units.")
+            return results
+        except sqlite3.OperationalError as e:
+            self.logger.critical("Problem checking database for existing SPUIDs. Aborting submission." + str(e))
+
     def get_previous_submission_info(self, read_file):
         try:
-            conn = sqlite3.connect(self.db, timeout=c.global_db_timeout)
-            cursor = conn.cursor()
-            check_string = '''SELECT DISTINCT spuid, temp_path, submission_status FROM submissions WHERE read_file=\''''\
-                           + read_file + '''\''''
-            cursor.execute(check_string)
-            results = cursor.fetchall()
-            conn.close()
+            check_string = '''SELECT DISTINCT spuid, temp_path, submission_status FROM submissions WHERE read_file=?'''
+            conn = self.manager.connection()
+            results = conn.execute(check_string, (read_file,)).fetchall()
+            if not results:
+                results = conn.execute(check_string.replace("FROM submissions", "FROM submissions_archive"),
+                                       (read_file,)).fetchall()
             prev_spuid = str(results[0][0])
             prev_temp = str(results[0][1])
             self.logger.debug("Previous SPUID " + prev_spuid + " found. Processing as resubmission.")
@@ -88,8 +475,300 @@ class SubmissionDBService(object):
         except sqlite3.OperationalError as e:
             self.logger.critical("Problem retrieving previous submission information. Aborting submission." + str(e))
 
+    def archive_submissions(self, max_age_days=None):
+        """
+        Moves terminal submissions that have not changed for max_age_days from the submissions table into
+        submissions_archive in one transaction, keeping the live table small.
+        :param max_age_days: minimum age in days, c.archive_after_days by default. Age is measured from the last
+        status change, or from spuid_date for submissions without a logged status change.
+        :return: the number of submissions archived.
+        """
+        if max_age_days is None:
+            max_age_days = c.archive_after_days
+        cutoff = time.time() - max_age_days * 86400
+        columns = ", ".join(SubmissionRecord.__slots__)
+        candidates = ('''SELECT spuid FROM submissions WHERE submission_status IN (''' +
+                      ", ".join("?" * len(c.terminal_states)) + ''') AND COALESCE(spuid_date, '') < ? AND
+                      COALESCE((SELECT MAX(event_time) FROM submission_events
+                                WHERE submission_events.spuid = submissions.spuid), 0) < ?''')
+        params = list(c.terminal_states) + [time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(cutoff)), cutoff]
+        try:
+            with self.manager.transaction() as conn:
+                conn.execute('''INSERT INTO submissions_archive (''' + columns + ''', archived_date)
+                                SELECT ''' + columns + ''', ? FROM submissions WHERE spuid IN (''' + candidates + ''')''',
+                             [time.strftime("%Y-%m-%d %H:%M:%S")] + params)
+                archived = conn.execute('''DELETE FROM submissions WHERE spuid IN (''' + candidates + ''')''',
+                                        params).rowcount
+            self.logger.info("Archived " + str(archived) + " terminal submissions older than " + str(max_age_days)
+                             + " days.")
+            return archived
+        except sqlite3.Error as e:
+            # the transaction has been rolled back, so nothing was moved
+            self.logger.error("Problem archiving submissions: " + str(e))
+            return 0
+
+    def restore_archived(self, spuid):
+        """
+        Moves an archived submission back into the submissions table so it can be worked on again.
+        :param spuid: the SPUID number of the submission (without prefix).
+        :return: True if the submission was in the archive.
+        """
+        columns = ", ".join(SubmissionRecord.__slots__)
+        with self.manager.transaction() as conn:
+            conn.execute('''INSERT INTO submissions (''' + columns + ''') SELECT ''' + columns +
+                         ''' FROM submissions_archive WHERE spuid=?''', (str(spuid),))
+            restored = conn.execute('''DELETE FROM submissions_archive WHERE spuid=?''', (str(spuid),)).rowcount
+        if restored:
+            self.logger.info("Restored SPUID " + str(spuid) + " from the submissions archive.")
+        return bool(restored)
+
     def reset_resub(self, spuid):
         self.logger.critical("Resetting DB data for resubmission of SPUID " + str(spuid))
+        self.restore_archived(spuid)
+        self.update_sub_fields(spuid, dict.fromkeys(c.reset_fields))
+
+
+_status_writers = weakref.WeakSet()
+
+
+def _close_status_writers():
+    for writer in list(_status_writers):
+        writer.close()
+
+
+atexit.register(_close_status_writers)
+
+
+class StatusWriter(object):
+    """
+    A write-behind buffer for high-churn submission updates. Pending values are coalesced per SPUID and column,
+    values equal to what is stored at flush time are dropped, and the rest are written in one transaction every
+    flush_interval seconds by a background thread. Statuses outside c.write_behind_states are written through at once,
+    and anything still pending is flushed when the writer is closed or the process exits.
+    """
+
+    def __init__(self, db, flush_interval=None, logger=None):
+        if logger:
+            self.logger = logging.getLogger(logger + '.submission_db.StatusWriter')
+        else:
+            self.logger = logging.getLogger('sra_tool.submission_db.StatusWriter')
+        self.dbs = SubmissionDBService(db, logger)
+        self.flush_interval = c.status_flush_interval if flush_interval is None else flush_interval
+        self._pending = dict()
+        self._status_times = dict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="StatusWriter")
+        self._thread.daemon = True
+        self._thread.start()
+        _status_writers.add(self)
+
+    def write(self, spuid, fields):
+        """
+        Queues an update of several columns of a submission. A status change is logged with the time it was queued,
+        not the time it is flushed.
+        :param spuid: the SPUID number of the submission (without prefix).
+        :param fields: a dictionary of column names to values.
+        :return:
+        """
+        with self._lock:
+            self._pending.setdefault(str(spuid), dict()).update(fields)
+            if 'submission_status' in fields:
+                self._status_times[str(spuid)] = time.time()
+        status = fields.get('submission_status')
+        if status is not None and status not in c.write_behind_states:
+            self.flush()
+
+    def _load(self, spuids):
+        """
+        Reads the stored values of submissions, without taking the write lock.
+        :param spuids: a list of SPUID numbers as strings.
+        :return: a dict of SPUID to a dict of column names to stored values as strings.
+        """
+        stored = dict()
+        conn = self.dbs.manager.connection()
+        for i in range(0, len(spuids), c.db_max_variables):
+            chunk = spuids[i:i + c.db_max_variables]
+            query = ('''SELECT ''' + ", ".join(SubmissionRecord.__slots__) + ''' FROM submissions WHERE spuid IN (''' +
+                     ", ".join("?" * len(chunk)) + ''')''')
+            for row in conn.execute(query, chunk).fetchall():
+                stored[str(row[0])] = dict((column, None if value is None else str(value))
+                                           for column, value in zip(SubmissionRecord.__slots__, row))
+        return stored
+
+    def flush(self):
+        """
+        Writes every pending update in a single transaction.
+        :return: the number of submissions written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, dict()
+                status_times, self._status_times = self._status_times, dict()
+            if not pending:
+                return 0
+            # compare against the database as it is now, so that writes made elsewhere since are never mistaken for
+            # values this writer already stored
+            stored = self._load(list(pending.keys()))
+            changes = dict()
+            for spuid, fields in pending.items():
+                changed = dict((column, value) for column, value in fields.items()
+                               if self.dbs.clean_value(value) != stored.get(spuid, dict()).get(column))
+                if changed:
+                    changes[spuid] = changed
+            if not changes:
+                return 0
+            if self.dbs.update_many(changes.items(), status_times):
+                self.logger.debug("Flushed pending updates for " + str(len(changes)) + " submissions.")
+                return len(changes)
+            with self._lock:
+                # keep failed updates for the next flush unless they have been superseded since
+                for spuid, fields in changes.items():
+                    newer = self._pending.setdefault(spuid, dict())
+                    if 'submission_status' in fields and 'submission_status' not in newer:
+                        self._status_times[spuid] = status_times[spuid]
+                    for column, value in fields.items():
+                        newer.setdefault(column, value)
+            return 0
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error("Background flush failed: " + str(e))
+
+    def close(self):
+        """
+        Stops the background thread and synchronously flushes anything still pending.
+        """
+        if not self._closed:
+            self._closed = True
+            self._wakeup.set()
+            self._thread.join()
+        self.flush()
+
+
+class JobQueue(object):
+    """
+    A lease-based work queue kept in the submission DB. Workers claim jobs for a limited time and must renew or
+    finish them before the lease expires; expired leases are handed to the next worker that asks.
+    """
+
+    def __init__(self, db, logger=None):
+        if logger:
+            self.logger = logging.getLogger(logger + '.submission_db.JobQueue')
+        else:
+            self.logger = logging.getLogger('sra_tool.submission_db.JobQueue')
+        self.db = db
+        self.manager = ConnectionManager.for_db(db)
+        db_schema.ensure_schema(self.manager)
+
+    def enqueue(self, spuid, payload=None):
+        """
+        Adds a job to the queue.
+        :param spuid: the SPUID number of the submission the job works on.
+        :param payload: a json-serializable object handed to the worker, e.g. the launch row.
+        :return: the new job id.
+        """
+        now = time.time()
+        with self.manager.transaction() as conn:
+            job_id = conn.execute('''INSERT INTO jobs (spuid, payload, state, created, updated)
+                                     VALUES (?, ?, 'queued', ?, ?)''', (spuid, json.dumps(payload), now, now)).lastrowid
+        self.logger.debug("Queued job " + str(job_id) + " for SPUID " + str(spuid))
+        return job_id
+
+    def claim_next(self, worker_id, n=1, lease_seconds=None):
+        """
+        Atomically leases up to n queued jobs, oldest first. Jobs whose lease expired are reclaimed, or failed once
+        they have used up c.job_max_attempts.
+        :param worker_id: a name unique to the claiming worker, e.g. host:pid.
+        :param n: the maximum number of jobs to claim.
+        :param lease_seconds: how long the worker holds the jobs, c.job_lease_seconds by default.
+        :return: a list of (job_id, spuid, payload, attempts) tuples.
+        """
+        if lease_seconds is None:
+            lease_seconds = c.job_lease_seconds
+        now = time.time()
+        with self.manager.transaction() as conn:
+            conn.execute('''UPDATE jobs SET state='failed', lease_owner=NULL, last_error='lease expired', updated=?
+                            WHERE state='leased' AND lease_expiry < ? AND attempts >= ?''',
+                         (now, now, c.job_max_attempts))
+            jobs = conn.execute('''SELECT job_id, spuid, payload, attempts FROM jobs
+                                   WHERE state='queued' OR (state='leased' AND lease_expiry < ?)
+                                   ORDER BY job_id LIMIT ?''', (now, n)).fetchall()
+            conn.executemany('''UPDATE jobs SET state='leased', lease_owner=?, lease_expiry=?,
+                                attempts=attempts + 1, updated=? WHERE job_id=?''',
+                             [(worker_id, now + lease_seconds, now, job[0]) for job in jobs])
+        if jobs:
+            self.logger.info(worker_id + " claimed jobs " + ", ".join(str(job[0]) for job in jobs))
+        return [(job_id, spuid, json.loads(payload), attempts + 1) for job_id, spuid, payload, attempts in jobs]
+
+    def renew_lease(self, job_id, worker_id, lease_seconds=None):
+        """
+        Extends a lease the worker still holds.
+        :return: False if the lease was lost to another worker, in which case the job must be abandoned.
+        """
+        if lease_seconds is None:
+            lease_seconds = c.job_lease_seconds
+        now = time.time()
+        with self.manager.transaction() as conn:
+            renewed = conn.execute('''UPDATE jobs SET lease_expiry=?, updated=?
+                                      WHERE job_id=? AND lease_owner=? AND state='leased' ''',
+                                   (now + lease_seconds, now, job_id, worker_id)).rowcount
+        if not renewed:
+            self.logger.warning(worker_id + " lost the lease on job " + str(job_id))
+        return bool(renewed)
+
+    def heartbeat(self, worker_id, lease_seconds=None):
+        """
+        Extends every lease the worker holds.
+        :return: the number of leases renewed.
+        """
+        if lease_seconds is None:
+            lease_seconds = c.job_lease_seconds
+        now = time.time()
+        with self.manager.transaction() as conn:
+            return conn.execute('''UPDATE jobs SET lease_expiry=?, updated=?
+                                   WHERE lease_owner=? AND state='leased' AND lease_expiry >= ?''',
+                                (now + lease_seconds, now, worker_id, now)).rowcount
+
+    def complete(self, job_id, worker_id):
+        """
+        Marks a leased job as done.
+        :return: False if the worker no longer held the lease.
+        """
+        return self._finish(job_id, worker_id, 'done', None)
+
+    def fail(self, job_id, worker_id, error=None, retry=True):
+        """
+        Releases a leased job after an error. It goes back on the queue unless retry is False or it has used up
+        c.job_max_attempts.
+        :return: False if the worker no longer held the lease.
+        """
+        with self.manager.transaction() as conn:
+            row = conn.execute('''SELECT attempts FROM jobs WHERE job_id=?''', (job_id,)).fetchone()
+            state = 'queued' if retry and row and row[0] < c.job_max_attempts else 'failed'
+            return self._finish(job_id, worker_id, state, error)
+
+    def _finish(self, job_id, worker_id, state, error):
+        with self.manager.transaction() as conn:
+            finished = conn.execute('''UPDATE jobs SET state=?, lease_owner=NULL, lease_expiry=NULL, last_error=?,
+                                       updated=? WHERE job_id=? AND lease_owner=? AND state='leased' ''',
+                                    (state, None if error is None else str(error), time.time(), job_id,
+                                     worker_id)).rowcount
+        if finished:
+            self.logger.info("Job " + str(job_id) + " " + state + " by " + worker_id)
+        else:
+            self.logger.warning(worker_id + " tried to finish job " + str(job_id) + " without holding its lease.")
+        return bool(finished)
 
-        for key in c.reset_fields:
-            self.update_sub_data(spuid, key, None)
\ No newline at end of file
+    def counts(self):
+        """
+        :return: a dict of job state to number of jobs.
+        """
+        return dict(self.manager.connection().execute('''SELECT state, COUNT(*) FROM jobs GROUP BY state'''))
@@ -0,0 +1,348 @@
+import SRA_submission_tool.constants as c
+import cStringIO
+import gzip
+import itertools
+import logging
+import multiprocessing
+import os
+import struct
+import zlib
+from SRA_submission_tool import bgzf
+from SRA_submission_tool.bam_stats import record_fields
+from SRA_submission_tool.resource_broker import ResourceBroker
+try:
+    import numpy
+except ImportError:
+    numpy = None
+__author__ = 'Amr Abouelleil'
+
+# Adapter and quality trimming of the 3' end of reads. The parent streams the read file in batches of whole records
+# and a process pool trims and recompresses each batch, so the output is written in one pass. Bases are compared as
+# BAM nibble codes whatever the input format; an adapter matches where it starts inside a read and the rest of the read
+# is a prefix of it, so adapters running off the end of a read are found as long as c.trim_min_overlap bases remain.
+
+nibble_bases = "=ACMGRSVTWYHKDBN"
+nibble_pairs = [chr(byte >> 4) + chr(byte & 0xf) for byte in range(256)]
+# FASTQ bases to nibble codes; anything that is not a base becomes N, which never matches an adapter base
+fastq_codes = "".join(chr(nibble_bases.index(chr(i).upper())) if chr(i).upper() in "ACGT" else "\x0f"
+                      for i in range(256))
+
+
+class TrimError(Exception):
+    """
+    Raised when a read file cannot be trimmed.
+    """
+    pass
+
+
+def read_adapters(trim_file):
+    """
+    Reads the adapter sequences from a trim file, one per line. FASTA headers, comments and blank lines are skipped.
+    :param trim_file: path to the trim file.
+    :return: a list of adapter sequences.
+    """
+    adapters = []
+    with open(trim_file) as handle:
+        for line in handle:
+            line = line.strip().upper()
+            if not line or line[0] in ">#":
+                continue
+            if line.strip("ACGT"):
+                raise TrimError(trim_file + " has a line that is not a DNA sequence: " + line)
+            adapters.append(line)
+    return adapters
+
+
+def encode_adapter(adapter):
+    """
+    :return: the adapter as a string of nibble codes.
+    """
+    return "".join(chr(nibble_bases.index(base)) for base in adapter)
+
+
+def adapter_cuts(reads, adapters, min_overlap):
+    """
+    Finds where each read's adapter starts.
+    :param reads: a list of reads as nibble code strings.
+    :param adapters: a list of encoded adapters.
+    :param min_overlap: the fewest adapter bases a read must end with to be cut.
+    :return: a list of cut positions, the length of the read where no adapter was found.
+    """
+    if numpy is not None and adapters and any(reads):
+        return _numpy_adapter_cuts(reads, adapters, min_overlap)
+    cuts = []
+    for read in reads:
+        cut = len(read)
+        for adapter in adapters:
+            for start in range(min(cut, len(read) - min_overlap + 1)):
+                if read[start:start + len(adapter)] == adapter[:len(read) - start]:
+                    cut = start
+                    break
+        cuts.append(cut)
+    return cuts
+
+
+def _numpy_adapter_cuts(reads, adapters, min_overlap):
+    # one row per read and one column per start position; each adapter base is compared against every start at once
+    lengths = numpy.array([len(read) for read in reads])
+    width = lengths.max()
+    longest = max(len(adapter) for adapter in adapters)
+    codes = numpy.zeros((len(reads), width + longest), dtype=numpy.uint8)
+    for row, read in enumerate(reads):
+        codes[row, :len(read)] = numpy.frombuffer(read, dtype=numpy.uint8)
+    starts = numpy.arange(width)
+    cuts = lengths.copy()
+    for adapter in adapters:
+        matches = starts[numpy.newaxis, :] <= (lengths - min_overlap)[:, numpy.newaxis]
+        for offset, code in enumerate(numpy.frombuffer(adapter, dtype=numpy.uint8)):
+            past_end = (starts + offset)[numpy.newaxis, :] >= lengths[:, numpy.newaxis]
+            matches &= (codes[:, offset:offset + width] == code) | past_end
+        found = matches.any(axis=1)
+        cuts = numpy.where(found, numpy.minimum(cuts, matches.argmax(axis=1)), cuts)
+    return [int(cut) for cut in cuts]
+
+
+def quality_cut(qualities, cutoff, offset=0):
+    """
+    Finds where to cut the low quality 3' end of a read, the way BWA does: the cut maximises the sum of cutoff minus the
+    base qualities over the bases removed.
+    :param qualities: the base qualities as a string.
+    :param cutoff: the Phred quality cutoff.
+    :param offset: what to subtract from each character to get its Phred quality, 33 for FASTQ.
+    :return: the cut position, the length of the read if nothing should be cut.
+    """
+    cut = len(qualities)
+    total = best = 0
+    for position in range(len(qualities) - 1, -1, -1):
+        total += cutoff - (ord(qualities[position]) - offset)
+        if total < 0:
+            break
+        if total > best:
+            best = total
+            cut = position
+    return cut
+
+
+def trim_points(reads, qualities, settings, offset):
+    """
+    :param reads: a list of reads as nibble code strings.
+    :param qualities: the reads' base qualities, in the same order.
+    :param settings: an (adapters, min_overlap, quality_cutoff, min_length) tuple.
+    :param offset: the quality offset, see quality_cut.
+    :return: a list of the lengths to trim the reads to.
+    """
+    adapters, min_overlap, quality_cutoff, min_length = settings
+    cuts = adapter_cuts(reads, adapters, min_overlap)
+    if quality_cutoff:
+        cuts = [min(cut, quality_cut(quality[:cut], quality_cutoff, offset)) for cut, quality in zip(cuts, qualities)]
+    # reads are shortened, never dropped, so mates stay paired and no read is left empty
+    return [max(cut, min(min_length, len(read))) for cut, read in zip(cuts, reads)]
+
+
+def trim_bam_batch(task):
+    """
+    Pool worker that trims a batch of BAM alignment records. Only unmapped records on the forward strand are trimmed;
+    cutting the bases of an aligned record would invalidate its cigar.
+    :param task: a (data, settings) tuple, data being whole records and settings as for trim_points.
+    :return: a (blocks, reads_trimmed, bases_trimmed) tuple, blocks being the trimmed records as BGZF blocks.
+    """
+    data, settings = task
+    records = []
+    position = 0
+    while position < len(data):
+        fields = record_fields.unpack_from(data, position)
+        records.append((position, fields))
+        position += fields[0] + 4
+    trimmable = [(start, fields) for start, fields in records if fields[7] & 0x14 == 0x4 and fields[8]]
+    reads = []
+    qualities = []
+    for start, fields in trimmable:
+        seq_start = start + record_fields.size + fields[3] + 4 * fields[6]
+        packed_length = (fields[8] + 1) // 2
+        reads.append("".join(nibble_pairs[ord(byte)] for byte in data[seq_start:seq_start + packed_length])[
+            :fields[8]])
+        qualities.append(data[seq_start + packed_length:seq_start + packed_length + fields[8]])
+    cuts = dict((start, cut) for (start, fields), cut in zip(trimmable, trim_points(reads, qualities, settings, 0)))
+    output = []
+    reads_trimmed = bases_trimmed = 0
+    for start, fields in records:
+        end = start + fields[0] + 4
+        cut = cuts.get(start, fields[8])
+        if cut == fields[8]:
+            output.append(data[start:end])
+            continue
+        reads_trimmed += 1
+        bases_trimmed += fields[8] - cut
+        seq_start = start + record_fields.size + fields[3] + 4 * fields[6]
+        packed_length = (fields[8] + 1) // 2
+        seq = data[seq_start:seq_start + (cut + 1) // 2]
+        if cut % 2:
+            seq = seq[:-1] + chr(ord(seq[-1]) & 0xf0)
+        tags = data[seq_start + packed_length + fields[8]:end]
+        block_size = fields[0] - (packed_length - len(seq)) - (fields[8] - cut)
+        output.append(record_fields.pack(block_size, *(fields[1:8] + (cut,) + fields[9:])) +
+                      data[start + record_fields.size:seq_start] + seq +
+                      data[seq_start + packed_length:seq_start + packed_length + cut] + tags)
+    blocks = cStringIO.StringIO()
+    bgzf.write_blocks(blocks, "".join(output))
+    return blocks.getvalue(), reads_trimmed, bases_trimmed
+
+
+def trim_fastq_batch(task):
+    """
+    Pool worker that trims a batch of FASTQ records.
+    :param task: a (data, settings, compress) tuple, data being whole four-line records, settings as for trim_points
+    and compress whether to return the output as a gzip member.
+    :return: a (data, reads_trimmed, bases_trimmed) tuple.
+    """
+    data, settings, compress = task
+    lines = data.split("\n")[:-1]
+    sequences = lines[1::4]
+    qualities = lines[3::4]
+    cuts = trim_points([sequence.translate(fastq_codes) for sequence in sequences], qualities, settings, 33)
+    reads_trimmed = bases_trimmed = 0
+    for record, (sequence, cut) in enumerate(zip(sequences, cuts)):
+        if cut < len(sequence):
+            reads_trimmed += 1
+            bases_trimmed += len(sequence) - cut
+            lines[4 * record + 1] = sequence[:cut]
+            lines[4 * record + 3] = qualities[record][:cut]
+    output = "\n".join(lines) + "\n"
+    if compress:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        output = compressor.compress(output) + compressor.flush()
+    return output, reads_trimmed, bases_trimmed
+
+
+def bam_batches(reader, batch_size):
+    """
+    Reads the alignment records of a bam in batches of whole records.
+    :param reader: a BgzfReader positioned at the first record.
+    :param batch_size: inflated bytes read per batch; a batch can be larger to finish its last record.
+    :return: a generator of strings of whole records.
+    """
+    pending = ""
+    while True:
+        data = reader.read(batch_size)
+        pending += data
+        end = 0
+        while end + 4 <= len(pending):
+            size = struct.unpack_from("<i", pending, end)[0] + 4
+            if end + size > len(pending):
+                break
+            end += size
+        if end:
+            yield pending[:end]
+            pending = pending[end:]
+        if not data:
+            if pending:
+                raise bgzf.BgzfError(reader.path + " ends inside an alignment record.")
+            return
+
+
+def fastq_batches(handle, batch_reads, path):
+    """
+    Reads a FASTQ file in batches of whole four-line records.
+    :param handle: the open FASTQ file.
+    :param batch_reads: records per batch.
+    :param path: the path of the file, for errors.
+    :return: a generator of strings of whole records.
+    """
+    while True:
+        lines = list(itertools.islice(handle, 4 * batch_reads))
+        if not lines:
+            return
+        if len(lines) % 4:
+            raise TrimError(path + " ends inside a FASTQ record.")
+        if not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+        if not lines[0].startswith("@"):
+            raise TrimError(path + " is not a FASTQ file.")
+        yield "".join(lines)
+
+
+class TrimService(object):
+    """
+    A class for trimming adapters and low quality ends from the reads of a bam or FASTQ file.
+    """
+    def __init__(self, trim_file, processes=None):
+        """
+        :param trim_file: path to the file of adapter sequences, see read_adapters.
+        :param processes: the most processes to trim with. Defaults to c.trim_processes, or every core if that is None.
+        The resource broker may grant fewer.
+        """
+        self.logger = logging.getLogger('sra_tool.trim_service.TrimService')
+        self.adapters = read_adapters(trim_file)
+        self.processes = processes or c.trim_processes or multiprocessing.cpu_count()
+        self.settings = ([encode_adapter(adapter) for adapter in self.adapters], c.trim_min_overlap,
+                         c.trim_quality_cutoff, c.trim_min_length)
+        self.logger.info("Loaded " + str(len(self.adapters)) + " adapters from " + trim_file)
+
+    def trim(self, read_file, output_dir):
+        """
+        Trims a read file into output_dir. The output is written under a temporary name and renamed when complete, so
+        it can replace a file of the same name, such as a screened bam, that is being read.
+        :param read_file: a bam, or a FASTQ file optionally gzipped.
+        :param output_dir: the directory to write the trimmed file to.
+        :return: a (path, stats) tuple, path being the trimmed file in output_dir, named like read_file, and stats a
+        dictionary of trimmed_reads and trimmed_bases.
+        """
+        name = read_file.split("/")[-1]
+        target = output_dir + "/" + name
+        partial = target + ".trimming"
+        fastq_name = name[:-3] if name.endswith(".gz") else name
+        if not name.endswith(".bam") and fastq_name.split(".")[-1] not in ["fastq", "fq"]:
+            raise TrimError("Cannot trim " + read_file + ": only bam and FASTQ files are supported.")
+        stats = {'trimmed_reads': 0, 'trimmed_bases': 0}
+        with ResourceBroker().acquire(cpus=self.processes, memory_mb=c.trim_memory_mb, min_cpus=1,
+                                      label="trim " + read_file) as grant:
+            pool = multiprocessing.Pool(grant.cpus) if grant.cpus > 1 else None
+            try:
+                with open(partial, 'wb') as target_handle:
+                    if name.endswith(".bam"):
+                        self.trim_bam(read_file, target_handle, pool, grant.cpus, stats)
+                    else:
+                        self.trim_fastq(read_file, target_handle, pool, grant.cpus, stats)
+                os.rename(partial, target)
+            except:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+            finally:
+                if pool:
+                    pool.close()
+                    pool.join()
+        self.logger.info("Trimmed " + read_file + " into " + target + ": " + str(stats))
+        return target, stats
+
+    def trim_bam(self, read_file, target_handle, pool, processes, stats):
+        with bgzf.BgzfReader(read_file) as reader:
+            header = bgzf.read_bam_header(reader)
+            bgzf.write_blocks(target_handle, bgzf.encode_bam_header(*header))
+            tasks = ((batch, self.settings) for batch in bam_batches(reader, c.trim_batch_size))
+            self.run_batches(trim_bam_batch, tasks, target_handle, pool, processes, stats)
+        target_handle.write(bgzf.eof_block)
+
+    def trim_fastq(self, read_file, target_handle, pool, processes, stats):
+        compress = read_file.endswith(".gz")
+        handle = gzip.open(read_file, 'rb') if compress else open(read_file, 'rb')
+        try:
+            tasks = ((batch, self.settings, compress) for batch in fastq_batches(handle, c.trim_batch_reads,
+                                                                                read_file))
+            self.run_batches(trim_fastq_batch, tasks, target_handle, pool, processes, stats)
+        finally:
+            handle.close()
+
+    def run_batches(self, worker, tasks, target_handle, pool, processes, stats):
+        """
+        Runs a worker over the batches and writes the results in order. Batches are handed out a few per process at a
+        time, so only that many are ever held in memory.
+        """
+        while True:
+            window = list(itertools.islice(tasks, 2 * processes))
+            if not window:
+                return
+            for output, reads_trimmed, bases_trimmed in (pool.map(worker, window) if pool else map(worker, window)):
+                target_handle.write(output)
+                stats['trimmed_reads'] += reads_trimmed
+                stats['trimmed_bases'] += bases_trimmed
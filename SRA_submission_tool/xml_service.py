@@ -13,6 +13,9 @@ import logging
 import csv
 from submission_db import SubmissionDBService
 from SRA_submission_tool.file_service import PacBioService
+from SRA_submission_tool.checksum_service import ChecksumService
+from SRA_submission_tool.bam_stats import BamStatistics
+from SRA_submission_tool.bgzf import BgzfError
 
 
 class XmlCreator(object):
@@ -60,7 +63,7 @@ class XmlCreator(object):
             xml_dict['library_selection_method'] = selection_method
         xml_dict['library_protocol'] = construct_protocol
         file_list = [read_file, ref]
-        xml_dict['file_block'] = self.generate_file_block(file_list)
+        xml_dict['file_block'] = self.generate_file_block(file_list, self.get_checksums(file_list))
         os.symlink(ref, temp_path + "/" + ref.split('/')[-1])
         src.safe_substitute(xml_dict)
         self.write_xml_file(xml_dict, temp_path)
@@ -98,6 +101,7 @@ class XmlCreator(object):
         attributes['library_construction_protocol'] = construction_protocol
         attributes['library_selection'] = selection_method
         attributes['library_source'] = library_source
+        attributes.update(self.get_read_statistics(read_file))
         if additional_attributes and ":" in additional_attributes:
             att_list = additional_attributes.split('|')
             for att in att_list:
@@ -113,16 +117,34 @@ class XmlCreator(object):
         self.logger.debug('File record generated' + str(file_dict))
         return file_dict
 
-    def generate_file_block(self, file_list):
+    def get_checksums(self, file_list):
+        """
+        Checksums the files of a submission for the file block.
+        :param file_list: full paths of the files.
+        :return: a dictionary of file name (as it appears in the file block) to md5.
+        """
+        checksums = ChecksumService().get_checksums([f for f in file_list if f and os.path.isfile(f)])
+        return dict((f.split("/")[-1], checksum) for f, checksum in checksums.items())
+
+    def generate_file_block(self, file_list, checksums=None):
+        """
+        Generates the File elements of the submission xml.
+        :param file_list: the files of the submission.
+        :param checksums: an optional dictionary of file name to md5, added as each File's md5 attribute.
+        :return: the block as a string.
+        """
         self.logger.debug("File block generator received file list:" + str(file_list))
         block = ""
-        template_string = "      <File file_path=\"$file_name\">\n        <DataType>$file_data_type</DataType>\n      </File>"
+        template_string = "      <File file_path=\"$file_name\"$md5_attribute>\n        <DataType>$file_data_type</DataType>\n      </File>"
         src = Template(template_string)
         count = 0
         for f in file_list:
             file_dict = self.generate_file_record(f.split("/")[-1], "generic-data")
             if self.generate_file_record(f.split("/")[-1], "generic-data")['file_name'] == '.':
                 continue #skip the file block if file name is empty
+            file_dict['md5_attribute'] = ""
+            if checksums and file_dict['file_name'] in checksums:
+                file_dict['md5_attribute'] = " md5=\"" + checksums[file_dict['file_name']] + "\""
             file_string = src.safe_substitute(file_dict)
             count += 1
             if count == len(file_list):
@@ -132,6 +154,23 @@ class XmlCreator(object):
         self.logger.debug("File block generated with following values" + str(file_list))
         return block
 
+    def get_read_statistics(self, read_file):
+        """
+        Gets the read statistics of a bam for the attributes block.
+        :param read_file: path to the read file.
+        :return: a dictionary of read_count, base_count and mean_read_length, empty if the file is not a bam, the
+        statistics are turned off, or the bam could not be read.
+        """
+        if not c.bam_stats_attributes or not read_file.endswith(".bam"):
+            return dict()
+        try:
+            stats = BamStatistics().get_stats(read_file)
+        except (BgzfError, IOError, OSError) as e:
+            self.logger.warning("Could not compute read statistics for " + read_file + ": " + str(e))
+            return dict()
+        return {'read_count': stats['reads'], 'base_count': stats['bases'],
+                'mean_read_length': stats['mean_read_length']}
+
     def generate_attribute(self, key, value):
         attribute_dict = {'attribute_name': key, 'attribute_value': value}
         self.logger.debug('Attribute generated:' + str(attribute_dict))
@@ -307,23 +346,28 @@ class XmlCreator(object):
         if 'PacBio_HDF5' in file_type:
             pbs = PacBioService()
             pb_files = pbs.get_pacbio_files_data(xml_dict['read_file'])['file_list']
+            checksum_files = list(pb_files)
             xml_dict['file_list'] = []
             for f in pb_files:
                 self.logger.debug("Adding to file list:" + f.split('/')[-1])
                 xml_dict['file_list'].append(f.split('/')[-1])
         else:
             xml_dict['file_list'] = [xml_dict['read_file']]
+            checksum_files = [xml_dict['read_file']]
             xml_dict.update(self.get_file_information(xml_dict['read_file']))
+            for key, value in self.get_read_statistics(xml_dict['read_file']).items():
+                attributes.setdefault(key, value)
         if xml_dict['reference_file']:
             self.logger.info('reference file found:' + xml_dict['reference_file'])
             if not os.path.exists(xml_dict['reference_file']):	    
                 os.symlink(xml_dict['reference_file'], temp_path + "/" + xml_dict['reference_file'].split('/')[-1])
             xml_dict['file_list'].append(xml_dict['reference_file'])
+            checksum_files.append(xml_dict['reference_file'])
         else:
             self.logger.info('no reference file found.')
         self.logger.debug('file_list:' + ", ".join(xml_dict['file_list']))
 
-        xml_dict['file_block'] = self.generate_file_block(xml_dict['file_list'])
+        xml_dict['file_block'] = self.generate_file_block(xml_dict['file_list'], self.get_checksums(checksum_files))
         xml_dict['attributes_block'] = self.generate_attributes_block(attributes)
         xml_file = self.write_xml_file(xml_dict, temp_path)
         return xml_file
@@ -5,6 +5,7 @@ import sys
 import logging
 import xml.etree.ElementTree as ET
 from SRA_submission_tool.submission_db import SubmissionDBService
+from SRA_submission_tool import db_schema
 import SRA_submission_tool.constants as c
 import sqlite3
 from SRA_submission_tool.transfer_service import AsperaTransfer
@@ -22,6 +23,10 @@ parser.add_argument('-A', '--update_all', action='store_true', help='Crawl submi
 parser.add_argument('-b', '--update_batch', action='store', help='update a comma-sep list of spuids.')
 parser.add_argument('-R', '--update_range', action='store', help='updated a range of spuids(sep with hyphen.)')
 parser.add_argument('-D', '--database', action='store', help="Path to db file.", default=c.submission_db)
+parser.add_argument('-X', '--archive', action='store', type=int, nargs='?', const=c.archive_after_days,
+                    help='Move terminal submissions older than this many days into the archive table.')
+parser.add_argument('-U', '--dedupe', action='store_true',
+                    help='Resolve submissions sharing a platform unit so that platform units can be enforced unique.')
 
 
 def update_by_report(report, database):
@@ -30,35 +35,28 @@ def update_by_report(report, database):
     if root.attrib['status'] == 'processed-ok':
         update_dict = {'submission_status': root.attrib['status'], 'accession': root[0][0][0].attrib['accession']}
     spuid_number = root[0][0][0].attrib['spuid'].split('_')[1]
-    for k, v in update_dict.items():
-        try:
-            database.update_sub_data(spuid=spuid_number,
-                                column_id=k, column_value=v)
-        except KeyError as e:
-            print "Unable to update " + str(k) + ":" + str(v) + "." + str(e)
+    database.update_sub_fields(spuid_number, update_dict)
 
 
-def update_by_spuid(spuid_list, kv_pairs, database):
+def parse_kv_pairs(kv_pairs):
+    update_dict = dict()
     for kv_pair in kv_pairs:
-        k = kv_pair.split(':')[0]
-        v = kv_pair.split(':')[1]
-        for spuid_number in spuid_list:
-            try:
-                database.update_sub_data(spuid=spuid_number, column_id=k, column_value=v)
-            except KeyError as e:
-                print "Unable to update " + str(k) + ":" + str(v) + "." + str(e)
+        update_dict[kv_pair.split(':')[0]] = kv_pair.split(':')[1]
+    return update_dict
+
+
+def update_by_spuid(spuid_list, kv_pairs, database):
+    update_dict = parse_kv_pairs(kv_pairs)
+    database.update_many([(spuid_number, update_dict) for spuid_number in spuid_list])
 
 
 def update_all(db, kv_update=None):
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-    cursor.execute("SELECT spuid, temp_path, submission_status FROM submissions WHERE submission_status <> 'processed-ok'")
-    table = cursor.fetchall()
-    for row in table:
-        if "abandoned" not in row[2]:
-            t = threading.Thread(target=update_one(spuid_suffix=row[0], dest=row[1] + "/", db=db, kv_update=kv_update))
+    dbs = SubmissionDBService(db)
+    for record in dbs.iter_submissions(exclude_status='processed-ok'):
+        if record.submission_status and "abandoned" not in record.submission_status:
+            t = threading.Thread(target=update_one(spuid_suffix=record.spuid, dest=str(record.temp_path) + "/", db=db,
+                                                   kv_update=kv_update))
             t.start()
-    conn.close()
 
 
 def update_batch(db, list, kv_update=None):
@@ -75,28 +73,19 @@ def update_batch(db, list, kv_update=None):
 
 def update_range(db, list, kv_update=None):
     list_split = list.split("-")
-    conn = sqlite3.connect(db)
-    for spuid in range(int(list_split[0]), int(list_split[-1]) + 1):
-        cursor = conn.cursor()
-        cursor.execute("SELECT spuid, temp_path, submission_status FROM submissions WHERE spuid=" + str(spuid))
-        row = cursor.fetchall()
-        t = threading.Thread(target=update_one(spuid_suffix=row[0][0], dest=row[0][1] + "/", db=db, kv_update=kv_update))
+    dbs = SubmissionDBService(db)
+    for record in dbs.iter_submissions(spuid_range=(list_split[0], list_split[-1])):
+        t = threading.Thread(target=update_one(spuid_suffix=record.spuid, dest=str(record.temp_path) + "/", db=db,
+                                               kv_update=kv_update))
         t.start()
-    conn.close()
 
 
 def update_one(spuid_suffix, dest, db, kv_update=None):
     print("\n---Checking BI_" + str(spuid_suffix) + "---")
     dbs = SubmissionDBService(db)
     if kv_update:
-        for kv_pair in kv_update:
-            k = kv_pair.split(':')[0]
-            v = kv_pair.split(':')[1]
-            try:
-                print ("Updating SPUID " + str(spuid_suffix))
-                dbs.update_sub_data(spuid=spuid_suffix, column_id=k, column_value=v)
-            except KeyError as e:
-                print "Unable to update " + str(k) + ":" + str(v) + "." + str(e)
+        print ("Updating SPUID " + str(spuid_suffix))
+        dbs.update_sub_fields(spuid_suffix, parse_kv_pairs(kv_update))
     else:
         if not os.path.exists(dest):
             os.mkdir(dest, 0777)
@@ -120,12 +109,7 @@ def update_one(spuid_suffix, dest, db, kv_update=None):
                 except KeyError as e:
                     print("Unable to assign response message. Assigning none value." + str(e))
                     update_dict['response_message'] = "None"
-                for k, v in update_dict.items():
-                    try:
-                        dbs.update_sub_data(spuid=spuid_suffix,
-                                            column_id=k, column_value=v)
-                    except KeyError as e:
-                        print("Unable to update " + str(k) + ":" + str(v) + "." + str(e))
+                dbs.update_sub_fields(spuid_suffix, update_dict)
                 print("Processing failed with status processed-error. Submission DB updated.")
             elif root.attrib['status'] == 'processed-ok':
                 update_dict = {'ncbi_submission_id': root.attrib['submission_id'],
@@ -144,35 +128,23 @@ def update_one(spuid_suffix, dest, db, kv_update=None):
                     update_dict['accession'] = root[0][0][0].attrib['accession']
                 except KeyError as e:
                     print("Unable to assign accession number. Assigning none value." + str(e))
-                    update_dict['accession_number'] = "None"
-                for k, v in update_dict.items():
-                    try:
-                        dbs.update_sub_data(spuid=spuid_suffix,
-                                            column_id=k, column_value=v)
-                    except KeyError as e:
-                        print("Unable to update " + str(k) + ":" + str(v) + "." + str(e))
+                    update_dict['accession'] = "None"
+                dbs.update_sub_fields(spuid_suffix, update_dict)
                 print("Processing completed with status processed-ok. Submission DB updated.")
             elif root.attrib['status'] == 'failed':
-                dbs.update_sub_data(spuid=spuid_suffix,
-                                    column_id='submission_status', column_value=root.attrib['status'])
-                dbs.update_sub_data(spuid=spuid_suffix,
-                                    column_id='response_severity', column_value=root[0].attrib['severity'])
-                dbs.update_sub_data(spuid=spuid_suffix,
-                                    column_id='response_message', column_value=root[0].text)
+                dbs.update_sub_fields(spuid_suffix, {'submission_status': root.attrib['status'],
+                                                     'response_severity': root[0].attrib['severity'],
+                                                     'response_message': root[0].text})
                 print("NCBI returned submission 'failed' status for SPUID " + str(spuid_suffix))
 
             elif root.attrib['status'] == 'processing' or root.attrib['status'] == 'submitted':
-                dbs.update_sub_data(spuid=spuid_suffix,
-                                    column_id='submission_status', column_value=root.attrib['status'])
+                update_dict = {'submission_status': root.attrib['status']}
                 try:
-                    dbs.update_sub_data(spuid=spuid_suffix,
-                                        column_id='ncbi_submission_id',
-                                        column_value=root.attrib['submission_id'])
+                    update_dict['ncbi_submission_id'] = root.attrib['submission_id']
                 except KeyError as e:
                     print("No submission_id assigned yet." + str(e))
-                    dbs.update_sub_data(spuid=spuid_suffix,
-                                        column_id='ncbi_submission_id',
-                                        column_value='')
+                    update_dict['ncbi_submission_id'] = ''
+                dbs.update_sub_fields(spuid_suffix, update_dict)
 
 
 def main():
@@ -189,6 +161,12 @@ def main():
         update_batch(c.submission_db, args_dict['update_batch'], args_dict['key_value_pair'])
     elif args_dict['update_range']:
         update_range(c.submission_db, args_dict['update_range'], args_dict['key_value_pair'])
+    if args_dict['archive'] is not None:
+        dbs.archive_submissions(args_dict['archive'])
+    if args_dict['dedupe']:
+        for platform_unit, kept, cleared in db_schema.dedupe_platform_units(dbs.manager):
+            print("Platform unit " + platform_unit + " kept by SPUID " + str(kept) + ", cleared from SPUIDs " +
+                  ", ".join(str(spuid) for spuid in cleared))
 
 if __name__ == "__main__":
     sys.exit(main())
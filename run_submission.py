@@ -8,7 +8,7 @@ import logging
 import SRA_submission_tool.constants as c
 from SRA_submission_tool.zamboni_service import Zamboni
 from SRA_submission_tool.process_handler import ProcessHandler
-from SRA_submission_tool.file_service import BamParser
+from SRA_submission_tool.file_service import BamParser, BamValidator
 from SRA_submission_tool import LevelFilter
 import csv
 import getpass
@@ -47,7 +47,7 @@ prod_single_cmd.add_argument("-H", '--host_screen', action="store_true", default
 prod_single_cmd.add_argument("-F", '--force', action="store_true", default=False,
                              help='Resubmit previously submitted data even if it was successfully submitted before.')
 prod_single_cmd.add_argument('-D', '--dry_run', action="store_true", help=argparse.SUPPRESS)
-prod_single_cmd.add_argument('-T', '--trim', action="store", help="Path to sequence file for trimming.", default="trim.seq")
+prod_single_cmd.add_argument('-T', '--trim', action="store", help="Path to sequence file for trimming.", default=c.default_trim_file)
 
 
 batch_cmd = sub.add_parser("prod_batch", description='Submit a batch of production files to the SRA.',
@@ -63,8 +63,10 @@ batch_cmd.add_argument("-H", '--host_screen', action="store_true", default=False
 batch_cmd.add_argument("-F", '--force', action="store_true", default=False,
                              help='Resubmit running or previously '
                                   'submitted data even if it was successfully submitted before.')
+batch_cmd.add_argument('-V', '--prevalidate', action="store_true", default=False,
+                       help='Validate every bam file of the batch before anything is sent to Zamboni.')
 batch_cmd.add_argument('-D', '--dry_run', action="store_true", help=argparse.SUPPRESS)
-batch_cmd.add_argument('-T', '--trim', action="store", help="Path to sequence file for trimming.", default="trim.seq")
+batch_cmd.add_argument('-T', '--trim', action="store", help="Path to sequence file for trimming.", default=c.default_trim_file)
 
 manual_cmd = sub.add_parser("manual", description='Submit one or more data files to the SRA while providing all XML '
                                                   'data via CSV file. Use for files with no metadata in databases.',
@@ -80,7 +82,69 @@ manual_cmd.add_argument('-n', '--notification_email', dest='notificationEmailAdd
                         default=getpass.getuser() + "@broadinstitute.org",
                         help='email address to send notifications to.')
 manual_cmd.add_argument('-D', '--dry_run', action="store_true", help=argparse.SUPPRESS)
-manual_cmd.add_argument('-T', '--trim', action="store", help="Path to sequence file for trimming.", default="trim.seq")
+manual_cmd.add_argument('-T', '--trim', action="store", help="Path to sequence file for trimming.", default=c.default_trim_file)
+
+
+def reserve_new_submissions(sdb, new_rows):
+    """
+    Reserves SPUIDs for every new submission of a batch and creates their temp dirs. Platform units are claimed
+    atomically, so launchers running in parallel never create two submissions for the same one.
+    :param sdb: the SubmissionDBService to use.
+    :param new_rows: a list of (row, platform_unit) tuples. Rows get their spuid and temp_dir filled in; rows with a
+    platform_unit of None get a new SPUID without one.
+    :return: the rows whose platform unit was claimed by another launcher in the meantime or by an earlier row of the
+    batch. They must not be launched.
+    """
+    logger = logging.getLogger('run_submission')
+    keyed_rows = [(row, platform_unit) for row, platform_unit in new_rows if platform_unit is not None]
+    unkeyed_rows = [row for row, platform_unit in new_rows if platform_unit is None]
+    submissions = sdb.get_or_create_submissions([(platform_unit, row['read_file']) for row, platform_unit in keyed_rows])
+    lost_rows = []
+    claimed_units = set()
+    for row, platform_unit in keyed_rows:
+        spuid, temp_path, status, created = submissions[platform_unit]
+        if platform_unit in claimed_units:
+            logger.critical(row['read_file'] + " has the same platform unit as an earlier row of this batch. Skipping.")
+            lost_rows.append(row)
+            continue
+        if not created:
+            logger.critical(row['read_file'] + " was claimed as SPUID " + spuid + " by another launch. Skipping.")
+            lost_rows.append(row)
+            continue
+        claimed_units.add(platform_unit)
+        row['spuid'] = spuid
+        row['temp_dir'] = temp_path
+        os.mkdir(row['temp_dir'], 0777)
+    spuids = sdb.reserve_spuids([row['read_file'] for row in unkeyed_rows])
+    updates = []
+    for row, spuid in zip(unkeyed_rows, spuids):
+        row['spuid'] = spuid
+        row['temp_dir'] = c.temp_root + c.spuid_prefix + str(spuid)
+        updates.append((spuid, {'temp_path': row['temp_dir']}))
+        os.mkdir(row['temp_dir'], 0777)
+    sdb.update_many(updates)
+    return lost_rows
+
+
+def prevalidate_rows(sdb, rows):
+    """
+    Validates the read files of a batch before launch. Rows whose files fail validation are marked and dropped; the
+    verdicts of the others are cached for the workers.
+    :param sdb: the SubmissionDBService to use.
+    :param rows: the launch rows of the batch.
+    :return: the rows that may be launched.
+    """
+    logger = logging.getLogger('run_submission')
+    verdicts = BamValidator().validate_bams([row['read_file'] for row in rows])
+    valid_rows = []
+    for row in rows:
+        valid, first_error = verdicts[row['read_file']]
+        if valid is False:
+            logger.critical(row['read_file'] + " failed validation and will not be submitted: " + str(first_error))
+            sdb.update_sub_data(row['spuid'], 'submission_status', 'not validated')
+        else:
+            valid_rows.append(row)
+    return valid_rows
 
 
 def main():
@@ -102,6 +166,10 @@ def main():
     run_logger.info("\n=========RUN SUBMISSION LOG RECORD BEGIN=========")
     run_logger.debug('Processing Mode: ' + mode)
     args_dict = vars(parser.parse_args())
+    if args_dict.get('trim'):
+        # workers run from another directory; only a trim file the user named must exist
+        args_dict['trim_required'] = args_dict['trim'] != c.default_trim_file
+        args_dict['trim'] = os.path.abspath(args_dict['trim'])
     run_logger.debug('Run Submission Arguments: ' + str(args_dict))
     zamboni = Zamboni()
     ph = ProcessHandler()
@@ -115,7 +183,7 @@ def main():
                 zamboni.disconnect()
                 sys.exit(-1)
             # check to see if this is a resubmission, if it is, use the same temp dir as what's stored in the database.
-            header_dict = bp.parse_header(bam_file=['read_file'])
+            header_dict = bp.parse_header(bam_file=args_dict['read_file'])
             prev_sub_data_info = sdb.check_submission_exists(platform_unit=header_dict['PU'])
             if len(prev_sub_data_info) == 1:
                 if prev_sub_data_info[0][1] and prev_sub_data_info[0][2]:
@@ -154,11 +222,17 @@ def main():
             else:
                 run_logger.info(args_dict['read_file']
                                 + " never submitted. Processing as new submission.")
-                args_dict['spuid'] = sdb.get_new_spuid(args_dict['read_file'])
-                args_dict['temp_dir'] = c.temp_root + c.spuid_prefix + str(args_dict['spuid'])
+                spuid, temp_path, status, created = sdb.get_or_create_submission(header_dict['PU'],
+                                                                                 args_dict['read_file'])
+                if not created:
+                    run_logger.critical(args_dict['read_file'] + " was claimed as SPUID " + spuid +
+                                        " by another launch. Aborting submission.")
+                    zamboni.disconnect()
+                    sys.exit(0)
+                args_dict['spuid'] = spuid
+                args_dict['temp_dir'] = temp_path
                 os.mkdir(args_dict['temp_dir'], 0777)
             sdb.update_sub_data(args_dict['spuid'], 'temp_path', args_dict['temp_dir'])
-            sdb.update_sub_data(args_dict['spuid'], 'platform_unit', header_dict['PU'])
             os.chmod(args_dict['temp_dir'], 0777)
             args_dict['temp_string'] = args_dict['temp_dir'].split("/")[-1]
             if not args_dict['additional_attributes']:
@@ -166,96 +240,123 @@ def main():
             print ("Initiating single SRA submission of production data...\n")
             zamboni.start_workflow("ProdSraSubWorkflow", args_dict)
             sdb.update_sub_data(args_dict['spuid'], 'submission_status', 'requested')
+        except SystemExit:
+            raise
         except:
-            sdb.update_sub_data(args_dict['spuid'], 'submission_status', 'launch failed')
+            if 'spuid' in args_dict:
+                sdb.update_sub_data(args_dict['spuid'], 'submission_status', 'launch failed')
             traceback.print_exc()
             traceback.print_stack()
             sys.exit(1)
 
     elif mode == "prod_batch":
         print ("\nInitiating batch SRA submission of production data...\n")
+        batch = []
         try:
             with open(args_dict['batch_input_file']) as csvfile:
                 reader = csv.DictReader(csvfile)
                 for row in reader:
-                    try:
-                        if args_dict['dry_run']:
-                            row['dry_run'] = True
-                        if args_dict['host_screen']:
-                            row['host_screen'] = True
-                        if args_dict['trim']:
-                            row['trim'] = args_dict['trim']
-                        if row["read_file"] == '':
-                            run_logger.info("No read file detected for entry" + row["g_project"] + ". Do you have blank rows?")
-                            continue
-                        ph.check_row(row)
-                        if not os.path.isfile(row['read_file']):
-                            run_logger.critical(row['read_file'] + " does not exist. Please supply an existing read file.")
-                            zamboni.disconnect()
-                            sys.exit(-1)
-                        header_dict = bp.parse_header(row['read_file'])
-                        prev_sub_data_info = sdb.check_submission_exists(platform_unit=header_dict['PU'])
-                        if len(prev_sub_data_info) == 1:
-                            if prev_sub_data_info[0][1] and prev_sub_data_info[0][2]:
-                                if prev_sub_data_info[0][2] in c.run_states and not args_dict['force']:
-                                    run_logger.critical(row['read_file'] + " is currently being processed for submission. "
-                                                                           "Please wait until current submission completes "
-                                                                           "before resubmitting.")
-                                    continue
-                                elif prev_sub_data_info[0][2] == 'processed-ok' and not args_dict['force']:
-                                    run_logger.critical(row['read_file'] + " previously submitted successfully. "
-                                                                           "Aborting submission.")
-                                    continue
-                                elif (prev_sub_data_info[0][2] == 'processed-ok' or prev_sub_data_info[0][2] == 'requested') \
-                                        and args_dict['force']:
-                                    run_logger.info(row['read_file']
-                                                    + " running or previously submitted successfully "
-                                                      "but resubmitting as directed by user.")
-                                    # resubmit the data with same info as previous submission
-                                    row['spuid'] = prev_sub_data_info[0][0]
-                                    row['temp_dir'] = prev_sub_data_info[0][1].rstrip("/")
-                                    sdb.reset_resub(row['spuid'])
-                                    if os.path.isdir(row['temp_dir']):
-                                        shutil.rmtree(row['temp_dir'])
-                                    os.mkdir(row['temp_dir'])
-                                else:
-                                    # resubmit the data with same info as previous submission
-                                    row['spuid'] = prev_sub_data_info[0][0]
-                                    row['temp_dir'] = prev_sub_data_info[0][1].rstrip("/")
-                                    sdb.reset_resub(row['spuid'])
-                                    if os.path.isdir(row['temp_dir']):
-                                        shutil.rmtree(row['temp_dir'])
-                                    os.mkdir(row['temp_dir'])
-                                    run_logger.info(row['read_file']
-                                                    + " previously submitted unsuccessfully. Resubmitting with same SPUID.")
-                        else:
-                            run_logger.info(row['read_file']
-                                            + " never submitted. Processing as new submission.")
-                            row['spuid'] = sdb.get_new_spuid(row['read_file'])
-                            row['temp_dir'] = c.temp_root + c.spuid_prefix + str(row['spuid'])
-                            sdb.update_sub_data(row['spuid'], 'temp_path', row['temp_dir'])
-                            sdb.update_sub_data(row['spuid'], 'platform_unit', header_dict['PU'])
-                            os.mkdir(row['temp_dir'], 0777)
-                        os.chmod(row['temp_dir'], 0777)
-                        row['temp_string'] = row['temp_dir'].split("/")[-1]
-                        row['notificationEmailAddresses'] = args_dict['notificationEmailAddresses']
-                        zamboni.start_workflow("ProdSraSubWorkflow", row)
-                        run_logger.debug("Row sent to Zamboni:" + str(row))
-                        sdb.update_sub_data(row['spuid'], 'submission_status', 'requested')
-                    except:
+                    if args_dict['dry_run']:
+                        row['dry_run'] = True
+                    if args_dict['host_screen']:
+                        row['host_screen'] = True
+                    if args_dict['trim']:
+                        row['trim'] = args_dict['trim']
+                        row['trim_required'] = args_dict['trim_required']
+                    if row["read_file"] == '':
+                        run_logger.info("No read file detected for entry" + row["g_project"] + ". Do you have blank rows?")
+                        continue
+                    ph.check_row(row)
+                    if not os.path.isfile(row['read_file']):
+                        run_logger.critical(row['read_file'] + " does not exist. Please supply an existing read file.")
                         zamboni.disconnect()
-                        sdb.update_sub_data(row['spuid'], 'submission_status', 'launch failed')
-                        traceback.print_exc()
-                        traceback.print_stack()
-                        sys.exit(1)
+                        sys.exit(-1)
+                    batch.append((row, bp.parse_header(row['read_file'])['PU']))
                 csvfile.close()
         except IOError:
             zamboni.disconnect()
             run_logger.error('ERROR:{} not found.'.format(args_dict['batch_input_file']))
             print('{} not found.'.format(args_dict['batch_input_file']))
             sys.exit(-1)
+        # resolve the whole batch against the submission db before anything is sent to zamboni
+        prev_subs = sdb.check_submissions_exist([platform_unit for row, platform_unit in batch])
+        launch_rows = []
+        new_rows = []
+        batch_units = set()
+        for row, platform_unit in batch:
+            if platform_unit in batch_units:
+                run_logger.critical(row['read_file'] + " has the same platform unit as an earlier row of this batch. "
+                                                       "Skipping duplicate row.")
+                continue
+            batch_units.add(platform_unit)
+            try:
+                prev_sub_data_info = prev_subs[platform_unit]
+                if len(prev_sub_data_info) == 1:
+                    if prev_sub_data_info[0][1] and prev_sub_data_info[0][2]:
+                        if prev_sub_data_info[0][2] in c.run_states and not args_dict['force']:
+                            run_logger.critical(row['read_file'] + " is currently being processed for submission. "
+                                                                   "Please wait until current submission completes "
+                                                                   "before resubmitting.")
+                            continue
+                        elif prev_sub_data_info[0][2] == 'processed-ok' and not args_dict['force']:
+                            run_logger.critical(row['read_file'] + " previously submitted successfully. "
+                                                                   "Aborting submission.")
+                            continue
+                        elif (prev_sub_data_info[0][2] == 'processed-ok' or prev_sub_data_info[0][2] == 'requested') \
+                                and args_dict['force']:
+                            run_logger.info(row['read_file']
+                                            + " running or previously submitted successfully "
+                                              "but resubmitting as directed by user.")
+                            # resubmit the data with same info as previous submission
+                            row['spuid'] = prev_sub_data_info[0][0]
+                            row['temp_dir'] = prev_sub_data_info[0][1].rstrip("/")
+                            sdb.reset_resub(row['spuid'])
+                            if os.path.isdir(row['temp_dir']):
+                                shutil.rmtree(row['temp_dir'])
+                            os.mkdir(row['temp_dir'])
+                        else:
+                            # resubmit the data with same info as previous submission
+                            row['spuid'] = prev_sub_data_info[0][0]
+                            row['temp_dir'] = prev_sub_data_info[0][1].rstrip("/")
+                            sdb.reset_resub(row['spuid'])
+                            if os.path.isdir(row['temp_dir']):
+                                shutil.rmtree(row['temp_dir'])
+                            os.mkdir(row['temp_dir'])
+                            run_logger.info(row['read_file']
+                                            + " previously submitted unsuccessfully. Resubmitting with same SPUID.")
+                else:
+                    run_logger.info(row['read_file']
+                                    + " never submitted. Processing as new submission.")
+                    new_rows.append((row, platform_unit))
+                launch_rows.append(row)
+            except:
+                zamboni.disconnect()
+                if 'spuid' in row:
+                    sdb.update_sub_data(row['spuid'], 'submission_status', 'launch failed')
+                traceback.print_exc()
+                traceback.print_stack()
+                sys.exit(1)
+        lost_ids = set(id(row) for row in reserve_new_submissions(sdb, new_rows))
+        launch_rows = [row for row in launch_rows if id(row) not in lost_ids]
+        if args_dict['prevalidate']:
+            launch_rows = prevalidate_rows(sdb, launch_rows)
+        for row in launch_rows:
+            try:
+                os.chmod(row['temp_dir'], 0777)
+                row['temp_string'] = row['temp_dir'].split("/")[-1]
+                row['notificationEmailAddresses'] = args_dict['notificationEmailAddresses']
+                zamboni.start_workflow("ProdSraSubWorkflow", row)
+                run_logger.debug("Row sent to Zamboni:" + str(row))
+                sdb.update_sub_data(row['spuid'], 'submission_status', 'requested')
+            except:
+                zamboni.disconnect()
+                sdb.update_sub_data(row['spuid'], 'submission_status', 'launch failed')
+                traceback.print_exc()
+                traceback.print_stack()
+                sys.exit(1)
     elif mode == "manual":
         print ("Initiating SRA submission of data in CSV file...\n")
+        batch = []
         try:
             with open(args_dict['batch_input_file']) as csvfile:
                 reader = csv.DictReader(csvfile)
@@ -271,6 +372,7 @@ def main():
                     if args_dict['trim']:
                         run_logger.info("Trimming selected")
                         row['trim'] = args_dict['trim']
+                        row['trim_required'] = args_dict['trim_required']
                     if row["read_file"] == '':
                         run_logger.info("No read file detected for entry. Do you have blank rows? Skipping...")
                         continue
@@ -287,77 +389,19 @@ def main():
                         run_logger.critical(row['read_file'] + " does not exist. Please supply an existing read file.")
                         zamboni.disconnect()
                         sys.exit(-1)
+                    # submissions are keyed by platform unit where the bam header has one, by read file otherwise
+                    platform_unit = row['read_file']
                     if 'bam' in row['file_type']:
                         run_logger.info('{} is a bam file.'.format(row['file_type']))
                         header_dict = bp.parse_header(row['read_file'])
                         if 'PU' in header_dict:
                             run_logger.debug('Platform unit:{}'.format(header_dict['PU']))
-                            prev_sub_data_info = sdb.check_submission_exists(platform_unit=header_dict['PU'])
+                            platform_unit = header_dict['PU']
                         else:
                             run_logger.debug('No platform unit detected.')
-                            prev_sub_data_info = sdb.check_submission_exists(platform_unit=row['read_file'])
                     else:
                         run_logger.info('{} is not a bam file.'.format(row['read_file']))
-                        prev_sub_data_info = sdb.check_submission_exists(platform_unit=row['read_file'])
-                    run_logger.debug('Previous submission data: {}'.format(prev_sub_data_info))
-                    if len(prev_sub_data_info) == 1:
-                        if prev_sub_data_info[0][1] and prev_sub_data_info[0][2]:
-                            if prev_sub_data_info[0][2] in c.run_states and not args_dict['force']:
-                                run_logger.critical(row['read_file'] + " is currently being processed for submission."
-                                                                       "Please wait until current submission completes"
-                                                                       "before resubmitting.")
-                                continue
-                            elif prev_sub_data_info[0][2] == 'processed-ok' and not args_dict['force']:
-                                run_logger.critical(row['read_file'] + " previously submitted successfully."
-                                                                       "Aborting submission.")
-                                continue
-                            elif (prev_sub_data_info[0][2] == 'processed-ok' or prev_sub_data_info[0][2] == 'requested')\
-                                    and args_dict['force']:
-                                run_logger.info(row['read_file']
-                                                + " running or previously submitted successfully "
-                                                  "but resubmitting as directed by user.")
-                                # resubmit the data with same info as previous submission
-                                row['spuid'] = prev_sub_data_info[0][0]
-                                row['temp_dir'] = prev_sub_data_info[0][1]
-                                sdb.reset_resub(row['spuid'])
-                                if os.path.isdir(row['temp_dir']):
-                                    shutil.rmtree(row['temp_dir'])
-                                os.mkdir(row['temp_dir'])
-                            else:
-                                # resubmit the data with same info as previous submission
-                                row['spuid'] = prev_sub_data_info[0][0]
-                                row['temp_dir'] = prev_sub_data_info[0][1]
-                                sdb.reset_resub(row['spuid'])
-                                if os.path.isdir(row['temp_dir']):
-                                    shutil.rmtree(row['temp_dir'])
-                                os.mkdir(row['temp_dir'])
-                                run_logger.info(row['read_file']
-                                                + " previously submitted unsuccessfully. Resubmitting with same SPUID.")
-                        else:
-                            run_logger.info(row['read_file']
-                                            + " submitted but missing data. Processing as new submission.")
-                            row['spuid'] = sdb.get_new_spuid(row['read_file'])
-                            row['temp_dir'] = c.temp_root + c.spuid_prefix + str(row['spuid'])
-                            sdb.update_sub_data(row['spuid'], 'temp_path', row['temp_dir'])
-                            os.mkdir(row['temp_dir'], 0777)
-                    else:
-                        run_logger.info(row['read_file']
-                                        + " never submitted. Processing as new submission.")
-                        row['spuid'] = sdb.get_new_spuid(row['read_file'])
-                        row['temp_dir'] = c.temp_root + c.spuid_prefix + str(row['spuid'])
-                        sdb.update_sub_data(row['spuid'], 'temp_path', row['temp_dir'])
-                        if 'bam' in row['file_type'] and 'PU' in header_dict:
-                            sdb.update_sub_data(row['spuid'], 'platform_unit', header_dict['PU'])
-                        else:
-                            sdb.update_sub_data(row['spuid'], 'platform_unit', row['read_file'])
-                        os.mkdir(row['temp_dir'], 0777)
-                    os.chmod(row['temp_dir'], 0777)
-                    row['temp_string'] = row['temp_dir'].split("/")[-1]
-                    row['notificationEmailAddresses'] = args_dict['notificationEmailAddresses']
-                    zamboni.start_workflow("ManualSraSubWorkflow", row)
-		    print("ROW SENT TO ZAMBONI:" + str(row))
-                    run_logger.debug("Row sent to Zamboni:" + str(row))
-                    sdb.update_sub_data(row['spuid'], 'submission_status', 'requested')
+                    batch.append((row, platform_unit))
                     # except KeyError as e:
                     #     zamboni.disconnect()
                     #     sdb.update_sub_data(row['spuid'], 'submission_status', 'KeyError')
@@ -372,6 +416,71 @@ def main():
             run_logger.critical('ERROR:{} not found.'.format(args_dict['batch_input_file']))
             print('ERROR:{} not found.'.format(args_dict['batch_input_file']))
             sys.exit(-1)
+        # resolve the whole batch against the submission db before anything is sent to zamboni
+        prev_subs = sdb.check_submissions_exist([platform_unit for row, platform_unit in batch])
+        launch_rows = []
+        new_rows = []
+        batch_units = set()
+        for row, platform_unit in batch:
+            if platform_unit in batch_units:
+                run_logger.critical(row['read_file'] + " has the same platform unit as an earlier row of this batch. "
+                                                       "Skipping duplicate row.")
+                continue
+            batch_units.add(platform_unit)
+            prev_sub_data_info = prev_subs[platform_unit]
+            run_logger.debug('Previous submission data: {}'.format(prev_sub_data_info))
+            if len(prev_sub_data_info) == 1:
+                if prev_sub_data_info[0][1] and prev_sub_data_info[0][2]:
+                    if prev_sub_data_info[0][2] in c.run_states and not args_dict['force']:
+                        run_logger.critical(row['read_file'] + " is currently being processed for submission."
+                                                               "Please wait until current submission completes"
+                                                               "before resubmitting.")
+                        continue
+                    elif prev_sub_data_info[0][2] == 'processed-ok' and not args_dict['force']:
+                        run_logger.critical(row['read_file'] + " previously submitted successfully."
+                                                               "Aborting submission.")
+                        continue
+                    elif (prev_sub_data_info[0][2] == 'processed-ok' or prev_sub_data_info[0][2] == 'requested')\
+                            and args_dict['force']:
+                        run_logger.info(row['read_file']
+                                        + " running or previously submitted successfully "
+                                          "but resubmitting as directed by user.")
+                        # resubmit the data with same info as previous submission
+                        row['spuid'] = prev_sub_data_info[0][0]
+                        row['temp_dir'] = prev_sub_data_info[0][1]
+                        sdb.reset_resub(row['spuid'])
+                        if os.path.isdir(row['temp_dir']):
+                            shutil.rmtree(row['temp_dir'])
+                        os.mkdir(row['temp_dir'])
+                    else:
+                        # resubmit the data with same info as previous submission
+                        row['spuid'] = prev_sub_data_info[0][0]
+                        row['temp_dir'] = prev_sub_data_info[0][1]
+                        sdb.reset_resub(row['spuid'])
+                        if os.path.isdir(row['temp_dir']):
+                            shutil.rmtree(row['temp_dir'])
+                        os.mkdir(row['temp_dir'])
+                        run_logger.info(row['read_file']
+                                        + " previously submitted unsuccessfully. Resubmitting with same SPUID.")
+                else:
+                    run_logger.info(row['read_file']
+                                    + " submitted but missing data. Processing as new submission.")
+                    new_rows.append((row, None))
+            else:
+                run_logger.info(row['read_file']
+                                + " never submitted. Processing as new submission.")
+                new_rows.append((row, platform_unit))
+            launch_rows.append(row)
+        lost_ids = set(id(row) for row in reserve_new_submissions(sdb, new_rows))
+        launch_rows = [row for row in launch_rows if id(row) not in lost_ids]
+        for row in launch_rows:
+            os.chmod(row['temp_dir'], 0777)
+            row['temp_string'] = row['temp_dir'].split("/")[-1]
+            row['notificationEmailAddresses'] = args_dict['notificationEmailAddresses']
+            zamboni.start_workflow("ManualSraSubWorkflow", row)
+            print("ROW SENT TO ZAMBONI:" + str(row))
+            run_logger.debug("Row sent to Zamboni:" + str(row))
+            sdb.update_sub_data(row['spuid'], 'submission_status', 'requested')
     else:
         run_logger.critical("{} is not a recognized submission mode.".format(mode))
     run_logger.info("\n=========RUN SUBMISSION LOG RECORD END=========\n")
@@ -1,9 +1,40 @@
 __author__ = 'Amr Abouelleil'
 
 import unittest
-from SRA_submission_tool.file_service import BamParser
+import struct
+import tempfile
+import shutil
+import gzip
+import os
+import time
+import SRA_submission_tool.constants as c
+from SRA_submission_tool.file_service import BamParser, HeaderCache
+from SRA_submission_tool import bgzf
 from tests import BAM, WALK_UP_BAM
 
+HEADER_TEXT = ("@HD\tVN:1.5\tSO:queryname\n"
+               "@SQ\tSN:chr1\tLN:1000\tUR:/ref/genome.fasta\n"
+               "@SQ\tSN:chr2\tLN:2000\tUR:/ref/genome.fasta\n"
+               "@RG\tID:A\tPL:illumina\tPU:C686TACXX150305.7\tLB:Solexa-316435\tDT:2015-03-05T00:00:00-0500\n"
+               "@RG\tID:B\tPL:illumina\tPU:C686TACXX150305.8\tLB:Solexa-316436\n"
+               "@PG\tID:bwa\tPN:bwa\tCL:bwa mem -t 4 ref.fa r1.fq\n"
+               "@CO\tfree text comment\n")
+
+
+def make_bam(path, text=HEADER_TEXT, references=(("chr1", 1000), ("chr2", 2000)), records="", block_size=50):
+    """
+    Writes a small BAM file, splitting the inflated stream into BGZF blocks of block_size bytes.
+    """
+    data = bgzf.bam_magic + struct.pack("<i", len(text)) + text + struct.pack("<i", len(references))
+    for name, length in references:
+        data += struct.pack("<i", len(name) + 1) + name + "\x00" + struct.pack("<i", length)
+    data += records
+    with open(path, 'wb') as handle:
+        for i in range(0, len(data), block_size):
+            handle.write(bgzf.compress_block(data[i:i + block_size]))
+        handle.write(bgzf.eof_block)
+    return path
+
 
 class BamParserTest(unittest.TestCase):
 
@@ -16,5 +47,83 @@ class BamParserTest(unittest.TestCase):
     def test_walkup_bam_parser(self):
         self.assertIsInstance(self.bp.parse_header(WALK_UP_BAM), dict)
 
+
+class NativeHeaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.bam = make_bam(os.path.join(self.temp_dir, "test.bam"), records="\x01" * 500)
+        self.bp = BamParser()
+
+    def test_blocks_are_gzip_compatible(self):
+        self.assertEqual(gzip.open(self.bam).read(len(bgzf.bam_magic)), bgzf.bam_magic)
+
+    def test_read_header_records(self):
+        header = self.bp.read_header(self.bam)
+        self.assertEqual(header['HD'], {'VN': "1.5", 'SO': "queryname"})
+        self.assertEqual([rg['PU'] for rg in header['RG']], ["C686TACXX150305.7", "C686TACXX150305.8"])
+        self.assertEqual([sq['SN'] for sq in header['SQ']], ["chr1", "chr2"])
+        self.assertEqual(header['PG'][0]['CL'], "bwa mem -t 4 ref.fa r1.fq")
+        self.assertEqual(header['CO'], ["free text comment"])
+        self.assertEqual(header['references'], [("chr1", 1000), ("chr2", 2000)])
+
+    def test_parse_header_flat_dict(self):
+        header_dict = self.bp.parse_header(self.bam)
+        self.assertEqual(header_dict['PU'], "C686TACXX150305.7")
+        self.assertEqual(header_dict['UR'], "/ref/genome.fasta")
+        self.assertEqual(header_dict['DT'], "2015-03-05T00:00:00-0500")
+
+    def test_reader_stops_at_first_record(self):
+        with bgzf.BgzfReader(self.bam) as reader:
+            bgzf.read_bam_header(reader)
+            self.assertEqual(reader.read(3), "\x01" * 3)
+
+    def test_header_cache(self):
+        bp = BamParser(cache_db=os.path.join(self.temp_dir, "header_cache.db"))
+        header = bp.read_header(self.bam)
+        self.assertEqual(bp.cache.get(self.bam), header)
+        cached = BamParser(cache_db=os.path.join(self.temp_dir, "header_cache.db"))
+        read_bam_header = bgzf.read_bam_header
+        bgzf.read_bam_header = None
+        try:
+            self.assertEqual(cached.read_header(self.bam), header)
+        finally:
+            bgzf.read_bam_header = read_bam_header
+        self.assertIs(type(cached.parse_header(self.bam)['PU']), str)
+        make_bam(self.bam, text=HEADER_TEXT.replace("C686TACXX150305.7", "C686TACXX150305.1"), block_size=60)
+        self.assertEqual(cached.cache.get(self.bam), None)
+        self.assertEqual(cached.parse_header(self.bam)['PU'], "C686TACXX150305.1")
+
+    def test_cache_pruning(self):
+        max_age_days, max_entries = c.fingerprint_cache_max_age_days, c.fingerprint_cache_max_entries
+        c.fingerprint_cache_max_age_days, c.fingerprint_cache_max_entries = 30, 1
+        try:
+            cache = HeaderCache(os.path.join(self.temp_dir, "pruned_cache.db"))
+            for version, age_days in (("1", 60), ("2", 1), ("3", 0)):
+                cache.put(self.bam, {'references': []}, version=version)
+                with cache.manager.transaction() as conn:
+                    conn.execute('''UPDATE results SET cached=? WHERE version=?''',
+                                 (time.time() - age_days * 24 * 60 * 60, version))
+            with cache.manager.transaction() as conn:
+                self.assertEqual(cache.prune(conn), 2)
+            self.assertEqual(cache.get(self.bam, "1"), None)
+            self.assertEqual(cache.get(self.bam, "2"), None)
+            self.assertEqual(cache.get(self.bam, "3"), {'references': []})
+        finally:
+            c.fingerprint_cache_max_age_days, c.fingerprint_cache_max_entries = max_age_days, max_entries
+
+    def test_truncated_header_rejected(self):
+        with open(self.bam, 'rb') as handle:
+            block_size = bgzf.read_block(handle)[0]
+            handle.seek(0)
+            first_block = handle.read(block_size)
+        truncated = os.path.join(self.temp_dir, "truncated.bam")
+        with open(truncated, 'wb') as handle:
+            handle.write(first_block)
+        self.assertRaises(bgzf.BgzfError, self.bp.read_header, truncated)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,164 @@
+__author__ = 'Amr Abouelleil'
+
+import unittest
+import tempfile
+import shutil
+import struct
+import os
+from SRA_submission_tool import bam_stats
+from SRA_submission_tool.bam_stats import BamStatistics
+from SRA_submission_tool.screening_service import ScreeningService
+from SRA_submission_tool.file_service import write_bam_slice, concatenate_bams
+import SRA_submission_tool.constants as c
+from tests.bam_parser_test import make_bam
+
+
+def make_record(name, seq_length, flag=0, ref_id=0, pos=100):
+    """
+    Builds an unaligned-style BAM alignment record without cigar or tags.
+    """
+    data = struct.pack("<iiBBHHHiiii", ref_id, pos, len(name) + 1, 60, 4680, 0, flag, seq_length, ref_id, pos + 200,
+                       300)
+    data += name + "\x00" + "\x11" * ((seq_length + 1) // 2) + "\x1e" * seq_length
+    return struct.pack("<i", len(data)) + data
+
+
+class BamStatisticsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.old_db, self.old_broker_db = c.submission_db, c.broker_db
+        c.submission_db = os.path.join(self.temp_dir, "submission.db")
+        c.broker_db = os.path.join(self.temp_dir, "broker.db")
+        records = ""
+        self.reads = self.bases = 0
+        for i in range(400):
+            flag = [0x41, 0x81, 0x100, 0x45][i % 4]
+            records += make_record("read" + str(i), 50 + i % 60, flag)
+            if not flag & 0x100:
+                self.reads += 1
+                self.bases += 50 + i % 60
+        self.bam = make_bam(os.path.join(self.temp_dir, "test.bam"), records=records, block_size=700)
+
+    def test_serial_scan(self):
+        stats = BamStatistics(processes=1, cache=False).compute_stats(self.bam)
+        self.assertEqual(stats['records'], 400)
+        self.assertEqual(stats['reads'], self.reads)
+        self.assertEqual(stats['bases'], self.bases)
+        self.assertEqual(stats['unmapped'], 100)
+        self.assertEqual(stats['mean_read_length'], round(float(self.bases) / self.reads, 1))
+
+    def test_ranges_match_serial_scan(self):
+        bs = BamStatistics(processes=4, min_range_size=1, cache=False)
+        self.assertEqual(len(bs.block_ranges(self.bam)), 4)
+        self.assertEqual(bs.compute_stats(self.bam), BamStatistics(processes=1, cache=False).compute_stats(self.bam))
+
+    def test_pool_sized_by_broker_grant(self):
+        broker_cpus, pool = c.broker_cpus, bam_stats.multiprocessing.Pool
+        c.broker_cpus, bam_stats.multiprocessing.Pool = 1, None
+        try:
+            stats = BamStatistics(processes=4, min_range_size=1, cache=False).compute_stats(self.bam)
+        finally:
+            c.broker_cpus, bam_stats.multiprocessing.Pool = broker_cpus, pool
+        self.assertEqual(stats, BamStatistics(processes=1, cache=False).compute_stats(self.bam))
+
+    def test_pure_python_tally(self):
+        numpy = bam_stats.numpy
+        bam_stats.numpy = None
+        try:
+            stats = BamStatistics(processes=1, cache=False).compute_stats(self.bam)
+        finally:
+            bam_stats.numpy = numpy
+        self.assertEqual((stats['reads'], stats['bases']), (self.reads, self.bases))
+
+    def test_record_spanning_ranges(self):
+        records = make_record("short", 100) + make_record("long", 30000) + make_record("short2", 100)
+        bam = make_bam(os.path.join(self.temp_dir, "long.bam"), records=records, block_size=2000)
+        stats = BamStatistics(processes=8, min_range_size=1, cache=False).compute_stats(bam)
+        self.assertEqual((stats['records'], stats['bases']), (3, 30200))
+
+    def test_truncated_record(self):
+        bam = make_bam(os.path.join(self.temp_dir, "cut.bam"), records=make_record("read", 100)[:-10])
+        self.assertRaises(bam_stats.bgzf.BgzfError, BamStatistics(processes=1, cache=False).compute_stats, bam)
+
+    def test_find_first_record(self):
+        first = make_record("read1", 70)
+        data = first + make_record("read2", 80) + make_record("read3", 90)
+        self.assertEqual(bam_stats.find_first_record(data[10:], 2), len(first) - 10)
+
+    def test_stats_cached(self):
+        bs = BamStatistics(processes=1)
+        stats = bs.get_stats(self.bam)
+        compute_stats = bs.compute_stats
+        bs.compute_stats = None
+        try:
+            self.assertEqual(bs.get_stats(self.bam), stats)
+        finally:
+            bs.compute_stats = compute_stats
+
+    def read_records(self, bam_file):
+        with bam_stats.bgzf.BgzfReader(bam_file) as reader:
+            bam_stats.bgzf.read_bam_header(reader)
+            return reader.read(os.path.getsize(bam_file) * 100)
+
+    def test_shards_keep_templates_together(self):
+        records = "".join(make_record("pair" + str(i), 100 + i % 9) * 2 for i in range(300))
+        bam = make_bam(os.path.join(self.temp_dir, "pairs.bam"), records=records, block_size=1000)
+        boundaries = BamStatistics(processes=5, min_range_size=1, cache=False).shard_boundaries(bam)
+        self.assertEqual(len(boundaries), 5)
+        shards = []
+        for i, start in enumerate(boundaries):
+            shards.append(os.path.join(self.temp_dir, "shard" + str(i) + ".bam"))
+            with open(shards[-1], 'wb') as handle:
+                write_bam_slice(bam, start, (boundaries + [None])[i + 1], handle)
+            shard_records = self.read_records(shards[-1])
+            self.assertTrue(shard_records)
+            self.assertEqual(BamStatistics(processes=1, cache=False).compute_stats(shards[-1])['records'] % 2, 0)
+        self.assertEqual("".join(self.read_records(shard) for shard in shards), records)
+        joined = os.path.join(self.temp_dir, "joined.bam")
+        with open(joined, 'wb') as handle:
+            concatenate_bams(bam, shards, handle)
+        self.assertEqual(self.read_records(joined), records)
+        self.assertTrue(bam_stats.bgzf.has_eof_marker(joined))
+
+    def test_shard_scan_caches_stats(self):
+        records = "".join(make_record("pair" + str(i), 100) * 2 for i in range(300))
+        bam = make_bam(os.path.join(self.temp_dir, "pairs.bam"), records=records, block_size=1000)
+        BamStatistics(processes=5, min_range_size=1).shard_boundaries(bam)
+        bs = BamStatistics(processes=1)
+        bs.compute_stats = None
+        self.assertEqual(bs.get_stats(bam)['reads'], 600)
+
+    def test_only_name_grouped_bams_sharded(self):
+        records = "".join(make_record("pair" + str(i), 100) * 2 for i in range(300))
+        bs = BamStatistics(processes=5, min_range_size=1, cache=False)
+        for hd_line, shards in (("@HD\tVN:1.5\tSO:coordinate\n", 1), ("@HD\tVN:1.5\n", 1),
+                                ("@HD\tVN:1.5\tSO:unsorted\tGO:query\n", 5)):
+            bam = make_bam(os.path.join(self.temp_dir, "pairs.bam"), text=hd_line, records=records, block_size=1000)
+            self.assertEqual(len(bs.shard_boundaries(bam)), shards)
+
+    def test_read_retention(self):
+        records = [make_record("read" + str(i), 100) for i in range(40)]
+        kept = make_bam(os.path.join(self.temp_dir, "kept.bam"), records="".join(records[:30]))
+        lost = make_bam(os.path.join(self.temp_dir, "lost.bam"), records="".join(records[:10]))
+        original = make_bam(os.path.join(self.temp_dir, "original.bam"), records="".join(records))
+        ss = ScreeningService()
+        self.assertTrue(ss.check_read_retention(original, kept))
+        self.assertFalse(ss.check_read_retention(original, lost))
+        cached = BamStatistics()
+        cached.compute_stats = None
+        self.assertEqual([cached.get_stats(bam)['reads'] for bam in (original, kept)], [40, 30])
+        check_read_retention = c.screen_check_read_retention
+        c.screen_check_read_retention = False
+        try:
+            self.assertTrue(ss.check_read_retention(original, lost))
+        finally:
+            c.screen_check_read_retention = check_read_retention
+
+    def tearDown(self):
+        c.submission_db, c.broker_db = self.old_db, self.old_broker_db
+        shutil.rmtree(self.temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,16 @@
 __author__ = 'Amr Abouelleil'
 
 import unittest
+import tempfile
+import shutil
+import time
+import sys
+import os
+import SRA_submission_tool.constants as c
 from SRA_submission_tool.file_service import BamValidator
+from SRA_submission_tool.submission_db import SubmissionDBService
 from tests import TEST_PATH
+from tests.bam_parser_test import make_bam
 
 
 class BamValidatorTests(unittest.TestCase):
@@ -22,6 +30,124 @@ class BamValidatorTests(unittest.TestCase):
         print "Bam Validator testing complete."
 
 
+class ScriptedValidator(BamValidator):
+    """
+    Stands in a script for ValidateSamFile that prints the given report, then hangs unless it is stopped.
+    """
+    report = []
+
+    def validation_command(self, bam_file, jvm_flags=()):
+        return [sys.executable, "-c", "import sys, time\nfor line in %r:\n    print line\nsys.stdout.flush()\n"
+                                      "time.sleep(30)" % self.report]
+
+
+class CachedValidationTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.submission_db = c.submission_db
+        self.picard_validate_path = c.picard_validate_path
+        self.broker_db = c.broker_db
+        c.submission_db = os.path.join(self.temp_dir, "submission.db")
+        c.broker_db = os.path.join(self.temp_dir, "broker.db")
+        c.picard_validate_path = os.path.join(self.temp_dir, "ValidateSamFile.jar")
+        open(c.picard_validate_path, 'w').close()
+        self.bam_file = make_bam(os.path.join(self.temp_dir, "test.bam"), records="\x01" * 500)
+        self.sds = SubmissionDBService(c.submission_db)
+        self.spuid = self.sds.get_new_spuid(self.bam_file)
+
+    def validator(self, report):
+        ScriptedValidator.report = report
+        return ScriptedValidator(cache_db=os.path.join(self.temp_dir, "validation_cache.db"))
+
+    def record(self):
+        return list(self.sds.iter_submissions())[0]
+
+    def test_stops_at_first_error(self):
+        start = time.time()
+        self.assertFalse(self.validator(["ERROR: Read name A, Mate not found", "ERROR: more"]).validate_bam(
+            self.bam_file, self.spuid))
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(self.record().submission_status, "not validated")
+        self.assertTrue(float(self.record().validation_seconds) < 10)
+
+    def test_verdict_cached_until_file_or_picard_changes(self):
+        self.assertFalse(self.validator(["ERROR: Mate not found"]).validate_bam(self.bam_file, self.spuid))
+        self.assertFalse(self.validator(None).validate_bam(self.bam_file, self.spuid))
+        with open(c.picard_validate_path, 'w') as handle:
+            handle.write("upgraded")
+        validator = self.validator(None)
+        validator.validation_command = lambda bam_file, jvm_flags=(): [sys.executable, "-c", "print 'No errors found'"]
+        self.assertTrue(validator.validate_bam(self.bam_file, self.spuid))
+        self.assertEqual(self.record().submission_status, "validated")
+
+    def test_validate_batch(self):
+        bam_files = [os.path.join(self.temp_dir, name) for name in ("good_1.bam", "good_2.bam", "bad.bam")]
+        for bam_file in bam_files:
+            make_bam(bam_file)
+        validator = self.validator(None)
+        validator.validation_command = lambda bam_file, jvm_flags=(): [sys.executable, "-c", "print %r" % (
+            "ERROR: Mate not found" if "bad" in bam_file else "No errors found")]
+        results = validator.validate_bams(bam_files + bam_files[:1], workers=2)
+        self.assertEqual(results, {bam_files[0]: (True, None), bam_files[1]: (True, None),
+                                   bam_files[2]: (False, "ERROR: Mate not found")})
+        validator.validation_command = None
+        self.assertEqual(validator.validate_bams(bam_files), results)
+        self.assertEqual(validator.validate_bams([self.bam_file + ".missing"])[self.bam_file + ".missing"][0], None)
+
+    def test_crashed_validation_not_cached(self):
+        validator = self.validator(None)
+        validator.validation_command = lambda bam_file, jvm_flags=(): [
+            sys.executable, "-c", "import sys\nsys.stderr.write('java.lang.OutOfMemoryError\\n')\nsys.exit(1)"]
+        self.assertEqual(validator.validate_bam(self.bam_file, self.spuid), None)
+        self.assertEqual(self.record().submission_status, "validation error")
+        valid, problem = validator.run_validation(self.bam_file)
+        self.assertEqual(valid, None)
+        self.assertIn("status 1", problem)
+        self.assertIn("OutOfMemoryError", problem)
+        validator.validation_command = lambda bam_file, jvm_flags=(): [sys.executable, "-c", "print 'No errors found'"]
+        self.assertTrue(validator.validate_bam(self.bam_file, self.spuid))
+
+    def test_fast_start_flags_only_for_small_batch_files(self):
+        validator = self.validator(None)
+        self.assertEqual(validator.batch_jvm_flags(self.bam_file), c.validation_jvm_flags)
+        self.assertEqual(BamValidator(cache=False).validation_command(self.bam_file)[:2], ["java", "-jar"])
+        fast_start_max_size = c.validation_fast_start_max_size
+        c.validation_fast_start_max_size = os.path.getsize(self.bam_file)
+        try:
+            self.assertEqual(validator.batch_jvm_flags(self.bam_file), [])
+        finally:
+            c.validation_fast_start_max_size = fast_start_max_size
+
+    def test_truncated_bam_fails_before_picard(self):
+        with open(self.bam_file, 'r+b') as handle:
+            handle.truncate(os.path.getsize(self.bam_file) - 10)
+        self.assertFalse(self.validator(None).validate_bam(self.bam_file, self.spuid))
+        self.assertEqual(self.record().submission_status, "not validated")
+
+    def test_broken_block_chain(self):
+        with open(self.bam_file, 'rb') as handle:
+            data = handle.read()
+        with open(self.bam_file, 'wb') as handle:
+            handle.write(data[:200] + data[210:])
+        valid, problem = self.validator(None).check_structure(self.bam_file)
+        self.assertFalse(valid)
+
+    def test_platform_unit_mismatch(self):
+        self.sds.update_sub_data(self.spuid, "platform_unit", "C686TACXX150305.5")
+        validator = self.validator(None)
+        validator.validation_command = lambda bam_file, jvm_flags=(): [sys.executable, "-c", "print 'No errors found'"]
+        self.assertTrue(validator.check_structure(self.bam_file)[0])
+        self.assertFalse(validator.validate_bam(self.bam_file, self.spuid))
+        self.sds.update_sub_data(self.spuid, "platform_unit", "C686TACXX150305.8")
+        self.assertTrue(validator.validate_bam(self.bam_file, self.spuid))
+
+    def tearDown(self):
+        c.submission_db = self.submission_db
+        c.picard_validate_path = self.picard_validate_path
+        c.broker_db = self.broker_db
+        shutil.rmtree(self.temp_dir)
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,6 +1,10 @@
 __author__ = 'Amr Abouelleil'
 
 import unittest
+import tempfile
+import hashlib
+import shutil
+import os
 import SRA_submission_tool.constants as c
 from SRA_submission_tool.file_service import ChecksumCreator
 
@@ -23,5 +27,36 @@ class ChecksumCreatorUnitTests(unittest.TestCase):
         print "Checksum Creator testing complete."
 
 
+class StreamingChecksumTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.target_file = os.path.join(self.temp_dir, "test.bam")
+        self.data = os.urandom(100000)
+        with open(self.target_file, 'wb') as handle:
+            handle.write(self.data)
+
+    def test_digests_match_hashlib_across_chunks(self):
+        for chunk_size in (4096, 99999, 100000, 1 << 20):
+            digests = ChecksumCreator(self.target_file, chunk_size=chunk_size).compute_digests()
+            self.assertEqual(digests['md5'], hashlib.md5(self.data).hexdigest())
+            self.assertEqual(digests['sha256'], hashlib.sha256(self.data).hexdigest())
+            self.assertEqual(digests['size'], len(self.data))
+
+    def test_empty_file(self):
+        open(self.target_file, 'wb').close()
+        self.assertEqual(ChecksumCreator(self.target_file).create_checksum(), hashlib.md5("").hexdigest())
+
+    def test_sidecar_format(self):
+        cc = ChecksumCreator(self.target_file, chunk_size=4096)
+        sidecar = cc.write_checksum(cc.create_checksum())
+        self.assertEqual(open(sidecar).read(), hashlib.md5(self.data).hexdigest())
+
+    def test_missing_file_raises(self):
+        self.assertRaises(IOError, ChecksumCreator(self.target_file + ".missing").create_checksum)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,61 @@
+__author__ = 'Amr Abouelleil'
+
+import unittest
+import tempfile
+import hashlib
+import shutil
+import os
+import SRA_submission_tool.constants as c
+from SRA_submission_tool.checksum_service import ChecksumService, ChecksumCache
+
+
+class ChecksumServiceTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.broker_db = c.broker_db
+        c.broker_db = os.path.join(self.temp_dir, "broker.db")
+        self.files = []
+        for i in range(3):
+            target_file = os.path.join(self.temp_dir, "test_" + str(i) + ".bax.h5")
+            with open(target_file, 'wb') as handle:
+                handle.write(os.urandom(10000 + i))
+            self.files.append(target_file)
+        self.cache_db = os.path.join(self.temp_dir, "checksum_cache.db")
+        self.cs = ChecksumService(processes=2, cache_db=self.cache_db)
+
+    def md5(self, target_file):
+        return hashlib.md5(open(target_file, 'rb').read()).hexdigest()
+
+    def test_checksums_computed_in_pool(self):
+        checksums = self.cs.get_checksums(self.files)
+        self.assertEqual(checksums, dict((f, self.md5(f)) for f in self.files))
+        for f in self.files:
+            self.assertEqual(ChecksumCache(self.cache_db).get(f)['md5'], checksums[f])
+            self.assertFalse(os.path.exists(f + ".md5"))
+
+    def test_cached_checksum_reused(self):
+        self.cs.get_checksums(self.files[:1])
+        self.cs.cache.put(self.files[0], {'md5': "0" * 32})
+        self.assertEqual(self.cs.get_checksums(self.files[:1]), {self.files[0]: "0" * 32})
+
+    def test_stale_checksum_ignored(self):
+        self.cs.get_checksums(self.files[:1])
+        with open(self.files[0], 'ab') as handle:
+            handle.write("more data")
+        os.utime(self.files[0], (0, os.stat(self.files[0]).st_mtime + 10))
+        self.assertEqual(self.cs.get_checksums(self.files[:1]), {self.files[0]: self.md5(self.files[0])})
+
+    def test_rewritten_file_same_size_rehashed(self):
+        self.cs.get_checksums(self.files[:1])
+        with open(self.files[0], 'r+b') as handle:
+            handle.write("x")
+        os.utime(self.files[0], (0, os.stat(self.files[0]).st_mtime + 10))
+        self.assertEqual(self.cs.get_checksums(self.files[:1]), {self.files[0]: self.md5(self.files[0])})
+
+    def tearDown(self):
+        c.broker_db = self.broker_db
+        shutil.rmtree(self.temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
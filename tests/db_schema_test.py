@@ -0,0 +1,71 @@
+__author__ = 'Amr Abouelleil'
+
+import unittest
+import sqlite3
+import tempfile
+import shutil
+import os
+import logging
+from SRA_submission_tool import db_schema
+from SRA_submission_tool.submission_db import SubmissionDBService, ConnectionManager
+
+
+class DBSchemaTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.temp_dir, "submission.db")
+
+    def test_schema_created_on_empty_db(self):
+        sds = SubmissionDBService(self.db)
+        conn = sds.manager.connection()
+        self.assertEqual(db_schema.get_schema_version(conn), db_schema.schema_version)
+        self.assertEqual(db_schema.get_columns(conn, 'submissions'), [col[0] for col in db_schema.submission_columns])
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT spuid FROM submissions WHERE submission_status='running'")
+        self.assertIn("submissions_submission_status", str(plan.fetchall()))
+
+    def test_legacy_table_gains_columns_and_unique_platform_unit(self):
+        conn = sqlite3.connect(self.db)
+        conn.execute("CREATE TABLE submissions (spuid INTEGER PRIMARY KEY AUTOINCREMENT, spuid_date, read_file, "
+                     "platform_unit, temp_path, submission_status)")
+        conn.execute("INSERT INTO submissions (read_file, platform_unit) VALUES ('a.bam', 'PU.1')")
+        conn.commit()
+        conn.close()
+        sds = SubmissionDBService(self.db)
+        self.assertIn('accession', db_schema.get_columns(sds.manager.connection(), 'submissions'))
+        with self.assertRaises(sqlite3.IntegrityError):
+            with sds.manager.transaction() as conn:
+                conn.execute("INSERT INTO submissions (read_file, platform_unit) VALUES ('b.bam', 'PU.1')")
+
+    def test_duplicate_platform_units_left_for_dedupe(self):
+        conn = sqlite3.connect(self.db)
+        conn.execute("CREATE TABLE submissions (spuid INTEGER PRIMARY KEY AUTOINCREMENT, read_file, platform_unit, "
+                     "submission_status)")
+        conn.executemany("INSERT INTO submissions (read_file, platform_unit, submission_status) VALUES (?, ?, ?)",
+                         [('a.bam', 'PU.1', 'processed-ok'), ('b.bam', 'PU.1', 'failed'), ('c.bam', 'PU.2', None)])
+        conn.commit()
+        conn.close()
+        records = []
+        handler = logging.Handler(logging.CRITICAL)
+        handler.emit = records.append
+        logger = logging.getLogger('sra_tool.db_schema')
+        logger.addHandler(handler)
+        try:
+            sds = SubmissionDBService(self.db)
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(len(records), 1)
+        conn = sds.manager.connection()
+        self.assertEqual(db_schema.get_schema_version(conn), db_schema.schema_version)
+        self.assertFalse(db_schema.has_unique_platform_unit(conn))
+        self.assertEqual(db_schema.dedupe_platform_units(sds.manager), [('PU.1', 1, [2])])
+        self.assertTrue(db_schema.has_unique_platform_unit(conn))
+        self.assertEqual(conn.execute("SELECT platform_unit FROM submissions ORDER BY spuid").fetchall(),
+                         [('PU.1',), (None,), ('PU.2',)])
+
+    def tearDown(self):
+        ConnectionManager.for_db(self.db).close()
+        shutil.rmtree(self.temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
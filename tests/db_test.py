@@ -2,7 +2,12 @@ __author__ = 'Amr Abouelleil'
 
 import unittest
 import sqlite3
-from SRA_submission_tool.submission_db import SubmissionDBService
+import tempfile
+import shutil
+import threading
+import multiprocessing
+import time
+from SRA_submission_tool.submission_db import SubmissionDBService, ConnectionManager, JobQueue, StatusWriter
 import os
 
 
@@ -52,5 +57,277 @@ class DBTests(unittest.TestCase):
     def tearDown(self):
         os.remove(self.db)
 
+
+class ConnectionManagerTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.temp_dir, "submission.db")
+        conn = sqlite3.connect(self.db)
+        conn.execute('''CREATE TABLE submissions (spuid INTEGER PRIMARY KEY AUTOINCREMENT, spuid_date, read_file,
+                        platform_unit, temp_path, submission_status, response_message, response_severity,
+                        xml_attributes, release_date, ncbi_submission_id)''')
+        conn.commit()
+        conn.close()
+        self.sds = SubmissionDBService(self.db)
+
+    def test_connection_reused_within_thread(self):
+        self.assertIs(self.sds.manager.connection(), SubmissionDBService(self.db).manager.connection())
+
+    def test_connection_not_shared_across_threads(self):
+        other = []
+        t = threading.Thread(target=lambda: other.append(self.sds.manager.connection()))
+        t.start()
+        t.join()
+        self.assertIsNot(self.sds.manager.connection(), other[0])
+
+    def test_rollback_journal_by_default(self):
+        mode = self.sds.manager.connection().execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "delete")
+
+    def test_wal_journal_mode_opt_in(self):
+        manager = ConnectionManager.for_db(os.path.join(self.temp_dir, "local.db"), "WAL")
+        self.assertEqual(manager.connection().execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        manager.close()
+
+    def test_transaction_rolls_back_on_error(self):
+        spuid = self.sds.get_new_spuid("test_file.bam")
+        try:
+            with self.sds.manager.transaction() as conn:
+                conn.execute("UPDATE submissions SET submission_status='running' WHERE spuid=?", (spuid,))
+                raise ValueError
+        except ValueError:
+            pass
+        self.sds.update_sub_data(spuid, "platform_unit", "PU.1")
+        self.assertEqual(self.sds.check_submission_exists("PU.1")[0][2], None)
+
+    def test_quotes_stripped_from_values(self):
+        spuid = self.sds.get_new_spuid("test_file.bam")
+        self.sds.update_sub_data(spuid, "platform_unit", "PU'.2")
+        self.assertEqual(len(self.sds.check_submission_exists("PU.2")), 1)
+
+    def test_update_sub_fields(self):
+        spuid = self.sds.get_new_spuid("test_file.bam")
+        self.sds.update_sub_fields(spuid, {'platform_unit': "PU.3", 'submission_status': "running",
+                                           'response_message': None})
+        row = self.sds.manager.connection().execute('''SELECT platform_unit, submission_status, response_message
+                                                       FROM submissions WHERE spuid=?''', (spuid,)).fetchone()
+        self.assertEqual(row, ("PU.3", "running", "None"))
+
+    def test_update_many(self):
+        spuids = [self.sds.get_new_spuid("test_file_" + str(i) + ".bam") for i in range(3)]
+        self.sds.update_many([(spuids[0], {'submission_status': "processed-ok"}),
+                              (spuids[1], {'submission_status': "processed-ok"}),
+                              (spuids[2], {'submission_status': "failed", 'response_severity': "error"})])
+        rows = self.sds.manager.connection().execute('''SELECT submission_status, response_severity FROM submissions
+                                                        ORDER BY spuid''').fetchall()
+        self.assertEqual(rows, [("processed-ok", None), ("processed-ok", None), ("failed", "error")])
+
+    def test_check_submissions_exist(self):
+        for i in range(3):
+            spuid = self.sds.get_new_spuid("test_file_" + str(i) + ".bam")
+            self.sds.update_sub_fields(spuid, {'platform_unit': "PU." + str(i), 'temp_path': "temp/" + str(i)})
+        results = self.sds.check_submissions_exist(["PU." + str(i) for i in range(5)])
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results["PU.1"], self.sds.check_submission_exists("PU.1"))
+        self.assertEqual(results["PU.4"], [])
+
+    def test_reserve_spuids_in_input_order(self):
+        first = self.sds.get_new_spuid("test_file.bam")
+        read_files = ["test_file_" + str(i) + ".bam" for i in range(4)]
+        spuids = self.sds.reserve_spuids(read_files)
+        self.assertEqual(spuids, [str(int(first) + i + 1) for i in range(4)])
+        rows = self.sds.manager.connection().execute('''SELECT spuid, read_file FROM submissions WHERE spuid > ?''',
+                                                     (first,)).fetchall()
+        self.assertEqual([(str(spuid), read_file) for spuid, read_file in rows], zip(spuids, read_files))
+
+    def test_status_changes_logged(self):
+        spuid = self.sds.get_new_spuid("test_file.bam")
+        self.sds.update_sub_data(spuid, "submission_status", "running")
+        self.sds.update_sub_fields(spuid, {'submission_status': "running", 'platform_unit': "PU.5"})
+        self.sds.update_many([(spuid, {'submission_status': "validating"})])
+        events = self.sds.get_status_events(spuid)
+        self.assertEqual([(old, new) for old, new, event_time, host, pid in events],
+                         [(None, "running"), ("running", "validating")])
+        self.assertEqual(events[0][4], os.getpid())
+        durations = self.sds.get_stage_durations(spuid)
+        self.assertEqual([status for status, started, seconds in durations], ["running", "validating"])
+        self.assertEqual(self.sds.get_stage_totals()["running"][0], 1)
+
+    def test_iter_submissions_pages_and_filters(self):
+        spuids = self.sds.reserve_spuids(["test_file_" + str(i) + ".bam" for i in range(7)])
+        self.sds.update_many([(spuid, {'submission_status': "processed-ok" if int(spuid) % 2 else "failed"})
+                              for spuid in spuids])
+        records = list(self.sds.iter_submissions(page_size=2))
+        self.assertEqual([str(record.spuid) for record in records], spuids)
+        self.assertEqual(records[0].read_file, "test_file_0.bam")
+        failed = list(self.sds.iter_submissions(exclude_status="processed-ok", page_size=2))
+        self.assertEqual([record.submission_status for record in failed], ["failed"] * 3)
+        ranged = list(self.sds.iter_submissions(status=["processed-ok", "failed"], spuid_range=(spuids[1], spuids[3])))
+        self.assertEqual([str(record.spuid) for record in ranged], spuids[1:4])
+        self.assertEqual(list(self.sds.iter_submissions(since="2999-01-01 00:00:00")), [])
+        self.assertRaises(AttributeError, setattr, records[0], 'spuid', 0)
+
+    def test_get_or_create_submission(self):
+        spuid, temp_path, status, created = self.sds.get_or_create_submission("PU.6", "test_file.bam")
+        self.assertTrue(created)
+        self.assertTrue(temp_path.endswith(spuid))
+        self.assertEqual(self.sds.get_or_create_submission("PU.6", "other_file.bam"), (spuid, temp_path, None, False))
+        results = self.sds.get_or_create_submissions([("PU.6", "test_file.bam"), ("PU.7", "test_file_7.bam")])
+        self.assertFalse(results["PU.6"][3])
+        self.assertTrue(results["PU.7"][3])
+        self.assertEqual(len(list(self.sds.iter_submissions())), 2)
+
+    def test_get_or_create_across_processes(self):
+        results = multiprocessing.Queue()
+        launchers = [multiprocessing.Process(target=create_submissions, args=(self.db, results)) for i in range(4)]
+        for launcher in launchers:
+            launcher.start()
+        created = [results.get(timeout=30) for launcher in launchers]
+        for launcher in launchers:
+            launcher.join()
+        self.assertEqual(sum(created), 20)
+        self.assertEqual(len(list(self.sds.iter_submissions())), 20)
+
+    def test_status_writer_coalesces_and_drops_no_ops(self):
+        spuid = self.sds.get_new_spuid("test_file.bam")
+        self.sds.update_sub_data(spuid, "submission_status", "processing")
+        writer = StatusWriter(self.db, flush_interval=3600)
+        writer.write(spuid, {'submission_status': "processing"})
+        self.assertEqual(writer.flush(), 0)
+        writer.write(spuid, {'submission_status': "submitted", 'ncbi_submission_id': "SUB1"})
+        writer.write(spuid, {'submission_status': "processing", 'ncbi_submission_id': "SUB2"})
+        self.assertEqual(list(self.sds.iter_submissions())[0].ncbi_submission_id, None)
+        self.assertEqual(writer.flush(), 1)
+        self.assertEqual(list(self.sds.iter_submissions())[0].ncbi_submission_id, "SUB2")
+        self.assertEqual(len(self.sds.get_status_events(spuid)), 1)
+        writer.write(spuid, {'ncbi_submission_id': "SUB3"})
+        writer.write(spuid, {'submission_status': "processed-ok"})
+        row = self.sds.manager.connection().execute('''SELECT submission_status, ncbi_submission_id FROM submissions
+                                                       WHERE spuid=?''', (spuid,)).fetchone()
+        self.assertEqual(row, ("processed-ok", "SUB3"))
+        writer.close()
+
+    def test_status_writer_sees_external_writes(self):
+        spuid = self.sds.get_new_spuid("test_file.bam")
+        writer = StatusWriter(self.db, flush_interval=3600)
+        writer.write(spuid, {'submission_status': "processing"})
+        self.assertEqual(writer.flush(), 1)
+        self.sds.update_sub_data(spuid, "submission_status", "submitted")
+        writer.write(spuid, {'submission_status': "processing"})
+        self.assertEqual(writer.flush(), 1)
+        self.assertEqual(list(self.sds.iter_submissions())[0].submission_status, "processing")
+        writer.close()
+
+    def test_status_writer_logs_queued_time(self):
+        spuid = self.sds.get_new_spuid("test_file.bam")
+        writer = StatusWriter(self.db, flush_interval=3600)
+        writer.write(spuid, {'submission_status': "processing"})
+        queued = time.time()
+        time.sleep(0.2)
+        self.assertEqual(writer.flush(), 1)
+        self.assertLessEqual(self.sds.get_status_events(spuid)[-1][2], queued)
+        writer.close()
+
+    def test_archive_terminal_submissions(self):
+        spuids = self.sds.reserve_spuids(["test_file_" + str(i) + ".bam" for i in range(3)])
+        self.sds.update_many([(spuids[0], {'submission_status': "processed-ok", 'platform_unit': "PU.A"}),
+                              (spuids[1], {'submission_status': "abandoned", 'platform_unit': "PU.B"}),
+                              (spuids[2], {'submission_status': "failed", 'platform_unit': "PU.C"})])
+        self.assertEqual(self.sds.archive_submissions(max_age_days=1), 0)
+        self.sds.manager.connection().execute('''UPDATE submissions SET spuid_date='2000-01-01 00:00:00' ''')
+        self.sds.manager.connection().execute('''UPDATE submission_events SET event_time=0''')
+        self.assertEqual(self.sds.archive_submissions(max_age_days=1), 2)
+        self.assertEqual([str(record.spuid) for record in self.sds.iter_submissions()], spuids[2:])
+        self.assertEqual([str(record.spuid) for record in self.sds.iter_submissions(archived=True)], spuids[:2])
+        self.assertEqual(self.sds.check_submission_exists("PU.A")[0][2], "processed-ok")
+        self.assertEqual(self.sds.check_submissions_exist(["PU.B", "PU.C"])["PU.B"][0][2], "abandoned")
+        self.sds.reset_resub(spuids[0])
+        self.assertEqual([str(record.spuid) for record in self.sds.iter_submissions()], [spuids[0], spuids[2]])
+
+    def test_archive_duplicate_platform_units(self):
+        spuids = self.sds.reserve_spuids(["test_file_" + str(i) + ".bam" for i in range(3)])
+        with self.sds.manager.transaction() as conn:
+            # a legacy database, from before platform units were unique
+            conn.execute('''DROP INDEX submissions_platform_unit''')
+            conn.executemany('''UPDATE submissions SET submission_status=?, platform_unit='PU1' WHERE spuid=?''',
+                             [("processed-ok", spuids[0]), ("abandoned", spuids[1])])
+            conn.execute('''UPDATE submissions SET spuid_date='2000-01-01 00:00:00' ''')
+            conn.execute('''UPDATE submission_events SET event_time=0''')
+        self.assertEqual(self.sds.archive_submissions(max_age_days=30), 2)
+        self.assertEqual(sorted(str(record.spuid) for record in self.sds.iter_submissions(archived=True)),
+                         sorted(spuids[:2]))
+        self.sds.update_many([(spuids[2], {'submission_status': "processed-ok", 'platform_unit': "PU1"})])
+        self.sds.manager.connection().execute('''UPDATE submissions SET spuid_date='2000-01-01 00:00:00' ''')
+        self.sds.manager.connection().execute('''UPDATE submission_events SET event_time=0''')
+        self.assertEqual(self.sds.archive_submissions(max_age_days=30), 1)
+        self.assertEqual(list(self.sds.iter_submissions()), [])
+
+    def tearDown(self):
+        self.sds.manager.close()
+        shutil.rmtree(self.temp_dir)
+
+
+def create_submissions(db, results):
+    sds = SubmissionDBService(db)
+    created = 0
+    for i in range(20):
+        created += sds.get_or_create_submission("PU." + str(i), "test_file_" + str(i) + ".bam")[3]
+    results.put(created)
+
+
+def drain_queue(db, worker_id, claimed):
+    queue = JobQueue(db)
+    while True:
+        jobs = queue.claim_next(worker_id, n=2)
+        if not jobs:
+            return
+        for job_id, spuid, payload, attempts in jobs:
+            claimed.put(job_id)
+            queue.complete(job_id, worker_id)
+
+
+class JobQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.temp_dir, "submission.db")
+        self.queue = JobQueue(self.db)
+
+    def test_claim_renew_and_complete(self):
+        job_id = self.queue.enqueue(1, {'read_file': "test_file.bam"})
+        self.assertEqual(self.queue.claim_next("worker-a"), [(job_id, 1, {'read_file': "test_file.bam"}, 1)])
+        self.assertEqual(self.queue.claim_next("worker-b"), [])
+        self.assertTrue(self.queue.renew_lease(job_id, "worker-a"))
+        self.assertFalse(self.queue.complete(job_id, "worker-b"))
+        self.assertTrue(self.queue.complete(job_id, "worker-a"))
+        self.assertEqual(self.queue.counts(), {'done': 1})
+
+    def test_expired_lease_reclaimed(self):
+        job_id = self.queue.enqueue(1)
+        self.queue.claim_next("worker-a", lease_seconds=-1)
+        self.assertEqual(self.queue.claim_next("worker-b")[0][::3], (job_id, 2))
+        self.assertFalse(self.queue.renew_lease(job_id, "worker-a"))
+        self.assertTrue(self.queue.fail(job_id, "worker-b", "boom"))
+        self.assertEqual(self.queue.claim_next("worker-c", lease_seconds=-1)[0][3], 3)
+        self.assertEqual(self.queue.claim_next("worker-d"), [])
+        self.assertEqual(self.queue.counts(), {'failed': 1})
+
+    def test_no_double_claims_across_processes(self):
+        job_ids = [self.queue.enqueue(i) for i in range(40)]
+        claimed = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=drain_queue, args=(self.db, "worker-" + str(i), claimed))
+                   for i in range(4)]
+        for worker in workers:
+            worker.start()
+        results = [claimed.get(timeout=30) for job_id in job_ids]
+        for worker in workers:
+            worker.join()
+        self.assertEqual(sorted(results), job_ids)
+        self.assertEqual(self.queue.counts(), {'done': 40})
+
+    def tearDown(self):
+        self.queue.manager.close()
+        shutil.rmtree(self.temp_dir)
+
+
 if __name__ == '__main__':
     unittest.main()
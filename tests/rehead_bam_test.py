@@ -0,0 +1,78 @@
+__author__ = 'Amr Abouelleil'
+
+import unittest
+import tempfile
+import shutil
+import os
+import functools
+import subprocess
+from SRA_submission_tool.file_service import rehead_bam, rehead_stream, BamParser, StageRunner
+from SRA_submission_tool import bgzf
+from tests.bam_parser_test import make_bam, HEADER_TEXT
+from tests.bam_stats_test import make_record
+
+SCREENED_TEXT = "@HD\tVN:1.5\tSO:queryname\n@PG\tID:bmtagger\tPN:bmtagger\n"
+REFERENCES = [("chr1", 1000), ("chr2", 2000)]
+
+
+class ReheadBamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.records = "".join(make_record("read" + str(i), 100) for i in range(50))
+        self.in_bam = make_bam(os.path.join(self.temp_dir, "in.bam"))
+
+    def read_all(self, bam_file):
+        with bgzf.BgzfReader(bam_file) as reader:
+            header = bgzf.read_bam_header(reader)
+            return header, reader.read(len(self.records) + 1)
+
+    def test_shared_block_recompressed(self):
+        screened = make_bam(os.path.join(self.temp_dir, "screened.bam"), text=SCREENED_TEXT, records=self.records,
+                            block_size=1000)
+        reheaded = rehead_bam(self.in_bam, screened, self.temp_dir, "test")
+        self.assertEqual(self.read_all(reheaded), ((HEADER_TEXT, REFERENCES), self.records))
+        self.assertTrue(bgzf.has_eof_marker(reheaded))
+
+    def test_aligned_blocks_copied(self):
+        screened = os.path.join(self.temp_dir, "screened.bam")
+        record_blocks = bgzf.compress_block(self.records) + bgzf.eof_block
+        with open(screened, 'wb') as handle:
+            handle.write(bgzf.compress_block(bgzf.encode_bam_header(SCREENED_TEXT, REFERENCES)) + record_blocks)
+        reheaded = rehead_bam(self.in_bam, screened, self.temp_dir, "test")
+        self.assertEqual(self.read_all(reheaded), ((HEADER_TEXT, REFERENCES), self.records))
+        self.assertTrue(open(reheaded, 'rb').read().endswith(record_blocks))
+        self.assertEqual(BamParser(cache=False).parse_header(reheaded)['PU'], "C686TACXX150305.7")
+
+    def test_stage_runner_pipes_commands_and_functions(self):
+        screened = make_bam(os.path.join(self.temp_dir, "screened.bam"), text=SCREENED_TEXT, records=self.records)
+        fifo = os.path.join(self.temp_dir, "fifo.bam")
+        os.mkfifo(fifo)
+        target = os.path.join(self.temp_dir, "out.bam")
+        runner = StageRunner(["cat", functools.partial(rehead_stream, self.in_bam), "cat"])
+        runner.start(fifo, target)
+        subprocess.check_call("cat " + screened + " > " + fifo, shell=True)
+        runner.wait()
+        self.assertEqual(self.read_all(target), ((HEADER_TEXT, REFERENCES), self.records))
+
+    def test_stage_runner_errors(self):
+        screened = make_bam(os.path.join(self.temp_dir, "screened.bam"), text=SCREENED_TEXT, records=self.records)
+        target = os.path.join(self.temp_dir, "out.bam")
+        self.assertRaises(subprocess.CalledProcessError, StageRunner(["cat", "exit 2"]).run, screened, target)
+        self.assertRaises(bgzf.BgzfError, StageRunner([functools.partial(rehead_stream, self.in_bam)]).run,
+                          os.devnull, target)
+
+    def test_stage_runner_release(self):
+        fifo = os.path.join(self.temp_dir, "fifo.bam")
+        os.mkfifo(fifo)
+        runner = StageRunner(["cat"])
+        runner.start(fifo, os.path.join(self.temp_dir, "out.bam"))
+        runner.wait()
+        self.assertEqual(os.path.getsize(os.path.join(self.temp_dir, "out.bam")), 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
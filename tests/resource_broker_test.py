@@ -0,0 +1,74 @@
+__author__ = 'Amr Abouelleil'
+
+import unittest
+import tempfile
+import shutil
+import subprocess
+import threading
+import time
+import os
+import sqlite3
+import SRA_submission_tool.constants as c
+from SRA_submission_tool.resource_broker import ResourceBroker, pid_alive
+
+
+class ResourceBrokerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.broker = ResourceBroker(os.path.join(self.temp_dir, "broker.db"), cpus=8, memory_mb=16000)
+
+    def test_grant_takes_free_cpus(self):
+        first = self.broker.acquire(cpus=6, memory_mb=1000, label="first")
+        second = self.broker.acquire(cpus=4, memory_mb=1000, min_cpus=1, label="second")
+        self.assertEqual((first.cpus, second.cpus), (6, 2))
+        first.release()
+        second.release()
+        with self.broker.acquire(cpus=20, memory_mb=50000) as grant:
+            self.assertEqual((grant.cpus, grant.memory_mb), (8, 16000))
+
+    def test_waits_for_release(self):
+        held = self.broker.acquire(cpus=1, memory_mb=12000)
+        granted = []
+        waiter = threading.Thread(target=lambda: granted.append(self.broker.acquire(memory_mb=8000,
+                                                                                    poll_seconds=0.05)))
+        waiter.start()
+        time.sleep(0.3)
+        self.assertFalse(granted)
+        held.release()
+        waiter.join(5)
+        self.assertEqual(len(granted), 1)
+        granted[0].release()
+
+    def test_dead_process_reclaimed(self):
+        process = subprocess.Popen(["true"])
+        process.wait()
+        self.assertFalse(pid_alive(process.pid))
+        self.assertTrue(pid_alive(os.getpid()))
+        with self.broker.manager.transaction() as conn:
+            conn.execute('''INSERT INTO grants (pid, cpus, memory_mb, label, granted) VALUES (?, 8, 16000, '', 0)''',
+                         (process.pid,))
+        with self.broker.acquire(cpus=8, memory_mb=16000) as grant:
+            self.assertEqual(grant.cpus, 8)
+
+    def test_table_created_once_per_process(self):
+        locker = sqlite3.connect(self.broker.manager.db, isolation_level=None)
+        locker.execute("BEGIN IMMEDIATE")
+        old_timeout = c.global_db_timeout
+        c.global_db_timeout = 0.1
+        self.broker.manager.close()
+        try:
+            # a second broker on the same file must not need the write lock
+            ResourceBroker(self.broker.manager.db, cpus=8, memory_mb=16000)
+        finally:
+            c.global_db_timeout = old_timeout
+            self.broker.manager.close()
+            locker.rollback()
+            locker.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,34 @@
 __author__ = 'Amr Abouelleil'
 
 import unittest
+import tempfile
+import shutil
+import subprocess
+import os
 from tests import BAM
-from SRA_submission_tool.screening_service import ScreeningService
+from tests.bam_parser_test import make_bam, HEADER_TEXT
+from tests.bam_stats_test import make_record
+from SRA_submission_tool.screening_service import ScreeningService, ScreeningCache
+from SRA_submission_tool.submission_db import SubmissionDBService
+from SRA_submission_tool import bgzf
+import SRA_submission_tool.constants as c
+
+FAKE_BLENDER = """#!/bin/sh
+# writes the bam named by SCREENED_BAM, or the input bam if SCREENED_BAM is "input", where blender would write its
+# filtered bam
+while [ $# -gt 0 ]; do
+    case $1 in
+        --output_directory) dir=$2; shift;;
+        --output_header) header=$2; shift;;
+        --paired_bam_file) input=$2; shift;;
+    esac
+    shift
+done
+[ -n "$SCREENED_BAM" ] || exit 3
+[ -z "$EXPECT_FIFO" ] || [ -p "$input" ] || exit 4
+[ "$SCREENED_BAM" = input ] && SCREENED_BAM=$input
+cat "$SCREENED_BAM" > "$dir$header.filter-bmtagger.paired.sample.1.bam"
+"""
 
 
 class ScreenTest(unittest.TestCase):
@@ -19,5 +45,139 @@ def tearDown(self):
         print "Ending ScreenTest..."
 
 
+class StreamingScreenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.old_settings = c.blender_path, c.screen_temp_dir
+        self.old_shard_settings = c.screen_min_shard_size, c.submission_db
+        self.old_cache_settings = c.screen_cache_dir, c.human_reference, c.broker_db, c.broker_poll_seconds
+        self.old_version_commands = c.screen_version_commands
+        c.screen_version_commands = ["echo blender 1.0"]
+        c.broker_db = os.path.join(self.temp_dir, "broker.db")
+        c.broker_poll_seconds = 0.1
+        c.screen_cache_dir = os.path.join(self.temp_dir, "cache")
+        c.human_reference = os.path.join(self.temp_dir, "reference.fasta")
+        with open(c.human_reference, 'w') as handle:
+            handle.write(">chr1\nACGT\n")
+        c.blender_path = os.path.join(self.temp_dir, "blender.sh")
+        with open(c.blender_path, 'w') as handle:
+            handle.write(FAKE_BLENDER)
+        os.chmod(c.blender_path, 0755)
+        c.screen_temp_dir = self.temp_dir + "/"
+        self.output_dir = os.path.join(self.temp_dir, "out")
+        os.mkdir(self.output_dir)
+        self.read_file = make_bam(os.path.join(self.temp_dir, "reads.bam"))
+        self.records = "".join(make_record("read" + str(i), 100) for i in range(20))
+        os.environ['SCREENED_BAM'] = make_bam(os.path.join(self.temp_dir, "screened.bam"),
+                                              text="@HD\tVN:1.5\n", records=self.records)
+
+    def test_screened_bam_streamed_to_output_dir(self):
+        final_bam = ScreeningService().screen_human(read_file=self.read_file, library_layout="paired",
+                                                    file_type="bam", spuid="BI_1", output_dir=self.output_dir)
+        self.assertEqual(final_bam, self.output_dir + "/reads.bam")
+        with bgzf.BgzfReader(final_bam) as reader:
+            self.assertEqual(bgzf.read_bam_header(reader)[0], HEADER_TEXT)
+            self.assertEqual(reader.read(len(self.records) + 1), self.records)
+        self.assertFalse(os.path.exists(c.screen_temp_dir + "BI_1"))
+
+    def test_blender_failure(self):
+        del os.environ['SCREENED_BAM']
+        self.assertRaises(subprocess.CalledProcessError, ScreeningService().screen_human, read_file=self.read_file,
+                          library_layout="paired", file_type="bam", spuid="BI_1", output_dir=self.output_dir)
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+    def screen_pairs(self, records):
+        c.screen_min_shard_size = 1
+        c.submission_db = os.path.join(self.temp_dir, "submission.db")
+        spuid = SubmissionDBService(c.submission_db).get_or_create_submission("PU.1", self.read_file)[0]
+        read_file = make_bam(os.path.join(self.temp_dir, "pairs.bam"), records=records, block_size=3000)
+        os.environ['EXPECT_FIFO'] = "1"
+        return spuid, ScreeningService().screen_human(read_file=read_file, library_layout="paired", file_type="bam",
+                                                      spuid=c.spuid_prefix + spuid, output_dir=self.output_dir,
+                                                      shards=4)
+
+    def test_sharded_screening(self):
+        records = "".join(make_record("pair" + str(i), 100 + i % 7) * 2 for i in range(300))
+        os.environ['SCREENED_BAM'] = "input"
+        spuid, final_bam = self.screen_pairs(records)
+        with bgzf.BgzfReader(final_bam) as reader:
+            self.assertEqual(bgzf.read_bam_header(reader)[0], HEADER_TEXT)
+            self.assertEqual(reader.read(len(records) + 1), records)
+        record = next(SubmissionDBService(c.submission_db).iter_submissions(spuid_range=(spuid, spuid)))
+        self.assertEqual(record.screening_progress, "4/4")
+        self.assertFalse(os.path.exists(c.screen_temp_dir + c.spuid_prefix + spuid))
+
+    def test_sharded_blender_failure(self):
+        del os.environ['SCREENED_BAM']
+        records = "".join(make_record("pair" + str(i), 100) * 2 for i in range(300))
+        self.assertRaises(subprocess.CalledProcessError, self.screen_pairs, records)
+        self.assertEqual(os.listdir(self.output_dir), [])
+        self.assertEqual([name for name in os.listdir(c.screen_temp_dir) if name.startswith(c.spuid_prefix)], [])
+
+    def screen(self, output_dir):
+        return ScreeningService().screen_human(read_file=self.read_file, library_layout="paired", file_type="bam",
+                                               spuid="BI_1", output_dir=output_dir)
+
+    def test_cache_hit_is_linked(self):
+        first = self.screen(self.output_dir)
+        del os.environ['SCREENED_BAM']  # blender now fails, so only a cache hit can succeed
+        second_dir = os.path.join(self.temp_dir, "resubmission")
+        os.mkdir(second_dir)
+        second = self.screen(second_dir)
+        self.assertEqual(os.stat(second).st_ino, os.stat(first).st_ino)
+        self.assertEqual(os.stat(second).st_nlink, 3)
+
+    def test_cache_keyed_by_reference(self):
+        self.screen(self.output_dir)
+        del os.environ['SCREENED_BAM']
+        os.utime(c.human_reference, (0, 0))
+        self.assertRaises(subprocess.CalledProcessError, self.screen, self.output_dir)
+
+    def test_cache_keyed_by_index_files_and_version(self):
+        cache = ScreeningCache()
+        key = cache.key(self.read_file, "paired")
+        index_file = os.path.splitext(c.human_reference)[0] + ".srprism.idx"
+        with open(index_file, 'w') as handle:
+            handle.write("index")
+        indexed_key = cache.key(self.read_file, "paired")
+        self.assertNotEqual(indexed_key, key)
+        with open(index_file, 'w') as handle:
+            handle.write("rebuilt index")
+        self.assertNotEqual(cache.key(self.read_file, "paired"), indexed_key)
+        indexed_key = cache.key(self.read_file, "paired")
+        c.screen_version_commands = ["echo blender 1.1"]
+        self.assertNotEqual(cache.key(self.read_file, "paired"), indexed_key)
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = ScreeningCache(max_bytes=250)
+        target = os.path.join(self.temp_dir, "fetched.bam")
+        for key in ("a", "b"):
+            entry = os.path.join(self.temp_dir, key + ".bam")
+            with open(entry, 'w') as handle:
+                handle.write("x" * 100)
+            cache.store(key, entry)
+        self.assertTrue(cache.fetch("a", target))
+        entry = os.path.join(self.temp_dir, "c.bam")
+        with open(entry, 'w') as handle:
+            handle.write("x" * 100)
+        cache.store("c", entry)
+        self.assertFalse(cache.fetch("b", target))
+        self.assertFalse(os.path.exists(cache.entry_path("b")))
+        os.remove(target)
+        self.assertTrue(cache.fetch("a", target))
+        self.assertTrue(cache.fetch("c", target + "2"))
+
+    def tearDown(self):
+        c.blender_path, c.screen_temp_dir = self.old_settings
+        c.screen_min_shard_size, c.submission_db = self.old_shard_settings
+        c.screen_cache_dir, c.human_reference, c.broker_db, c.broker_poll_seconds = self.old_cache_settings
+        c.screen_version_commands = self.old_version_commands
+        os.environ.pop('SCREENED_BAM', None)
+        os.environ.pop('EXPECT_FIFO', None)
+        # exiting pool threads close their broker connections, which may remove the WAL file under rmtree
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+
 if __name__ == '__main__':
     unittest.main()
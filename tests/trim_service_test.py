@@ -0,0 +1,109 @@
+__author__ = 'Amr Abouelleil'
+
+import unittest
+import tempfile
+import shutil
+import struct
+import gzip
+import os
+from SRA_submission_tool import trim_service
+from SRA_submission_tool.trim_service import TrimService, TrimError, adapter_cuts, encode_adapter, quality_cut
+from SRA_submission_tool import bgzf
+import SRA_submission_tool.constants as c
+from tests.bam_parser_test import make_bam
+
+ADAPTER = "AGATCGGAAGAGC"
+INSERT = "ACGTTGCAACGTTGCATTGA"
+
+
+def make_read(name, bases, flag=0x4):
+    """
+    Builds an unmapped BAM record with the given bases, all of quality 30, and an RG tag.
+    """
+    codes = [trim_service.nibble_bases.index(base) for base in bases] + [0]
+    seq = "".join(chr(codes[i] << 4 | codes[i + 1]) for i in range(0, len(bases), 2))
+    data = struct.pack("<iiBBHHHiiii", -1, -1, len(name) + 1, 0, 4680, 0, flag, len(bases), -1, -1, 0)
+    data += name + "\x00" + seq + "\x1e" * len(bases) + "RGZA\x00"
+    return struct.pack("<i", len(data)) + data
+
+
+def read_records(bam_file):
+    with bgzf.BgzfReader(bam_file) as reader:
+        bgzf.read_bam_header(reader)
+        return reader.read(os.path.getsize(bam_file) * 100)
+
+
+class TrimServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.old_settings = c.broker_db, c.trim_batch_size, c.trim_batch_reads
+        c.broker_db = os.path.join(self.temp_dir, "broker.db")
+        c.trim_batch_size = 500
+        c.trim_batch_reads = 3
+        self.trim_file = os.path.join(self.temp_dir, "trim.seq")
+        with open(self.trim_file, 'w') as handle:
+            handle.write(">TruSeq\n" + ADAPTER + "\n\n")
+        self.output_dir = os.path.join(self.temp_dir, "out")
+        os.mkdir(self.output_dir)
+
+    def test_adapter_cuts(self):
+        reads = [INSERT + ADAPTER + "TT", INSERT + ADAPTER[:5], INSERT + ADAPTER[:2], INSERT, "AGA"]
+        cuts = [len(INSERT), len(INSERT), len(INSERT) + 2, len(INSERT), 0]
+        codes = [read.translate(trim_service.fastq_codes) for read in reads]
+        self.assertEqual(adapter_cuts(codes, [encode_adapter(ADAPTER)], 3), cuts)
+        numpy = trim_service.numpy
+        trim_service.numpy = None
+        try:
+            self.assertEqual(adapter_cuts(codes, [encode_adapter(ADAPTER)], 3), cuts)
+        finally:
+            trim_service.numpy = numpy
+
+    def test_quality_cut(self):
+        self.assertEqual(quality_cut("IIIII###", 20, 33), 5)
+        self.assertEqual(quality_cut("IIIII", 20, 33), 5)
+
+    def test_trim_bam(self):
+        records = [make_read("r" + str(i), INSERT + ADAPTER[:i % 13 + 1]) for i in range(60)]
+        records.append(make_read("mapped", INSERT + ADAPTER, flag=0))
+        bam = make_bam(os.path.join(self.temp_dir, "reads.bam"), records="".join(records), block_size=700)
+        trimmed, stats = TrimService(self.trim_file, processes=2).trim(bam, self.output_dir)
+        self.assertEqual(trimmed, self.output_dir + "/reads.bam")
+        expected = [make_read("r" + str(i), INSERT if i % 13 >= 2 else INSERT + ADAPTER[:i % 13 + 1])
+                    for i in range(60)] + records[-1:]
+        self.assertEqual(read_records(trimmed), "".join(expected))
+        self.assertTrue(bgzf.has_eof_marker(trimmed))
+        self.assertEqual(stats['trimmed_reads'], len([i for i in range(60) if i % 13 >= 2]))
+        self.assertEqual(stats['trimmed_bases'], sum(i % 13 + 1 for i in range(60) if i % 13 >= 2))
+
+    def test_trim_gzipped_fastq(self):
+        reads = [INSERT + ADAPTER, INSERT, "ACGTNAGATCGG"]
+        fastq = os.path.join(self.temp_dir, "reads.fastq.gz")
+        handle = gzip.open(fastq, 'wb')
+        for i, read in enumerate(reads * 3):
+            handle.write("@read" + str(i) + "\n" + read + "\n+\n" + "I" * len(read) + "\n")
+        handle.close()
+        trimmed, stats = TrimService(self.trim_file, processes=1).trim(fastq, self.output_dir)
+        lines = gzip.open(trimmed).read().split("\n")
+        self.assertEqual(lines[1::4][:3], [INSERT, INSERT, "ACGTN"])
+        self.assertEqual(lines[3::4][:3], ["I" * len(INSERT), "I" * len(INSERT), "IIIII"])
+        self.assertEqual(stats, {'trimmed_reads': 6, 'trimmed_bases': 3 * (len(ADAPTER) + 7)})
+
+    def test_errors(self):
+        fastq = os.path.join(self.temp_dir, "reads.fastq")
+        with open(fastq, 'w') as handle:
+            handle.write("@read\nACGT\n+\n")
+        self.assertRaises(TrimError, TrimService(self.trim_file).trim, fastq, self.output_dir)
+        self.assertEqual(os.listdir(self.output_dir), [])
+        self.assertRaises(TrimError, TrimService(self.trim_file).trim, self.trim_file, self.output_dir)
+        with open(self.trim_file, 'w') as handle:
+            handle.write("not an adapter\n")
+        self.assertRaises(TrimError, TrimService, self.trim_file)
+
+    def tearDown(self):
+        c.broker_db, c.trim_batch_size, c.trim_batch_reads = self.old_settings
+        shutil.rmtree(self.temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()